@@ -0,0 +1,49 @@
+"""Restricción única (isin, fecha, proveedor) y hash de contenido en files_metadata
+
+Elimina los duplicados existentes (conserva la fila más reciente por id) antes de
+crear el índice único. Es idempotente: si la base se creó con init_db.py con los
+modelos actuales, no vuelve a crear lo que ya existe.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17 09:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+
+    valuation_indexes = {index["name"] for index in inspector.get_indexes("valuations")}
+    if "uq_valuations_isin_fecha_proveedor" not in valuation_indexes:
+        op.execute(
+            "DELETE FROM valuations WHERE id NOT IN ("
+            "SELECT MAX(id) FROM valuations GROUP BY isin, fecha, proveedor)"
+        )
+        op.create_index(
+            "uq_valuations_isin_fecha_proveedor",
+            "valuations",
+            ["isin", "fecha", "proveedor"],
+            unique=True,
+        )
+
+    file_columns = {column["name"] for column in inspector.get_columns("files_metadata")}
+    if "hash_contenido" not in file_columns:
+        op.add_column("files_metadata", sa.Column("hash_contenido", sa.String(length=64), nullable=True))
+        op.create_index("ix_files_metadata_hash_contenido", "files_metadata", ["hash_contenido"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_files_metadata_hash_contenido", table_name="files_metadata")
+    with op.batch_alter_table("files_metadata") as batch_op:
+        batch_op.drop_column("hash_contenido")
+    op.drop_index("uq_valuations_isin_fecha_proveedor", table_name="valuations")
@@ -0,0 +1,62 @@
+"""Índices compuestos para las consultas frecuentes de valoraciones
+
+- uq_valuations_isin_fecha_proveedor se recrea como (isin, fecha DESC, proveedor):
+  la misma llave del upsert sirve para "la valoración más reciente de un ISIN"
+  (get_latest_valuation, compare_providers, get_missing_data)
+- ix_valuations_fecha_proveedor (fecha, proveedor) para consultas por día y proveedor
+- ix_valuations_isin_upper sobre upper(isin) para el filtro sin mayúsculas de query_valuations
+- Se eliminan ix_valuations_isin e ix_valuations_fecha: son prefijos de los índices compuestos
+
+Ver scripts/benchmark_valuation_indexes.py para los planes de consulta antes y después.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 11:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    existing = {index["name"] for index in inspector.get_indexes("valuations")}
+
+    if "uq_valuations_isin_fecha_proveedor" in existing:
+        op.drop_index("uq_valuations_isin_fecha_proveedor", table_name="valuations")
+    op.create_index(
+        "uq_valuations_isin_fecha_proveedor",
+        "valuations",
+        ["isin", sa.text("fecha DESC"), "proveedor"],
+        unique=True,
+    )
+
+    if "ix_valuations_fecha_proveedor" not in existing:
+        op.create_index("ix_valuations_fecha_proveedor", "valuations", ["fecha", "proveedor"])
+    if "ix_valuations_isin_upper" not in existing:
+        op.create_index("ix_valuations_isin_upper", "valuations", [sa.text("upper(isin)")])
+
+    for redundant in ("ix_valuations_isin", "ix_valuations_fecha"):
+        if redundant in existing:
+            op.drop_index(redundant, table_name="valuations")
+
+
+def downgrade() -> None:
+    op.create_index("ix_valuations_fecha", "valuations", ["fecha"])
+    op.create_index("ix_valuations_isin", "valuations", ["isin"])
+    op.drop_index("ix_valuations_isin_upper", table_name="valuations")
+    op.drop_index("ix_valuations_fecha_proveedor", table_name="valuations")
+    op.drop_index("uq_valuations_isin_fecha_proveedor", table_name="valuations")
+    op.create_index(
+        "uq_valuations_isin_fecha_proveedor",
+        "valuations",
+        ["isin", "fecha", "proveedor"],
+        unique=True,
+    )
@@ -17,6 +17,40 @@ class Settings(BaseSettings):
     supabase_api_key: str = ""  # API Key de Supabase (anon key)
     supabase_table_pip: str = "BD_PIP"  # Tabla para PIP_LATAM
     supabase_table_precia: str = "BD_Precia"  # Tabla para PRECIA
+
+    # Pool HTTP compartido para la API REST de Supabase
+    supabase_http2: bool = True  # Usa HTTP/2 si el paquete h2 está instalado
+    supabase_max_connections: int = 20
+    supabase_max_keepalive_connections: int = 10
+    supabase_keepalive_expiry: float = 30.0  # Segundos que una conexión ociosa se mantiene abierta
+    supabase_timeout: float = 30.0
+    supabase_schema_cache_ttl: int = 3600  # Segundos que se reutilizan las columnas detectadas por tabla
+    supabase_fanout_workers: int = 8  # Hilos para consultar PIP_LATAM y PRECIA en paralelo
+    supabase_provider_timeout: float = 120.0  # Segundos máximos de espera por proveedor
+    supabase_page_size: int = 1000  # Filas pedidas por página (se ajusta al max-rows del servidor)
+    supabase_page_workers: int = 4  # Páginas descargadas en paralelo por consulta
+    supabase_files_view_suffix: str = "_archivos"  # Vistas de archivos (scripts/create_supabase_file_views.sql)
+    supabase_file_list_cache_ttl: int = 300  # Segundos máximos de la caché del listado de archivos
+    supabase_file_list_signature_ttl: int = 30  # Segundos que se reutiliza la firma de la tabla (detección de ingestas nuevas)
+    supabase_pagination_mode: str = "keyset"  # "keyset" (por cursor) u "offset" (conteo exacto + rangos en paralelo)
+
+    # Ingesta
+    ingestion_vectorized: bool = True  # Conversión por columnas en process_dataframe (False = fila por fila)
+    ingestion_batch_size: int = 5000  # Filas por lote en la carga masiva (COPY / executemany)
+    ingestion_mode: str = "upsert"  # "upsert" (reemplaza por isin/fecha/proveedor) o "append" (conserva la existente)
+
+    # Paginación de /valuations
+    valuations_page_size: int = 500  # Filas por página si no se indica limit
+    valuations_max_page_size: int = 5000  # Máximo de filas por página
+    valuations_count_cache_ttl: int = 300  # Segundos que se reutiliza un conteo como estimación
+    
+    # Series de tiempo por ISIN
+    series_cache_ttl: int = 300  # Segundos que se reutiliza una serie ya calculada
+    series_cache_max_entries: int = 512  # Series en caché por proceso (se descarta la menos usada)
+    
+    # Exportación de valoraciones (streaming)
+    export_batch_size: int = 2000  # Filas por lote leídas del cursor del servidor
+    export_max_rows: int = 1000000  # Máximo de filas por petición de exportación
     
     # MongoDB Atlas (deprecated - ya no se usa)
     # mongodb_uri: str = ""
@@ -36,6 +70,20 @@ class Settings(BaseSettings):
     openai_api_key: str
     llm_model: str = "gpt-4"
     llm_temperature: float = 0.3
+    intent_fast_path: bool = True  # Extraer la intención con reglas antes de llamar al LLM
+    intent_fast_path_min_confidence: float = 0.7  # Confianza mínima de las reglas para no llamar al LLM
+    intent_cache_ttl: int = 3600  # Segundos que se reutiliza la extracción del LLM de un mensaje (0 desactiva la caché)
+    intent_cache_max_entries: int = 2048  # Extracciones en caché por proceso (se descarta la menos usada)
+    intent_cache_path: str = ""  # Archivo SQLite para conservar la caché entre reinicios (vacío = solo memoria)
+    response_mode: str = "styled"  # fast (plantillas, sin LLM) | styled (el LLM reescribe la respuesta con personalidad)
+    response_style_cache_ttl: int = 86400  # Segundos que se reutiliza una respuesta reescrita para el mismo texto
+    response_style_cache_max_entries: int = 1024  # Respuestas reescritas en caché por proceso
+    
+    # Base de conocimiento (Guia de Estudio - Renta Fija.pdf)
+    knowledge_index_dir: str = "knowledge_index"  # Índice precalculado (scripts/build_knowledge_index.py)
+    knowledge_retrieval_mode: str = "bm25"  # bm25 | semantic | hybrid (semantic/hybrid requieren vectores precalculados)
+    knowledge_embedding_model: str = ""  # Ruta local de un modelo sentence-transformers (se ejecuta en CPU, sin red)
+    knowledge_hybrid_alpha: float = 0.5  # Peso del coseno en el modo hybrid (1 - alpha para BM25)
     
     # Application
     secret_key: str = "cambiar-en-produccion"
@@ -45,6 +93,7 @@ class Settings(BaseSettings):
     # API
     api_v1_prefix: str = "/api/v1"
     cors_origins: str = "http://localhost:3000,http://localhost:3001"
+    api_threadpool_size: int = 40  # Hilos para los handlers síncronos (BD, Supabase y OpenAI son bloqueantes)
     
     @property
     def cors_origins_list(self) -> List[str]:
@@ -3,24 +3,30 @@ S.I.R.I.U.S V4 - API Principal
 """
 from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool
 from jinja2 import Environment, FileSystemLoader
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from datetime import date
 import logging
+import anyio.to_thread
+import json
+import csv
+import io
 import os
 
-from database import get_db, engine, Base
-from models import Provider
+from database import get_db, engine, Base, SessionLocal
+from models import Provider, Valuation
 from schemas import (
-    ChatMessage, ChatResponse, ValuationResponse, ValuationQuery,
+    ChatMessage, ChatResponse, ValuationResponse, ValuationQuery, BatchCompareRequest,
     IngestRequest, IngestResponse, SupabaseAuthRequest, SupabaseAuthResponse
 )
-from services.chat_service import ChatService
-from services.query_service import QueryService
+from services.chat_service import ChatService, init_chat_resources, get_openai_client, get_knowledge_service
+from services.query_service import QueryService, invalidate_series_cache
 from services.ingestion_service import IngestionService
+from services import response_formats
 from config import settings
 from typing import Dict
 import threading
@@ -61,6 +67,39 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def configure_threadpool():
+    """
+    Dimensiona el threadpool de los endpoints síncronos
+    
+    Los endpoints que usan la sesión de SQLAlchemy, Supabase u OpenAI son `def`:
+    FastAPI los ejecuta en este pool y el event loop queda libre para otras peticiones
+    """
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = settings.api_threadpool_size
+    logger.info(f"🧵 Threadpool de endpoints: {settings.api_threadpool_size} hilos")
+
+
+@app.on_event("startup")
+async def load_chat_resources():
+    """
+    Crea el cliente de OpenAI y carga el índice de conocimiento una vez por proceso
+    
+    Un error aquí no detiene la API: los recursos se vuelven a crear en la primera consulta al chat
+    """
+    try:
+        await run_in_threadpool(init_chat_resources)
+    except Exception as e:
+        logger.error(f"❌ Error inicializando los recursos del chat (se reintenta en la primera consulta): {str(e)}")
+
+
+@app.on_event("shutdown")
+def shutdown_http_clients():
+    """Cierra el pool HTTP compartido de Supabase al apagar la aplicación"""
+    from services.supabase_service import close_http_clients
+    close_http_clients()
+
+
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
     """Página principal con interfaz de chat"""
@@ -75,7 +114,7 @@ async def health_check():
 
 
 @app.post(f"{settings.api_v1_prefix}/auth/supabase", response_model=SupabaseAuthResponse)
-async def authenticate_supabase(auth: SupabaseAuthRequest):
+def authenticate_supabase(auth: SupabaseAuthRequest):
     """
     Endpoint para autenticar con Supabase usando correo y contraseña
     
@@ -139,7 +178,7 @@ async def authenticate_supabase(auth: SupabaseAuthRequest):
 
 
 @app.post(f"{settings.api_v1_prefix}/chat", response_model=ChatResponse)
-async def chat(
+def chat(
     message: ChatMessage,
     db: Session = Depends(get_db)
 ):
@@ -165,7 +204,9 @@ async def chat(
         chat_service = ChatService(
             db, 
             supabase_access_token=access_token,
-            conversation_context=context
+            conversation_context=context,
+            client=get_openai_client(),
+            knowledge_service=get_knowledge_service()
         )
         response = chat_service.generate_response(message.message, message.user)
         
@@ -180,8 +221,54 @@ async def chat(
         raise HTTPException(status_code=500, detail=f"Error procesando consulta: {str(e)}")
 
 
+@app.post(f"{settings.api_v1_prefix}/chat/stream")
+def chat_stream(
+    message: ChatMessage,
+    db: Session = Depends(get_db)
+):
+    """
+    Chat con la respuesta simple primero y la reescrita con personalidad después
+    
+    Responde NDJSON: la primera línea ({"type": "answer", ...}) trae la respuesta completa
+    con las plantillas del modo fast; en modo styled, cada línea siguiente
+    ({"type": "styled", "answer": ...}) trae la respuesta con un fragmento más reescrito por el LLM.
+    """
+    try:
+        user_id = message.user or "default"
+        with context_lock:
+            context = conversation_contexts.get(user_id)
+        
+        chat_service = ChatService(
+            db,
+            supabase_access_token=message.supabase_access_token,
+            conversation_context=context,
+            client=get_openai_client(),
+            knowledge_service=get_knowledge_service(),
+            defer_styling=True
+        )
+        response = chat_service.generate_response(message.message, message.user)
+        
+        new_context = chat_service.get_conversation_context()
+        with context_lock:
+            conversation_contexts[user_id] = new_context
+        
+        first = ChatResponse(**response).model_dump(mode="json")
+    except Exception as e:
+        logger.error(f"Error en endpoint /chat/stream: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error procesando consulta: {str(e)}")
+    
+    def generate():
+        yield json.dumps({"type": "answer", **first}, ensure_ascii=False) + "\n"
+        for styled_answer in chat_service.iter_styled_answers(first["answer"]):
+            yield json.dumps({"type": "styled", "answer": styled_answer}, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
 @app.get(f"{settings.api_v1_prefix}/valuations", response_model=List[ValuationResponse])
-async def get_valuations(
+def get_valuations(
+    request: Request,
+    response: Response,
     isin: Optional[str] = None,
     isins: Optional[str] = None,  # Coma separada
     proveedor: Optional[Provider] = None,
@@ -190,12 +277,26 @@ async def get_valuations(
     fecha_fin: Optional[date] = None,
     emisor: Optional[str] = None,
     tipo_instrumento: Optional[str] = None,
+    formato: Optional[str] = None,  # json | columnar | arrow | parquet (si no se indica, se usa el header Accept)
+    after_id: Optional[int] = None,  # Paginación: último id de la página anterior
+    limit: Optional[int] = None,  # Tamaño de página (por defecto VALUATIONS_PAGE_SIZE, máximo VALUATIONS_MAX_PAGE_SIZE)
+    exact_count: bool = False,  # Conteo exacto en X-Total-Count (si no, es una estimación)
     db: Session = Depends(get_db)
 ):
     """
     Endpoint para consultar valoraciones con filtros estructurados
+    
+    Los formatos columnar, arrow y parquet se construyen directamente desde el
+    resultado de la consulta, sin validar cada fila con ValuationResponse.
+    
+    Todos los formatos se paginan por id: X-Next-After-Id trae el after_id de la
+    página siguiente y X-Total-Count el total (estimado salvo exact_count)
     """
     try:
+        formato = response_formats.negotiate_format(
+            formato, request.headers.get("accept")
+        )
+        
         # Procesar lista de ISINs
         isin_list = None
         if isins:
@@ -213,16 +314,124 @@ async def get_valuations(
         )
         
         query_service = QueryService(db)
-        valuations = query_service.query_valuations(query)
+        
+        if limit is not None and limit < 1:
+            raise ValueError("El límite debe ser mayor que cero")
+        limit = min(limit or settings.valuations_page_size, settings.valuations_max_page_size)
+        
+        if formato != "json":
+            df = query_service.query_valuations_frame(query, after_id=after_id, limit=limit)
+            count = query_service.count_valuations(query, exact=exact_count)
+            headers = {
+                "X-Total-Count": str(count["total"]),
+                "X-Total-Count-Exact": "true" if count["exact"] else "false",
+                "X-Page-Size": str(limit),
+            }
+            if len(df) == limit and df["id"].notna().iloc[-1]:
+                headers["X-Next-After-Id"] = str(int(df["id"].iloc[-1]))
+            if formato in response_formats.FILE_EXTENSIONS:
+                headers["Content-Disposition"] = (
+                    f'attachment; filename="valoraciones.{response_formats.FILE_EXTENSIONS[formato]}"'
+                )
+            return Response(
+                content=response_formats.render(df, formato, Valuation.__table__),
+                media_type=response_formats.MEDIA_TYPES[formato],
+                headers=headers
+            )
+        
+        valuations = query_service.query_valuations(query, after_id=after_id, limit=limit)
+        count = query_service.count_valuations(query, exact=exact_count)
+        
+        response.headers["X-Total-Count"] = str(count["total"])
+        response.headers["X-Total-Count-Exact"] = "true" if count["exact"] else "false"
+        response.headers["X-Page-Size"] = str(limit)
+        if len(valuations) == limit and valuations[-1].id is not None:
+            response.headers["X-Next-After-Id"] = str(valuations[-1].id)
         
         return [ValuationResponse.model_validate(v) for v in valuations]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error en endpoint /valuations: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error consultando valoraciones: {str(e)}")
 
 
+@app.get(f"{settings.api_v1_prefix}/valuations/export")
+def export_valuations(
+    isin: Optional[str] = None,
+    isins: Optional[str] = None,  # Coma separada
+    proveedor: Optional[Provider] = None,
+    fecha: Optional[date] = None,
+    fecha_inicio: Optional[date] = None,
+    fecha_fin: Optional[date] = None,
+    emisor: Optional[str] = None,
+    tipo_instrumento: Optional[str] = None,
+    formato: str = "ndjson",  # ndjson | csv
+    limite: Optional[int] = None,
+    after_id: Optional[int] = None  # Reanudar después del último id recibido
+):
+    """
+    Endpoint para exportar valoraciones por streaming (NDJSON o CSV) con memoria constante
+    
+    Las filas salen ordenadas por id; si la descarga se corta, se reanuda con
+    after_id igual al último id recibido
+    """
+    if formato not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail=f"Formato no soportado: {formato} (use ndjson o csv)")
+    if limite is not None and limite < 1:
+        raise HTTPException(status_code=400, detail="El límite debe ser mayor que cero")
+    limite = min(limite or settings.export_max_rows, settings.export_max_rows)
+    
+    query = ValuationQuery(
+        isin=isin,
+        isins=[i.strip() for i in isins.split(",")] if isins else None,
+        proveedor=proveedor,
+        fecha=fecha,
+        fecha_inicio=fecha_inicio,
+        fecha_fin=fecha_fin,
+        emisor=emisor,
+        tipo_instrumento=tipo_instrumento
+    )
+    columns = [column.name for column in Valuation.__table__.columns]
+    
+    def generate():
+        # Sesión propia: vive lo que dure el stream, no lo que dure la función del endpoint
+        db = SessionLocal()
+        try:
+            rows = QueryService(db).iter_valuation_rows(query, after_id=after_id, limit=limite)
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=columns) if formato == "csv" else None
+            if writer:
+                writer.writeheader()
+            
+            pending = 0
+            for record in rows:
+                if writer:
+                    writer.writerow(record)
+                else:
+                    buffer.write(json.dumps(record, default=lambda v: v.isoformat(), ensure_ascii=False) + "\n")
+                pending += 1
+                if pending >= settings.export_batch_size:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+                    pending = 0
+            yield buffer.getvalue()
+        except Exception as e:
+            logger.error(f"Error en endpoint /valuations/export: {str(e)}")
+            raise
+        finally:
+            db.close()
+    
+    media_type = "text/csv" if formato == "csv" else "application/x-ndjson"
+    headers = {"X-Export-Limit": str(limite)}
+    if formato == "csv":
+        headers["Content-Disposition"] = 'attachment; filename="valoraciones.csv"'
+    return StreamingResponse(generate(), media_type=media_type, headers=headers)
+
+
 @app.get(f"{settings.api_v1_prefix}/valuations/compare")
-async def compare_providers(
+def compare_providers(
     isin: str,
     fecha: Optional[date] = None,
     db: Session = Depends(get_db)
@@ -245,8 +454,62 @@ async def compare_providers(
         raise HTTPException(status_code=500, detail=f"Error comparando proveedores: {str(e)}")
 
 
+@app.post(f"{settings.api_v1_prefix}/valuations/compare/batch")
+def compare_providers_batch(
+    request: BatchCompareRequest,
+    db: Session = Depends(get_db)
+):
+    """
+    Endpoint para conciliar un portafolio completo entre PIP Latam y Precia
+    
+    Responde NDJSON: la primera línea es el resumen agregado y las siguientes
+    traen las diferencias por ISIN en bloques de chunk_size filas
+    """
+    try:
+        query_service = QueryService(db)
+        comparison = query_service.compare_providers_frame(
+            request.isins, request.fecha_inicio, request.fecha_fin
+        )
+        summary = query_service.summarize_comparison(comparison, request.isins, request.umbrales)
+    except Exception as e:
+        logger.error(f"Error en endpoint /valuations/compare/batch: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error comparando proveedores: {str(e)}")
+    
+    def generate():
+        yield json.dumps({"type": "summary", "summary": summary}) + "\n"
+        for start in range(0, len(comparison), request.chunk_size):
+            chunk = comparison.iloc[start:start + request.chunk_size].copy()
+            chunk["fecha"] = chunk["fecha"].astype(str)
+            chunk = chunk.astype(object).where(chunk.notna(), None)
+            yield json.dumps({"type": "rows", "rows": chunk.to_dict(orient="records")}) + "\n"
+    
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+@app.get(f"{settings.api_v1_prefix}/valuations/{{isin}}/series")
+def get_valuation_series(
+    isin: str,
+    fecha_inicio: Optional[date] = None,
+    fecha_fin: Optional[date] = None,
+    frecuencia: Optional[str] = None,  # semanal | mensual (sin valor = diaria)
+    agregacion: str = "ultimo",  # ultimo | promedio
+    db: Session = Depends(get_db)
+):
+    """
+    Endpoint para obtener la serie histórica de un ISIN por proveedor en arreglos por columna
+    """
+    try:
+        query_service = QueryService(db)
+        return query_service.get_series(isin, fecha_inicio, fecha_fin, frecuencia, agregacion)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error en endpoint /valuations/series: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error obteniendo serie: {str(e)}")
+
+
 @app.get(f"{settings.api_v1_prefix}/valuations/{{isin}}/alerts")
-async def get_alerts(
+def get_alerts(
     isin: str,
     fecha: Optional[date] = None,
     db: Session = Depends(get_db)
@@ -270,7 +533,7 @@ async def get_alerts(
 
 
 @app.post(f"{settings.api_v1_prefix}/ingest", response_model=IngestResponse)
-async def ingest_file(
+def ingest_file(
     request: IngestRequest,
     db: Session = Depends(get_db)
 ):
@@ -305,6 +568,8 @@ async def ingest_file(
                 detail="Debe proporcionar file_path o supabase_file_name"
             )
         
+        if result.get("success") and not result.get("skipped"):
+            invalidate_series_cache()
         return IngestResponse(**result)
     except Exception as e:
         logger.error(f"Error en endpoint /ingest: {str(e)}")
@@ -335,12 +600,16 @@ async def upload_file(
             tmp_path = tmp_file.name
         
         try:
+            # La ingesta es bloqueante (pandas + BD): se ejecuta en el threadpool
             ingestion_service = IngestionService(db)
-            result = ingestion_service.ingest_from_file(
+            result = await run_in_threadpool(
+                ingestion_service.ingest_from_file,
                 tmp_path,
                 provider,
                 fecha_valoracion
             )
+            if result.get("success") and not result.get("skipped"):
+                invalidate_series_cache()
             return IngestResponse(**result)
         finally:
             # Limpiar archivo temporal
@@ -366,7 +635,7 @@ async def list_providers():
 
 
 @app.get(f"{settings.api_v1_prefix}/stats")
-async def get_stats(db: Session = Depends(get_db)):
+def get_stats(db: Session = Depends(get_db)):
     """Estadísticas generales de la base de datos"""
     try:
         from sqlalchemy import func
@@ -393,6 +662,20 @@ async def get_stats(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"Error obteniendo estadísticas: {str(e)}")
 
 
+@app.get(f"{settings.api_v1_prefix}/stats/http-pool")
+async def get_http_pool_stats():
+    """Estadísticas de reutilización de conexiones del pool HTTP de Supabase"""
+    from services.supabase_service import get_http_pool_stats
+    return {"pools": get_http_pool_stats()}
+
+
+@app.get(f"{settings.api_v1_prefix}/stats/intent")
+async def get_intent_stats():
+    """Extracciones de intención resueltas por reglas, por el LLM o por el fallback"""
+    from services.chat_service import get_intent_stats
+    return get_intent_stats()
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -1,7 +1,7 @@
 """
 Database models for S.I.R.I.U.S V4
 """
-from sqlalchemy import Column, String, Float, Date, DateTime, Integer, Enum as SQLEnum
+from sqlalchemy import Column, String, Float, Date, DateTime, Integer, Index, Enum as SQLEnum
 from sqlalchemy.sql import func
 from database import Base
 import enum
@@ -31,7 +31,7 @@ class Valuation(Base):
     id = Column(Integer, primary_key=True, index=True)
     
     # Identificación del instrumento
-    isin = Column(String(12), index=True, nullable=False)
+    isin = Column(String(12), nullable=False)  # Indexada por uq_valuations_isin_fecha_proveedor e ix_valuations_isin_upper
     emisor = Column(String(255), index=True)
     tipo_instrumento = Column(String(50), index=True)
     plazo = Column(String(50))
@@ -44,7 +44,7 @@ class Valuation(Base):
     convexidad = Column(Float)
     
     # Metadatos
-    fecha = Column(Date, index=True, nullable=False)
+    fecha = Column(Date, nullable=False)  # Indexada por ix_valuations_fecha_proveedor
     proveedor = Column(SQLEnum(Provider), index=True, nullable=False)
     archivo_origen = Column(String(500))
     timestamp_ingesta = Column(DateTime(timezone=True), server_default=func.now())
@@ -56,6 +56,16 @@ class Valuation(Base):
     cupon = Column(Float)
     frecuencia_cupon = Column(String(20))
     
+    __table_args__ = (
+        # Una valoración por instrumento, fecha y proveedor (permite ingesta idempotente con upsert)
+        # fecha DESC: sirve también para "la valoración más reciente de un ISIN"
+        Index("uq_valuations_isin_fecha_proveedor", isin, fecha.desc(), proveedor, unique=True),
+        # Consultas por día y proveedor
+        Index("ix_valuations_fecha_proveedor", fecha, proveedor),
+        # Búsqueda de ISIN sin distinguir mayúsculas (func.upper en query_valuations)
+        Index("ix_valuations_isin_upper", func.upper(isin)),
+    )
+    
     def __repr__(self):
         return f"<Valuation(isin={self.isin}, proveedor={self.proveedor}, fecha={self.fecha})>"
 
@@ -75,6 +85,7 @@ class FileMetadata(Base):
     errores = Column(String(2000))
     timestamp_procesamiento = Column(DateTime(timezone=True), server_default=func.now())
     ruta_archivo = Column(String(1000))
+    hash_contenido = Column(String(64), index=True)  # SHA-256 del contenido, para omitir archivos ya ingeridos
     
     def __repr__(self):
         return f"<FileMetadata(nombre={self.nombre_archivo}, proveedor={self.proveedor})>"
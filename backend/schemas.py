@@ -2,7 +2,7 @@
 Pydantic schemas for request/response validation
 """
 from pydantic import BaseModel, Field
-from typing import Optional, List
+from typing import Optional, List, Dict
 from datetime import date, datetime
 from models import Provider
 
@@ -72,6 +72,18 @@ class ValuationQuery(BaseModel):
     cupon: Optional[float] = None  # Tasa facial o cupón para filtrar
 
 
+class BatchCompareRequest(BaseModel):
+    """Schema for batch provider comparison request"""
+    isins: List[str] = Field(..., min_length=1, max_length=20000)
+    fecha_inicio: Optional[date] = None  # Sin rango: fecha más reciente de cada ISIN
+    fecha_fin: Optional[date] = None
+    # Diferencia absoluta a partir de la cual una comparación cuenta como alerta
+    umbrales: Dict[str, float] = Field(
+        default_factory=lambda: {"precio_limpio": 0.1, "tasa": 0.05, "duracion": 0.05}
+    )
+    chunk_size: int = Field(500, ge=1, le=5000)  # Filas por línea del stream
+
+
 class IngestRequest(BaseModel):
     """Schema for file ingestion request"""
     provider: Provider
@@ -88,6 +100,9 @@ class IngestResponse(BaseModel):
     message: str
     records_processed: int
     file_metadata_id: Optional[int] = None
+    duration_seconds: Optional[float] = None  # Tiempo de la carga masiva a la BD
+    rows_per_second: Optional[float] = None
+    skipped: bool = False  # True si el archivo ya estaba ingerido con el mismo contenido
 
 
 class SupabaseAuthRequest(BaseModel):
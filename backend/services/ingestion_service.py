@@ -2,12 +2,19 @@
 Servicio de ingesta y normalización de archivos de valoración
 """
 import pandas as pd
+import numpy as np
 import logging
+import enum
+import hashlib
+import time
 from typing import List, Dict, Optional
 from datetime import datetime, date
 from sqlalchemy.orm import Session
+from sqlalchemy import insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from models import Valuation, FileMetadata, Provider
 from services.supabase_service import SupabaseService
+from config import settings
 import io
 
 logger = logging.getLogger(__name__)
@@ -85,6 +92,15 @@ class IngestionService:
         }
     }
     
+    # Campos de Valuation por tipo de conversión
+    STRING_FIELDS = ["emisor", "tipo_instrumento", "plazo", "frecuencia_cupon"]
+    FLOAT_FIELDS = ["precio_limpio", "precio_sucio", "tasa", "duracion", "convexidad", "valor_nominal", "cupon"]
+    DATE_FIELDS = ["fecha_vencimiento", "fecha_emision"]
+    # Columnas que llenan dataframe_to_records (id y timestamp_ingesta los asigna la base de datos)
+    RECORD_FIELDS = ["isin"] + STRING_FIELDS + FLOAT_FIELDS + DATE_FIELDS + ["fecha", "proveedor", "archivo_origen"]
+    # Llave natural de una valoración (índice único uq_valuations_isin_fecha_proveedor)
+    UPSERT_KEY = ["isin", "fecha", "proveedor"]
+    
     def __init__(self, db: Session, supabase_api_key: Optional[str] = None, supabase_access_token: Optional[str] = None):
         self.db = db
         # Usar access token si está disponible, sino usar API key
@@ -126,6 +142,34 @@ class IngestionService:
         
         return df_normalized
     
+    def get_projection(self, provider: Provider, available_columns: List[str],
+                       extra_columns: Optional[List[str]] = None) -> Optional[List[str]]:
+        """
+        Columnas de la tabla de Supabase que realmente usa COLUMN_MAPPINGS
+        
+        Se comparan sin importar mayúsculas, igual que en normalize_column_names,
+        para pedir en el select solo los campos que luego se procesan.
+        
+        Args:
+            provider: Proveedor de la tabla
+            available_columns: Columnas de la tabla (caché de esquema de SupabaseService)
+            extra_columns: Columnas adicionales que necesita el llamador (ej: fecha de valoración)
+        
+        Returns:
+            Lista de columnas a proyectar, o None si no se pudo resolver (usar select=*)
+        """
+        mapping = {key.strip().upper(): value for key, value in self.COLUMN_MAPPINGS.get(provider, {}).items()}
+        projection = [col for col in available_columns if str(col).strip().upper() in mapping]
+        
+        # Sin columna ISIN no se podría procesar nada: mejor no proyectar
+        if not any(mapping[str(col).strip().upper()] == "isin" for col in projection):
+            return None
+        
+        for col in extra_columns or []:
+            if col and col in available_columns and col not in projection:
+                projection.append(col)
+        return projection
+    
     def parse_date(self, date_value) -> Optional[date]:
         """Convierte valor a fecha"""
         if pd.isna(date_value):
@@ -159,8 +203,69 @@ class IngestionService:
         
         return str(value).strip()
     
+    @staticmethod
+    def _column(df: pd.DataFrame, name: str) -> pd.Series:
+        """Columna normalizada; si varias columnas originales mapean al mismo nombre, toma el primer valor no nulo"""
+        if name not in df.columns:
+            return pd.Series([None] * len(df), index=df.index, dtype=object)
+        column = df.loc[:, df.columns == name]
+        if column.shape[1] == 1:
+            return column.iloc[:, 0]
+        return column.bfill(axis=1).iloc[:, 0]
+    
+    @staticmethod
+    def _string_values(series: pd.Series) -> list:
+        """Equivalente vectorizado de parse_string sobre una columna completa"""
+        mask = series.notna().to_numpy()
+        stripped = series.astype(object).where(series.notna(), "").astype(str).str.strip().to_numpy(dtype=object)
+        return np.where(mask, stripped, None).tolist()
+    
+    @staticmethod
+    def _float_values(series: pd.Series) -> list:
+        """Equivalente vectorizado de parse_float (valores no numéricos → None)"""
+        numbers = pd.to_numeric(series, errors="coerce").astype("float64").to_numpy()
+        return np.where(np.isnan(numbers), None, numbers).tolist()
+    
+    @staticmethod
+    def _date_values(series: pd.Series) -> list:
+        """Equivalente vectorizado de parse_date (cada valor se interpreta con su propio formato)"""
+        dates = pd.to_datetime(series, errors="coerce", format="mixed")
+        return np.where(dates.notna().to_numpy(), dates.dt.date.to_numpy(dtype=object), None).tolist()
+    
+    def dataframe_to_records(self, df_normalized: pd.DataFrame, provider: Provider,
+                             fecha_valoracion: date, archivo_origen: str) -> List[Dict]:
+        """
+        Convierte un DataFrame normalizado en diccionarios con los campos de Valuation
+        
+        Convierte columnas completas (pd.to_numeric / pd.to_datetime / .str.strip)
+        con máscaras de nulos, en lugar de parsear celda por celda
+        
+        Returns:
+            Lista de diccionarios listos para Valuation(**registro); omite filas sin ISIN
+        """
+        columns = {"isin": self._string_values(self._column(df_normalized, "isin"))}
+        for field in self.STRING_FIELDS:
+            columns[field] = self._string_values(self._column(df_normalized, field))
+        for field in self.FLOAT_FIELDS:
+            columns[field] = self._float_values(self._column(df_normalized, field))
+        for field in self.DATE_FIELDS:
+            columns[field] = self._date_values(self._column(df_normalized, field))
+        
+        fields = list(columns.keys())
+        records = []
+        for values in zip(*columns.values()):
+            record = dict(zip(fields, values))
+            if not record["isin"]:
+                continue
+            record["fecha"] = fecha_valoracion
+            record["proveedor"] = provider
+            record["archivo_origen"] = archivo_origen
+            records.append(record)
+        return records
+    
     def process_dataframe(self, df: pd.DataFrame, provider: Provider, 
-                         fecha_valoracion: date, archivo_origen: str) -> List[Valuation]:
+                         fecha_valoracion: date, archivo_origen: str,
+                         vectorized: Optional[bool] = None) -> List[Valuation]:
         """
         Procesa DataFrame y crea objetos Valuation
         
@@ -169,6 +274,8 @@ class IngestionService:
             provider: Proveedor
             fecha_valoracion: Fecha de valoración
             archivo_origen: Nombre del archivo origen
+            vectorized: Usar la conversión por columnas (por defecto INGESTION_VECTORIZED);
+                        False usa el recorrido fila por fila original
         
         Returns:
             Lista de objetos Valuation
@@ -182,6 +289,12 @@ class IngestionService:
         if "isin" not in df_normalized.columns:
             raise ValueError("No se encontró columna ISIN en el archivo")
         
+        if vectorized is None:
+            vectorized = settings.ingestion_vectorized
+        if vectorized:
+            records = self.dataframe_to_records(df_normalized, provider, fecha_valoracion, archivo_origen)
+            return [Valuation(**record) for record in records]
+        
         for _, row in df_normalized.iterrows():
             try:
                 # Extraer ISIN (obligatorio)
@@ -217,6 +330,179 @@ class IngestionService:
         
         return valuations
     
+    def process_dataframe_records(self, df: pd.DataFrame, provider: Provider,
+                                  fecha_valoracion: date, archivo_origen: str) -> List[Dict]:
+        """
+        Igual que process_dataframe pero devuelve diccionarios (para la carga masiva)
+        
+        Respeta INGESTION_VECTORIZED: con el recorrido fila por fila convierte cada Valuation a diccionario
+        """
+        if not settings.ingestion_vectorized:
+            valuations = self.process_dataframe(df, provider, fecha_valoracion, archivo_origen, vectorized=False)
+            return [{field: getattr(v, field) for field in self.RECORD_FIELDS} for v in valuations]
+        
+        df_normalized = self.normalize_column_names(df, provider)
+        if "isin" not in df_normalized.columns:
+            raise ValueError("No se encontró columna ISIN en el archivo")
+        return self.dataframe_to_records(df_normalized, provider, fecha_valoracion, archivo_origen)
+    
+    @staticmethod
+    def _copy_value(value) -> str:
+        """Formatea un valor para COPY ... FROM STDIN en formato texto de PostgreSQL"""
+        if value is None:
+            return "\\N"
+        if isinstance(value, enum.Enum):
+            value = value.name  # SQLEnum guarda el nombre del miembro
+        return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+                .replace("\n", "\\n").replace("\r", "\\r"))
+    
+    def _copy_batch(self, records: List[Dict], upsert: bool = False):
+        """
+        Carga un lote con COPY FROM STDIN usando la conexión psycopg2 de la sesión (misma transacción)
+        
+        COPY va a una tabla temporal y desde ahí se hace INSERT ... ON CONFLICT (isin, fecha, proveedor):
+        DO UPDATE en modo upsert, DO NOTHING en modo append (se conservan las filas existentes)
+        """
+        columns = self.RECORD_FIELDS
+        column_list = ", ".join(columns)
+        buffer = io.StringIO()
+        for record in records:
+            buffer.write("\t".join(self._copy_value(record.get(column)) for column in columns))
+            buffer.write("\n")
+        buffer.seek(0)
+        
+        dbapi_connection = self.db.connection().connection.dbapi_connection
+        with dbapi_connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TEMP TABLE IF NOT EXISTS valuations_carga ON COMMIT DROP AS "
+                f"SELECT {column_list} FROM {Valuation.__tablename__} WITH NO DATA"
+            )
+            cursor.execute("TRUNCATE valuations_carga")
+            cursor.copy_expert(f"COPY valuations_carga ({column_list}) FROM STDIN", buffer)
+            if upsert:
+                updates = ", ".join(
+                    f"{column} = EXCLUDED.{column}" for column in columns if column not in self.UPSERT_KEY
+                )
+                conflict_action = f"DO UPDATE SET {updates}, timestamp_ingesta = now()"
+            else:
+                conflict_action = "DO NOTHING"
+            cursor.execute(
+                f"INSERT INTO {Valuation.__tablename__} ({column_list}) "
+                f"SELECT {column_list} FROM valuations_carga "
+                f"ON CONFLICT ({', '.join(self.UPSERT_KEY)}) {conflict_action}"
+            )
+    
+    def _upsert_statement(self, dialect_name: str, replace: bool = True):
+        """
+        INSERT idempotente por (isin, fecha, proveedor) según el dialecto; None si no está soportado
+        
+        Con replace=False la fila existente se conserva (ON CONFLICT DO NOTHING / INSERT OR IGNORE)
+        """
+        table = Valuation.__table__
+        if dialect_name == "sqlite":
+            return insert(table).prefix_with("OR REPLACE" if replace else "OR IGNORE")
+        if dialect_name == "postgresql":
+            statement = pg_insert(table)
+            if not replace:
+                return statement.on_conflict_do_nothing(index_elements=self.UPSERT_KEY)
+            return statement.on_conflict_do_update(
+                index_elements=self.UPSERT_KEY,
+                set_={column: statement.excluded[column] for column in self.RECORD_FIELDS
+                      if column not in self.UPSERT_KEY}
+            )
+        return None
+    
+    def bulk_insert_valuations(self, records: List[Dict], batch_size: Optional[int] = None,
+                               upsert: Optional[bool] = None) -> Dict:
+        """
+        Inserta valoraciones en lotes sin crear objetos ORM
+        
+        PostgreSQL (psycopg2): COPY FROM STDIN. Otras bases (SQLite): insert() con executemany.
+        En modo upsert (INGESTION_MODE=upsert) una fila con el mismo (isin, fecha, proveedor)
+        reemplaza a la existente: ON CONFLICT DO UPDATE en PostgreSQL, INSERT OR REPLACE en SQLite.
+        En modo append se conserva la existente y la nueva se descarta (DO NOTHING / INSERT OR IGNORE),
+        así un archivo que se solapa con datos ya cargados no viola la llave única.
+        No hace commit: se confirma junto con el FileMetadata en la misma transacción.
+        
+        Args:
+            records: Diccionarios con los campos de Valuation (ver dataframe_to_records)
+            batch_size: Filas por lote (por defecto INGESTION_BATCH_SIZE)
+            upsert: Reemplazar valoraciones existentes (por defecto según INGESTION_MODE)
+        
+        Returns:
+            Diccionario con rows, seconds y rows_per_second
+        
+        Raises:
+            RuntimeError: Si la base no es PostgreSQL ni SQLite (no hay INSERT con manejo de conflictos)
+        """
+        batch_size = batch_size or settings.ingestion_batch_size
+        if upsert is None:
+            upsert = settings.ingestion_mode == "upsert"
+        dialect = self.db.get_bind().dialect
+        use_copy = dialect.driver == "psycopg2"
+        
+        statement = None
+        if upsert:
+            # Un mismo archivo puede traer la llave repetida: gana la última fila
+            records = list({tuple(r[k] for k in self.UPSERT_KEY): r for r in records}.values())
+        if not use_copy:
+            statement = self._upsert_statement(dialect.name, replace=upsert)
+            if statement is None:
+                raise RuntimeError(
+                    f"Carga masiva no soportada en {dialect.name}: se requiere PostgreSQL o SQLite "
+                    f"para respetar la llave única (isin, fecha, proveedor)"
+                )
+        
+        inicio = time.perf_counter()
+        for start in range(0, len(records), batch_size):
+            batch = records[start:start + batch_size]
+            if use_copy:
+                self._copy_batch(batch, upsert=upsert)
+            else:
+                self.db.execute(statement, batch)
+        elapsed = time.perf_counter() - inicio
+        
+        rows_per_second = round(len(records) / elapsed, 1) if elapsed > 0 else None
+        logger.info(f"Carga masiva ({'COPY' if use_copy else 'executemany'}{', upsert' if upsert else ''}): "
+                    f"{len(records)} filas en {elapsed:.2f}s ({rows_per_second} filas/s)")
+        return {"rows": len(records), "seconds": round(elapsed, 3), "rows_per_second": rows_per_second}
+    
+    @staticmethod
+    def file_content_hash(file_path: str) -> str:
+        """SHA-256 del contenido de un archivo local"""
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    @staticmethod
+    def dataframe_content_hash(df: pd.DataFrame) -> str:
+        """SHA-256 del contenido de un DataFrame (columnas y valores, sin el índice)"""
+        digest = hashlib.sha256()
+        digest.update(",".join(str(col) for col in df.columns).encode("utf-8"))
+        digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+        return digest.hexdigest()
+    
+    def _find_ingested_file(self, content_hash: str, provider: Provider) -> Optional[FileMetadata]:
+        """Busca un archivo ya procesado con el mismo contenido y proveedor"""
+        return self.db.query(FileMetadata).filter(
+            FileMetadata.hash_contenido == content_hash,
+            FileMetadata.proveedor == provider,
+            FileMetadata.estado_procesamiento == "PROCESADO"
+        ).first()
+    
+    def _skipped_result(self, file_metadata: FileMetadata) -> Dict:
+        """Resultado de ingesta para un archivo sin cambios"""
+        logger.info(f"Archivo sin cambios (ya ingerido como {file_metadata.nombre_archivo}, id={file_metadata.id}); se omite")
+        return {
+            "success": True,
+            "message": f"Archivo sin cambios: ya fue ingerido ({file_metadata.registros_ingresados} registros)",
+            "records_processed": 0,
+            "file_metadata_id": file_metadata.id,
+            "skipped": True
+        }
+    
     def ingest_from_file(self, file_path: str, provider: Provider, 
                         fecha_valoracion: Optional[date] = None) -> Dict:
         """
@@ -231,6 +517,12 @@ class IngestionService:
             Diccionario con resultado de la ingesta
         """
         try:
+            # Omitir el archivo si ya se ingirió el mismo contenido
+            content_hash = self.file_content_hash(file_path)
+            existing_file = self._find_ingested_file(content_hash, provider)
+            if existing_file:
+                return self._skipped_result(existing_file)
+            
             # Leer archivo
             if file_path.endswith('.xlsx') or file_path.endswith('.xls'):
                 df = pd.read_excel(file_path)
@@ -244,9 +536,9 @@ class IngestionService:
                 fecha_valoracion = date.today()
             
             # Procesar datos
-            valuations = self.process_dataframe(df, provider, fecha_valoracion, file_path)
+            records = self.process_dataframe_records(df, provider, fecha_valoracion, file_path)
             
-            if not valuations:
+            if not records:
                 raise ValueError("No se encontraron registros válidos en el archivo")
             
             # Guardar en base de datos
@@ -255,26 +547,29 @@ class IngestionService:
                 proveedor=provider,
                 fecha_valoracion=fecha_valoracion,
                 estado_procesamiento="PROCESADO",
-                registros_ingresados=len(valuations),
-                ruta_archivo=file_path
+                registros_ingresados=len(records),
+                ruta_archivo=file_path,
+                hash_contenido=content_hash
             )
             
             self.db.add(file_metadata)
             self.db.flush()
             
-            # Insertar valoraciones
-            for valuation in valuations:
-                self.db.add(valuation)
+            # Insertar valoraciones en lotes (COPY en PostgreSQL, executemany en SQLite)
+            carga = self.bulk_insert_valuations(records)
+            file_metadata.registros_ingresados = carga["rows"]  # sin llaves repetidas en modo upsert
             
             self.db.commit()
             
-            logger.info(f"Ingesta exitosa: {len(valuations)} registros de {provider.value}")
+            logger.info(f"Ingesta exitosa: {carga['rows']} registros de {provider.value}")
             
             return {
                 "success": True,
-                "message": f"Ingesta exitosa: {len(valuations)} registros",
-                "records_processed": len(valuations),
-                "file_metadata_id": file_metadata.id
+                "message": f"Ingesta exitosa: {carga['rows']} registros",
+                "records_processed": carga["rows"],
+                "file_metadata_id": file_metadata.id,
+                "duration_seconds": carga["seconds"],
+                "rows_per_second": carga["rows_per_second"]
             }
             
         except Exception as e:
@@ -296,12 +591,24 @@ class IngestionService:
             Diccionario con resultado de la ingesta
         """
         try:
-            # Obtener datos desde Supabase
-            df = self.supabase.get_data_by_file(file_name, provider.value)
+            # Obtener datos desde Supabase (solo las columnas que se procesan)
+            table_name = self.supabase.get_table_name(provider.value)
+            columns = self.get_projection(
+                provider,
+                self.supabase._get_available_columns(table_name),
+                extra_columns=[self.supabase.resolve_columns(table_name)["fecha"]]
+            )
+            df = self.supabase.get_data_by_file(file_name, provider.value, columns=columns)
             
             if df.empty:
                 raise ValueError(f"No se encontraron datos para el archivo {file_name}")
             
+            # Omitir el archivo si ya se ingirió el mismo contenido
+            content_hash = self.dataframe_content_hash(df)
+            existing_file = self._find_ingested_file(content_hash, provider)
+            if existing_file:
+                return self._skipped_result(existing_file)
+            
             # Determinar fecha de valoración
             if not fecha_valoracion:
                 # Buscar columna de fecha (puede ser 'fecha', 'FECHA_VALORACION', etc.)
@@ -322,9 +629,9 @@ class IngestionService:
             
             # Procesar datos
             archivo_origen = f"Supabase:{file_name}"
-            valuations = self.process_dataframe(df, provider, fecha_valoracion, archivo_origen)
+            records = self.process_dataframe_records(df, provider, fecha_valoracion, archivo_origen)
             
-            if not valuations:
+            if not records:
                 raise ValueError("No se encontraron registros válidos en el archivo")
             
             # Guardar en base de datos local
@@ -333,26 +640,29 @@ class IngestionService:
                 proveedor=provider,
                 fecha_valoracion=fecha_valoracion,
                 estado_procesamiento="PROCESADO",
-                registros_ingresados=len(valuations),
-                ruta_archivo=f"Supabase:{file_name}"
+                registros_ingresados=len(records),
+                ruta_archivo=f"Supabase:{file_name}",
+                hash_contenido=content_hash
             )
             
             self.db.add(file_metadata)
             self.db.flush()
             
-            # Insertar valoraciones
-            for valuation in valuations:
-                self.db.add(valuation)
+            # Insertar valoraciones en lotes (COPY en PostgreSQL, executemany en SQLite)
+            carga = self.bulk_insert_valuations(records)
+            file_metadata.registros_ingresados = carga["rows"]  # sin llaves repetidas en modo upsert
             
             self.db.commit()
             
-            logger.info(f"Ingesta desde Supabase exitosa: {len(valuations)} registros")
+            logger.info(f"Ingesta desde Supabase exitosa: {carga['rows']} registros")
             
             return {
                 "success": True,
-                "message": f"Ingesta exitosa: {len(valuations)} registros",
-                "records_processed": len(valuations),
-                "file_metadata_id": file_metadata.id
+                "message": f"Ingesta exitosa: {carga['rows']} registros",
+                "records_processed": carga["rows"],
+                "file_metadata_id": file_metadata.id,
+                "duration_seconds": carga["seconds"],
+                "rows_per_second": carga["rows_per_second"]
             }
             
         except Exception as e:
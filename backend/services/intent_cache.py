@@ -0,0 +1,144 @@
+"""
+Caché de extracciones de intención del LLM, compartida por todas las peticiones del proceso
+
+La clave es el mensaje normalizado (services.intent_parser.normalize_message), así que
+"TIR del CDTBMMSOV" y "¿tir del cdtbmmsov?" reutilizan la misma extracción. Tiene
+tamaño máximo (se descarta la menos usada), TTL y contadores de aciertos/fallos.
+Si settings.intent_cache_path está configurado, las entradas también se guardan en
+un archivo SQLite y sobreviven a los reinicios.
+"""
+from collections import OrderedDict
+from typing import Dict, Optional
+from config import settings
+from services.intent_parser import normalize_message
+import copy
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Clave: mensaje normalizado, Valor: dict con result y loaded_at (time.time(), comparable con el de SQLite)
+_intent_cache: "OrderedDict[str, Dict]" = OrderedDict()
+_intent_cache_lock = threading.Lock()
+_counters = {"hits": 0, "misses": 0}
+_db: Optional[sqlite3.Connection] = None
+_db_opened = False  # True aunque no se pueda abrir el archivo, para no reintentar en cada consulta
+
+
+def _get_db() -> Optional[sqlite3.Connection]:
+    """Conexión al archivo SQLite de la caché (None si no está configurado); llamar con el lock tomado"""
+    global _db, _db_opened
+    if _db_opened:
+        return _db
+    _db_opened = True
+    if not settings.intent_cache_path:
+        return None
+    try:
+        _db = sqlite3.connect(settings.intent_cache_path, check_same_thread=False)
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS intent_cache ("
+            "key TEXT PRIMARY KEY, result TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        _db.execute("DELETE FROM intent_cache WHERE created_at < ?", (time.time() - settings.intent_cache_ttl,))
+        _db.commit()
+        logger.info(f"Caché de intenciones persistente en {settings.intent_cache_path}")
+    except sqlite3.Error as e:
+        logger.warning(f"No se pudo abrir la caché de intenciones en {settings.intent_cache_path}: {str(e)}")
+        _db = None
+    return _db
+
+
+def get_cached_intent(message: str) -> Optional[Dict]:
+    """
+    Extracción guardada para un mensaje equivalente, si no ha expirado
+
+    Returns:
+        Copia del resultado (el llamador puede modificarla) con _original_message del mensaje actual, o None
+    """
+    if settings.intent_cache_ttl <= 0:
+        return None
+    key = normalize_message(message)
+    now = time.time()
+    with _intent_cache_lock:
+        entry = _intent_cache.get(key)
+        if entry and now - entry["loaded_at"] >= settings.intent_cache_ttl:
+            del _intent_cache[key]
+            entry = None
+        if entry is None:
+            db = _get_db()
+            if db is not None:
+                try:
+                    row = db.execute(
+                        "SELECT result, created_at FROM intent_cache WHERE key = ?", (key,)
+                    ).fetchone()
+                except sqlite3.Error as e:
+                    logger.warning(f"Error leyendo la caché de intenciones: {str(e)}")
+                    row = None
+                if row and now - row[1] < settings.intent_cache_ttl:
+                    entry = {"result": json.loads(row[0]), "loaded_at": row[1]}
+                    _intent_cache[key] = entry
+        if entry is None:
+            _counters["misses"] += 1
+            return None
+        _intent_cache.move_to_end(key)
+        _counters["hits"] += 1
+        result = copy.deepcopy(entry["result"])
+    result["_original_message"] = message
+    return result
+
+
+def store_intent(message: str, result: Dict):
+    """Guarda la extracción del LLM para el mensaje (y sus variantes normalizadas)"""
+    if settings.intent_cache_ttl <= 0:
+        return
+    key = normalize_message(message)
+    now = time.time()
+    stored = copy.deepcopy(result)
+    with _intent_cache_lock:
+        _intent_cache[key] = {"result": stored, "loaded_at": now}
+        _intent_cache.move_to_end(key)
+        while len(_intent_cache) > settings.intent_cache_max_entries:
+            _intent_cache.popitem(last=False)
+        db = _get_db()
+        if db is not None:
+            try:
+                db.execute(
+                    "INSERT OR REPLACE INTO intent_cache (key, result, created_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(stored, ensure_ascii=False, default=str), now),
+                )
+                db.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Error guardando en la caché de intenciones: {str(e)}")
+
+
+def clear_intent_cache():
+    """Vacía la caché en memoria y, si existe, la persistente (los contadores se conservan)"""
+    with _intent_cache_lock:
+        _intent_cache.clear()
+        db = _get_db()
+        if db is not None:
+            db.execute("DELETE FROM intent_cache")
+            db.commit()
+
+
+def get_intent_cache_stats() -> Dict:
+    """
+    Estadísticas de la caché de intenciones
+
+    Returns:
+        Diccionario {hits, misses, hit_ratio, entries, persistent}
+    """
+    with _intent_cache_lock:
+        hits, misses = _counters["hits"], _counters["misses"]
+        entries = len(_intent_cache)
+    lookups = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+        "entries": entries,
+        "persistent": bool(settings.intent_cache_path),
+    }
@@ -0,0 +1,254 @@
+"""
+Extracción de intención por reglas: ruta rápida antes del LLM
+
+Reconoce las consultas estructuradas (ISIN, nemotécnico, proveedor, fecha de
+valoración, fecha de vencimiento, cupón/tasa facial y campos) sin llamar a OpenAI.
+Devuelve el mismo diccionario que ChatService.extract_intent junto con una confianza
+entre 0 y 1; el chat solo llama al LLM cuando la confianza queda por debajo de
+settings.intent_fast_path_min_confidence.
+
+Ver scripts/evaluate_intent_parser.py para la precisión sobre el corpus etiquetado.
+"""
+import re
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+from services.text_utils import SPANISH_STOP_WORDS, fold_accents
+
+# Los patrones se aplican sobre el mensaje sin tildes (fold_accents), en mayúsculas o minúsculas
+ISIN_PATTERN = re.compile(r'\bCO[A-Z0-9]{10,12}\b')
+_CODE_PATTERN = re.compile(r'\b[A-Z0-9]{6,12}\b')
+_EXPLICIT_NEMOTECNICO = re.compile(r'\bNEMOTECNICO\s+([A-Z0-9]{6,12})\b')
+_DATE_DMY = re.compile(r'\b(\d{1,2})[/-](\d{1,2})[/-](\d{4})\b')
+_DATE_ISO = re.compile(r'\b(\d{4})-(\d{1,2})-(\d{1,2})\b')
+_CUPON_PATTERN = re.compile(r'(?:tasa facial|cupon|tasa del)\D{0,60}?(\d+(?:[.,]\d+)?)')
+_WORD_PATTERN = re.compile(r'[a-z0-9]+')
+_QUESTION_MARKS = re.compile(r'[¿?¡!]')
+
+# Prefijos de nemotécnicos sin dígitos (CDTBGASOV); los demás códigos deben tener letras y dígitos.
+# Un código solo de letras se acepta por prefijo si el usuario lo escribió en mayúsculas
+# ("BONITOS" sí, "bonitos" no: es una palabra)
+NEMOTECNICO_PREFIXES = ("CDT", "TFIT", "TUVT", "TCO", "BON")
+
+# Consultas que no son de datos (explicaciones, conceptos): siempre van al LLM
+_EXPLANATION_PATTERN = re.compile(
+    r'\b(que es|que son|que significa|explica\w*|como se|por que|diferencia entre|definicion)\b'
+)
+
+_COMPARISON_PATTERN = re.compile(r'\b(compara\w*|vs|versus)\b')
+
+# Fechas relativas -> días hacia atrás
+RELATIVE_DATES = {"hoy": 0, "ayer": 1, "anteayer": 2, "antier": 2}
+
+# Campo solicitado -> patrón sobre el mensaje en minúsculas sin tildes
+FIELD_PATTERNS = {
+    "tasa": re.compile(r'\b(tir|yield|rendimiento)\b|\btasa\b(?! facial| del| cupon)'),
+    "precio_limpio": re.compile(r'\bprecio limpio\b'),
+    "precio_sucio": re.compile(r'\bprecio sucio\b'),
+    "duracion": re.compile(r'\bduracion\b'),
+    "convexidad": re.compile(r'\bconvexidad\b'),
+}
+
+# Palabras que las reglas entienden; las demás restan confianza (el mensaje dice algo que no se extrajo)
+KNOWN_WORDS = SPANISH_STOP_WORDS | frozenset("""
+ambos ambas antier anteayer ayer bono bonos buscando buscar busco cdt codigo compara comparacion comparar
+consulta consultar convexidad cupon dame dato datos dia duracion encontrar es esta estoy facial fecha
+hoy informacion isin isins latam limpio modificada muestra muestrame necesito nemotecnico pip precia
+precio precios proveedor proveedores quiero rendimiento saber sucio tasa tes tir titulo titulos trae
+traer valor valoracion valoraciones vence vencen vencimiento versus vs yield
+""".split())
+
+
+def _to_float(value: str) -> Optional[float]:
+    """Número con coma o punto decimal ("14,2232" -> 14.2232)"""
+    try:
+        return float(value.replace(',', '.'))
+    except ValueError:
+        return None
+
+
+def _safe_date(year: str, month: str, day: str) -> Optional[date]:
+    try:
+        return date(int(year), int(month), int(day))
+    except ValueError:
+        return None
+
+
+def _is_nemotecnico(code: str, written_upper: frozenset) -> bool:
+    """
+    Código de 6-12 caracteres que parece un nemotécnico (CDTBGAS0V, TFIT16240724) y no una palabra
+
+    Args:
+        code: Código en mayúsculas
+        written_upper: Códigos que aparecen completos y en mayúsculas en el mensaje original
+    """
+    if code.isdigit() or fold_accents(code) in KNOWN_WORDS:
+        return False
+    if any(c.isdigit() for c in code):
+        return any(c.isalpha() for c in code)
+    return code.startswith(NEMOTECNICO_PREFIXES) and code in written_upper
+
+
+def _extract_dates(text: str) -> Tuple[Optional[date], Optional[date], int]:
+    """
+    Fecha de valoración y fecha de vencimiento escritas en el mensaje
+
+    Una fecha es de vencimiento si "venc" aparece entre la fecha anterior (o el inicio) y ella.
+
+    Returns:
+        (fecha de valoración, fecha de vencimiento, número de fechas que no existen, como 30/02/2024)
+    """
+    invalid = 0
+    valuation_date = None
+    maturity_date = None
+    previous_end = 0
+    matches = sorted(
+        [(m.start(), m.end(), _safe_date(m.group(3), m.group(2), m.group(1))) for m in _DATE_DMY.finditer(text)]
+        + [(m.start(), m.end(), _safe_date(m.group(1), m.group(2), m.group(3))) for m in _DATE_ISO.finditer(text)]
+    )
+    for start, end, parsed in matches:
+        if parsed is None:
+            invalid += 1
+            continue
+        if "venc" in text[previous_end:start]:
+            maturity_date = maturity_date or parsed
+        else:
+            valuation_date = valuation_date or parsed
+        previous_end = end
+    return valuation_date, maturity_date, invalid
+
+
+def normalize_message(message: str, today: Optional[date] = None) -> str:
+    """
+    Forma canónica de un mensaje para reconocer consultas repetidas
+
+    Minúsculas sin tildes, sin signos de interrogación/exclamación ni punto final,
+    espacios colapsados y fechas relativas ("hoy", "ayer") reemplazadas por la fecha
+    absoluta: "¿TIR del  CDTBMMSOV hoy?" y "tir del cdtbmmsov 2026-10-17" coinciden.
+    """
+    today = today or date.today()
+    text = _QUESTION_MARKS.sub(' ', fold_accents(message))
+    text = ' '.join(text.split()).rstrip('. ')
+    for word, days in RELATIVE_DATES.items():
+        text = re.sub(rf'\b{word}\b', (today - timedelta(days=days)).isoformat(), text)
+    return text
+
+
+def parse_intent(message: str, today: Optional[date] = None) -> Tuple[Dict, float]:
+    """
+    Extrae intención y parámetros con reglas
+
+    Args:
+        message: Mensaje del usuario
+        today: Fecha de referencia para "hoy"/"ayer" (por defecto date.today())
+
+    Returns:
+        (resultado con el formato de ChatService.extract_intent, confianza entre 0 y 1)
+    """
+    today = today or date.today()
+    text = fold_accents(message)
+    text_upper = text.upper()
+
+    result = {
+        "intent": "busqueda",
+        "isins": [],
+        "nemotecnico": None,
+        "provider": None,
+        "date": None,
+        "fecha_vencimiento": None,
+        "cupon": None,
+        "fields": [],
+        "comparison": False,
+        "_original_message": message,
+        "_source": "reglas",
+    }
+
+    # Identificadores: ISIN, nemotécnico explícito ("nemotécnico X") o código con forma de nemotécnico
+    isins = list(dict.fromkeys(ISIN_PATTERN.findall(text_upper)))
+    explicit = _EXPLICIT_NEMOTECNICO.search(text_upper)
+    codes = [code for code in _CODE_PATTERN.findall(text_upper) if code not in isins]
+    written_upper = frozenset(_CODE_PATTERN.findall(message))
+    nemotecnicos = list(dict.fromkeys(code for code in codes if _is_nemotecnico(code, written_upper)))
+    # Códigos cortos que empiezan por CO seguido de dígitos (CO000123): ISIN incompleto o nemotécnico
+    ambiguous = [code for code in nemotecnicos if code.startswith("CO") and code[2:3].isdigit()]
+
+    # Proveedor (si se nombran ambos, no se filtra y se entiende como comparación)
+    mentions_pip = bool(re.search(r'\b(pip|latam)\b', text))
+    mentions_precia = bool(re.search(r'\bprecia\b', text))
+    if mentions_pip and not mentions_precia:
+        result["provider"] = "PIP_LATAM"
+    elif mentions_precia and not mentions_pip:
+        result["provider"] = "PRECIA"
+
+    result["comparison"] = bool(_COMPARISON_PATTERN.search(text)) or (mentions_pip and mentions_precia)
+
+    # Fechas: relativas ("hoy", "ayer") y explícitas (DD/MM/YYYY o YYYY-MM-DD)
+    valuation_date, maturity_date, invalid_dates = _extract_dates(text)
+    if valuation_date is None:
+        for word, days in RELATIVE_DATES.items():
+            if re.search(rf'\b{word}\b', text):
+                valuation_date = today - timedelta(days=days)
+                break
+    if valuation_date:
+        result["date"] = valuation_date.isoformat()
+    if maturity_date:
+        result["fecha_vencimiento"] = maturity_date.isoformat()
+
+    # Cupón/tasa facial: primer número después de la palabra clave
+    cupon_match = _CUPON_PATTERN.search(text)
+    if cupon_match:
+        result["cupon"] = _to_float(cupon_match.group(1))
+
+    result["fields"] = [field for field, pattern in FIELD_PATTERNS.items() if pattern.search(text)]
+
+    if explicit and fold_accents(explicit.group(1)) not in KNOWN_WORDS:
+        nemotecnicos = [explicit.group(1)]
+    if isins:
+        result["isins"] = isins
+        result["_search_type"] = "isin"
+    elif nemotecnicos:
+        result["nemotecnico"] = nemotecnicos[0]
+        result["_nemotecnico"] = nemotecnicos[0]
+        result["_search_type"] = "nemotecnico"
+
+    # Confianza base según el identificador encontrado
+    confidence = 0.0
+    if _EXPLANATION_PATTERN.search(text):
+        confidence = 0.0
+    elif isins or (explicit and nemotecnicos == [explicit.group(1)]):
+        confidence = 0.8
+    elif nemotecnicos:
+        confidence = 0.7
+    elif result["cupon"] is not None:
+        # Refinamiento de la búsqueda anterior ("el que tiene tasa facial del 14,2232%")
+        confidence = 0.7
+
+    # Ambigüedades que el LLM resuelve mejor
+    if len(nemotecnicos) > 1 or ambiguous or (isins and nemotecnicos):
+        confidence -= 0.3
+
+    # Cada parámetro reconocido refuerza la lectura; las palabras no reconocidas la debilitan
+    recognized = sum(bool(result[key]) for key in ("provider", "date", "fecha_vencimiento", "fields"))
+    recognized += result["cupon"] is not None
+    confidence += 0.05 * recognized
+
+    identifiers = {code.lower() for code in isins + codes}
+    unknown = [
+        word for word in _WORD_PATTERN.findall(text)
+        if len(word) > 2 and not word.isdigit() and word not in KNOWN_WORDS and word not in identifiers
+    ]
+    confidence -= 0.05 * max(0, len(unknown) - 2)
+
+    # Una fecha escrita que no existe no se puede descartar en silencio: que la interprete el LLM
+    if invalid_dates:
+        confidence = min(confidence, 0.3)
+
+    if result["comparison"]:
+        result["intent"] = "comparacion"
+    elif len(isins) > 1:
+        result["intent"] = "multiples_isins"
+    elif result["fields"] or re.search(r'\b(precio|valoracion)\b', text):
+        result["intent"] = "precio"
+
+    confidence = round(min(1.0, max(0.0, confidence)), 2)
+    result["_confidence"] = confidence
+    return result, confidence
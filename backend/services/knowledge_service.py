@@ -2,11 +2,22 @@
 Servicio de conocimiento para integrar documentación sobre renta fija
 """
 import os
+import re
+import json
+import math
+import heapq
+import hashlib
+import importlib.util
 import logging
-from typing import List, Optional, Dict
+import threading
+import numpy as np
+from collections import Counter
+from functools import lru_cache
+from typing import List, Optional, Dict, Tuple
 from pathlib import Path
 from openai import OpenAI
 from config import settings
+from services.text_utils import SPANISH_STOP_WORDS, fold_accents
 
 logger = logging.getLogger(__name__)
 
@@ -18,55 +29,316 @@ except ImportError:
     PDF_AVAILABLE = False
     logger.warning("PyPDF2 no está instalado. El servicio de conocimiento no funcionará.")
 
+# Modelo local de embeddings (opcional, solo para KNOWLEDGE_RETRIEVAL_MODE semantic/hybrid).
+# sentence-transformers (y torch) se importa al cargar el modelo, no al importar este módulo
+EMBEDDINGS_AVAILABLE = importlib.util.find_spec("sentence_transformers") is not None
+
+# Palabras en minúsculas, incluidas vocales con tilde/diéresis y ñ (se normalizan después)
+_TOKEN_PATTERN = re.compile(r"[0-9a-záéíóúüñàèìòùâêîôûäëïö]+")
+
+
+@lru_cache(maxsize=65536)
+def _search_term(token: str) -> Optional[str]:
+    """Término normalizado de una palabra, o None si es vacía o de un carácter (con caché: se repiten mucho)"""
+    term = fold_accents(token)
+    if len(term) < 2 or term in SPANISH_STOP_WORDS:
+        return None
+    return term
+
+
+def tokenize(text: str) -> List[str]:
+    """Términos de búsqueda: texto normalizado, sin palabras vacías ni tokens de un carácter"""
+    terms = (_search_term(token) for token in _TOKEN_PATTERN.findall(text.lower()))
+    return [term for term in terms if term]
+
 
 class KnowledgeService:
     """Servicio para gestionar conocimiento sobre renta fija desde documentos PDF"""
     
-    def __init__(self):
-        self.client = OpenAI(api_key=settings.openai_api_key)
+    # Versión del formato del índice en disco (cambiarla invalida los índices existentes)
+    INDEX_VERSION = 1
+    
+    # Parámetros de BM25
+    BM25_K1 = 1.5
+    BM25_B = 0.75
+    
+    # Puntaje mínimo (coseno o híbrido) para considerar relevante un chunk en búsqueda semántica
+    SEMANTIC_MIN_SCORE = 0.2
+    
+    def __init__(self, client: Optional[OpenAI] = None, index_dir: Optional[Path] = None, load: bool = True):
+        self.client = client or OpenAI(api_key=settings.openai_api_key)
         self.model = settings.llm_model
         self.knowledge_base_path = Path(__file__).parent.parent.parent / "Guia de Estudio - Renta Fija.pdf"
+        self.index_dir = Path(index_dir or settings.knowledge_index_dir)
         self.chunks = []
-        self._load_knowledge_base()
+        self.pdf_sha256 = None
+        self._postings = None  # Índice invertido BM25 (se construye al cargar los chunks)
+        self.retrieval_mode = settings.knowledge_retrieval_mode  # bm25 | semantic | hybrid
+        self._vectors = None  # Matriz float32 (chunks x dimensión) normalizada, con mmap
+        self._encoder = None
+        self._encoder_lock = threading.Lock()
+        if load:
+            self._load_knowledge_base()
+            self._build_search_index()
+            if self.retrieval_mode != "bm25" and self.chunks and not self._load_embeddings():
+                logger.warning(
+                    f"Modo de búsqueda '{self.retrieval_mode}' sin vectores precalculados para este PDF "
+                    f"(ejecuta scripts/build_knowledge_index.py --embeddings). Se usa BM25"
+                )
     
     def _load_knowledge_base(self):
-        """Carga y procesa el documento PDF de conocimiento"""
-        if not PDF_AVAILABLE:
-            logger.warning("PyPDF2 no está disponible. El servicio de conocimiento no funcionará.")
-            return
-            
+        """Carga los chunks desde el índice precalculado, o extrae el PDF si cambió o no hay índice"""
         try:
             if not self.knowledge_base_path.exists():
                 logger.warning(f"Documento de conocimiento no encontrado: {self.knowledge_base_path}")
                 return
             
-            logger.info(f"Cargando documento de conocimiento: {self.knowledge_base_path}")
+            pdf_hash = self.pdf_hash()
+            self.pdf_sha256 = pdf_hash
+            if self._load_index(pdf_hash):
+                logger.info(f"Índice de conocimiento cargado: {len(self.chunks)} chunks ({pdf_hash[:12]})")
+                return
             
-            # Extraer texto del PDF
-            with open(self.knowledge_base_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                text_content = []
-                
-                for page_num, page in enumerate(pdf_reader.pages):
-                    try:
-                        text = page.extract_text()
-                        if text.strip():
-                            text_content.append({
-                                'page': page_num + 1,
-                                'text': text.strip()
-                            })
-                    except Exception as e:
-                        logger.warning(f"Error extrayendo página {page_num + 1}: {str(e)}")
-                        continue
-                
-                # Dividir en chunks para búsqueda
-                self.chunks = self._split_into_chunks(text_content)
-                logger.info(f"Documento cargado: {len(self.chunks)} chunks procesados")
+            if not PDF_AVAILABLE:
+                logger.warning("PyPDF2 no está disponible y no hay índice precalculado. El servicio de conocimiento no funcionará.")
+                return
+            
+            self.chunks = self._extract_chunks()
+            logger.info(f"Documento cargado: {len(self.chunks)} chunks procesados")
+            try:
+                self._write_index(pdf_hash)
+            except Exception as e:
+                logger.warning(f"No se pudo guardar el índice de conocimiento: {str(e)}")
                 
         except Exception as e:
             logger.error(f"Error cargando documento de conocimiento: {str(e)}")
             self.chunks = []
     
+    def _extract_chunks(self) -> List[Dict]:
+        """Extrae el texto del PDF página por página y lo divide en chunks"""
+        logger.info(f"Cargando documento de conocimiento: {self.knowledge_base_path}")
+        
+        with open(self.knowledge_base_path, 'rb') as file:
+            pdf_reader = PyPDF2.PdfReader(file)
+            text_content = []
+            
+            for page_num, page in enumerate(pdf_reader.pages):
+                try:
+                    text = page.extract_text()
+                    if text.strip():
+                        text_content.append({
+                            'page': page_num + 1,
+                            'text': text.strip()
+                        })
+                except Exception as e:
+                    logger.warning(f"Error extrayendo página {page_num + 1}: {str(e)}")
+                    continue
+        
+        return self._split_into_chunks(text_content)
+    
+    def pdf_hash(self) -> str:
+        """SHA-256 del PDF de conocimiento (llave del índice en disco)"""
+        digest = hashlib.sha256()
+        with open(self.knowledge_base_path, 'rb') as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    def _index_paths(self, pdf_hash: str):
+        """Rutas del índice para un hash: metadatos (JSON) y textos concatenados (UTF-8)"""
+        stem = f"knowledge_{pdf_hash[:16]}"
+        return self.index_dir / f"{stem}.json", self.index_dir / f"{stem}.bin"
+    
+    def _write_index(self, pdf_hash: str) -> Path:
+        """
+        Guarda los chunks actuales como índice en disco
+        
+        Los textos van concatenados en un archivo binario y los metadatos guardan
+        (offset, longitud, página) de cada chunk, para cargarlos con una sola lectura sin parsear el PDF.
+        """
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        meta_path, blob_path = self._index_paths(pdf_hash)
+        
+        entries = []
+        offset = 0
+        tmp_blob = blob_path.with_suffix(".bin.tmp")
+        with open(tmp_blob, 'wb') as blob:
+            for chunk in self.chunks:
+                data = chunk['text'].encode('utf-8')
+                blob.write(data)
+                entries.append([offset, len(data), chunk['page']])
+                offset += len(data)
+        
+        meta = {
+            "version": self.INDEX_VERSION,
+            "pdf_sha256": pdf_hash,
+            "pdf_name": self.knowledge_base_path.name,
+            "source": self.chunks[0]['source'] if self.chunks else 'Guia de Estudio - Renta Fija',
+            "chunks": entries,
+        }
+        tmp_meta = meta_path.with_suffix(".json.tmp")
+        tmp_meta.write_text(json.dumps(meta, ensure_ascii=False), encoding='utf-8')
+        
+        # Reemplazo atómico: un proceso que arranca nunca ve un índice a medio escribir
+        os.replace(tmp_blob, blob_path)
+        os.replace(tmp_meta, meta_path)
+        
+        # Los índices (y vectores) de versiones anteriores del PDF ya no se usan
+        for stale in self.index_dir.glob("knowledge_*"):
+            if not stale.name.startswith(meta_path.stem + "."):
+                stale.unlink()
+        logger.info(f"Índice de conocimiento guardado: {meta_path} ({len(entries)} chunks, {offset} bytes)")
+        return meta_path
+    
+    def _load_index(self, pdf_hash: str) -> bool:
+        """
+        Carga los chunks desde el índice en disco si existe para este hash del PDF
+        
+        El archivo de textos se lee completo de una vez (BM25 necesita todos los chunks)
+        y cada chunk se decodifica desde su offset.
+        """
+        meta_path, blob_path = self._index_paths(pdf_hash)
+        if not meta_path.exists() or not blob_path.exists():
+            return False
+        
+        try:
+            meta = json.loads(meta_path.read_text(encoding='utf-8'))
+            if meta.get("version") != self.INDEX_VERSION or meta.get("pdf_sha256") != pdf_hash:
+                return False
+            
+            source = meta.get("source", 'Guia de Estudio - Renta Fija')
+            blob = memoryview(blob_path.read_bytes())
+            self.chunks = [
+                {
+                    'text': str(blob[offset:offset + length], 'utf-8'),
+                    'page': page,
+                    'source': source
+                }
+                for offset, length, page in meta["chunks"]
+            ]
+            self._postings = None
+            return True
+        except Exception as e:
+            logger.warning(f"Índice de conocimiento inválido, se reconstruye desde el PDF: {str(e)}")
+            return False
+    
+    def build_index(self, force: bool = False) -> Dict:
+        """
+        Construye (o verifica) el índice en disco para el PDF actual
+        
+        Args:
+            force: Re-extraer el PDF aunque exista un índice para el mismo hash
+        
+        Returns:
+            Diccionario con hash, ruta del índice, chunks y si se reconstruyó
+        """
+        pdf_hash = self.pdf_hash()
+        self.pdf_sha256 = pdf_hash
+        meta_path, _ = self._index_paths(pdf_hash)
+        if not force and self._load_index(pdf_hash):
+            return {"pdf_sha256": pdf_hash, "index": str(meta_path), "chunks": len(self.chunks), "rebuilt": False}
+        
+        if not PDF_AVAILABLE:
+            raise RuntimeError("PyPDF2 no está instalado. Instala con: pip install PyPDF2")
+        self.chunks = self._extract_chunks()
+        self._write_index(pdf_hash)
+        self._postings = None
+        return {"pdf_sha256": pdf_hash, "index": str(meta_path), "chunks": len(self.chunks), "rebuilt": True}
+    
+    def _embedding_paths(self, pdf_hash: str):
+        """Rutas de los vectores para un hash: metadatos (JSON) y matriz float32 (.npy)"""
+        meta_path, _ = self._index_paths(pdf_hash)
+        return meta_path.with_suffix(".emb.json"), meta_path.with_suffix(".emb.npy")
+    
+    def _get_encoder(self):
+        """Modelo local de embeddings (CPU, sin red), cargado una sola vez"""
+        if not EMBEDDINGS_AVAILABLE:
+            raise RuntimeError("sentence-transformers no está instalado. Instala con: pip install sentence-transformers")
+        if not settings.knowledge_embedding_model:
+            raise RuntimeError("KNOWLEDGE_EMBEDDING_MODEL no está configurado (ruta local del modelo)")
+        with self._encoder_lock:
+            if self._encoder is None:
+                from sentence_transformers import SentenceTransformer
+                self._encoder = SentenceTransformer(settings.knowledge_embedding_model, device="cpu")
+                logger.info(f"Modelo de embeddings cargado: {settings.knowledge_embedding_model}")
+            return self._encoder
+    
+    def warm_up_encoder(self) -> bool:
+        """
+        Carga el modelo de embeddings por adelantado si la búsqueda lo va a usar
+        (modo semantic/hybrid con vectores precalculados); en modo bm25 no hace nada
+        
+        Returns:
+            True si el modelo quedó cargado
+        """
+        if self.retrieval_mode not in ("semantic", "hybrid") or self._vectors is None:
+            return False
+        try:
+            self._get_encoder()
+            return True
+        except Exception as e:
+            logger.warning(f"No se pudo cargar el modelo de embeddings: {str(e)}")
+            return False
+    
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Vectores float32 normalizados (norma 1: el producto punto es el coseno)"""
+        vectors = self._get_encoder().encode(
+            texts, batch_size=32, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False
+        )
+        return np.asarray(vectors, dtype=np.float32)
+    
+    def build_embeddings(self, force: bool = False) -> Dict:
+        """
+        Precalcula los vectores de todos los chunks y los guarda junto al índice
+        
+        Args:
+            force: Recalcular aunque existan vectores del mismo PDF y modelo
+        
+        Returns:
+            Diccionario con ruta, cantidad de vectores, dimensión y si se recalcularon
+        """
+        if not self.chunks or not self.pdf_sha256:
+            raise RuntimeError("No hay chunks cargados para calcular vectores")
+        meta_path, matrix_path = self._embedding_paths(self.pdf_sha256)
+        if not force and self._load_embeddings():
+            return {"index": str(matrix_path), "vectors": len(self._vectors),
+                    "dim": int(self._vectors.shape[1]), "rebuilt": False}
+        
+        matrix = self.encode([chunk['text'] for chunk in self.chunks])
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        tmp_matrix = matrix_path.with_suffix(".tmp.npy")
+        np.save(tmp_matrix, matrix)
+        os.replace(tmp_matrix, matrix_path)
+        meta_path.write_text(json.dumps({
+            "pdf_sha256": self.pdf_sha256,
+            "model": settings.knowledge_embedding_model,
+            "chunks": len(self.chunks),
+            "dim": int(matrix.shape[1]),
+        }), encoding='utf-8')
+        self._load_embeddings()
+        logger.info(f"Vectores de conocimiento guardados: {matrix_path} {matrix.shape}")
+        return {"index": str(matrix_path), "vectors": int(matrix.shape[0]), "dim": int(matrix.shape[1]), "rebuilt": True}
+    
+    def _load_embeddings(self) -> bool:
+        """Abre con mmap los vectores precalculados si corresponden al PDF, al modelo y a los chunks actuales"""
+        if not self.pdf_sha256:
+            return False
+        meta_path, matrix_path = self._embedding_paths(self.pdf_sha256)
+        if not meta_path.exists() or not matrix_path.exists():
+            return False
+        try:
+            meta = json.loads(meta_path.read_text(encoding='utf-8'))
+            if (meta.get("pdf_sha256") != self.pdf_sha256 or meta.get("chunks") != len(self.chunks)
+                    or meta.get("model") != settings.knowledge_embedding_model):
+                return False
+            self._vectors = np.load(matrix_path, mmap_mode="r")
+            logger.info(f"Vectores de conocimiento cargados (mmap): {self._vectors.shape}")
+            return True
+        except Exception as e:
+            logger.warning(f"No se pudieron cargar los vectores de conocimiento: {str(e)}")
+            self._vectors = None
+            return False
+    
     def _split_into_chunks(self, pages: List[Dict], chunk_size: int = 1000, overlap: int = 200) -> List[Dict]:
         """Divide el texto en chunks para búsqueda semántica"""
         chunks = []
@@ -116,41 +388,91 @@ class KnowledgeService:
             return []
         
         try:
-            # Búsqueda por palabras clave mejorada (sin embeddings para evitar costos)
-            query_lower = query.lower()
-            scored_chunks = []
-            
-            for chunk in self.chunks:
-                chunk_text_lower = chunk['text'].lower()
-                
-                # Calcular score simple basado en palabras clave
-                score = 0
-                keywords = query_lower.split()
-                for keyword in keywords:
-                    if len(keyword) > 3:  # Ignorar palabras muy cortas
-                        score += chunk_text_lower.count(keyword)
-                
-                # Bonus si el chunk contiene términos relacionados con renta fija
-                renta_fija_terms = ['tir', 'tasa', 'precio', 'duración', 'convexidad', 'valoración', 
-                                   'cdt', 'tes', 'bonos', 'renta fija', 'yield', 'cupón']
-                for term in renta_fija_terms:
-                    if term in query_lower and term in chunk_text_lower:
-                        score += 2
-                
-                if score > 0:
-                    scored_chunks.append({
-                        'chunk': chunk,
-                        'score': score
-                    })
-            
-            # Ordenar por score y retornar los mejores
-            scored_chunks.sort(key=lambda x: x['score'], reverse=True)
-            return [item['chunk'] for item in scored_chunks[:max_chunks]]
-            
+            if self.retrieval_mode in ("semantic", "hybrid") and self._vectors is not None:
+                return [self.chunks[index] for index, _ in self._vector_top_k(query, max_chunks)]
+            return [self.chunks[index] for index, _ in self._bm25_top_k(query, max_chunks)]
         except Exception as e:
             logger.error(f"Error buscando contexto relevante: {str(e)}")
             return []
     
+    def _build_search_index(self):
+        """
+        Construye el índice invertido BM25 sobre los chunks cargados
+        
+        término -> [(chunk, frecuencia)], más la longitud de cada chunk y el IDF de
+        cada término. Se hace una sola vez al cargar los chunks.
+        """
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        doc_lengths = []
+        for index, chunk in enumerate(self.chunks):
+            # Se cuenta primero cada palabra y se normalizan solo las distintas
+            frequencies: Dict[str, int] = {}
+            for token, count in Counter(_TOKEN_PATTERN.findall(chunk['text'].lower())).items():
+                term = _search_term(token)
+                if term:
+                    frequencies[term] = frequencies.get(term, 0) + count
+            doc_lengths.append(sum(frequencies.values()))
+            for term, frequency in frequencies.items():
+                postings.setdefault(term, []).append((index, frequency))
+        
+        total = len(self.chunks)
+        self._postings = postings
+        self._doc_lengths = doc_lengths
+        self._avg_doc_length = (sum(doc_lengths) / total) if total else 0.0
+        # IDF de BM25 (variante con +1 para que nunca sea negativo)
+        self._idf = {
+            term: math.log(1 + (total - len(entries) + 0.5) / (len(entries) + 0.5))
+            for term, entries in postings.items()
+        }
+    
+    def _bm25_scores(self, query: str) -> Dict[int, float]:
+        """Puntaje BM25 de cada chunk que contiene al menos un término de la consulta"""
+        if self._postings is None:
+            self._build_search_index()
+        
+        scores: Dict[int, float] = {}
+        avg_length = self._avg_doc_length or 1.0
+        for term in set(tokenize(query)):
+            entries = self._postings.get(term)
+            if not entries:
+                continue
+            idf = self._idf[term]
+            for index, frequency in entries:
+                norm = self.BM25_K1 * (1 - self.BM25_B + self.BM25_B * self._doc_lengths[index] / avg_length)
+                scores[index] = scores.get(index, 0.0) + idf * frequency * (self.BM25_K1 + 1) / (frequency + norm)
+        return scores
+    
+    def _bm25_top_k(self, query: str, k: int) -> List[Tuple[int, float]]:
+        """Los k chunks con mayor puntaje BM25 (heap, sin ordenar todos los candidatos)"""
+        scores = self._bm25_scores(query)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+    
+    def _vector_top_k(self, query: str, k: int) -> List[Tuple[int, float]]:
+        """
+        Top-k por similitud coseno (semantic) o por mezcla BM25 + coseno (hybrid)
+        
+        Un solo producto matriz-vector sobre todos los chunks y argpartition para
+        seleccionar los k mejores sin ordenar el arreglo completo.
+        """
+        query_vector = self.encode([query])[0]
+        scores = np.asarray(self._vectors @ query_vector, dtype=np.float32)
+        
+        if self.retrieval_mode == "hybrid":
+            bm25 = np.zeros(len(self.chunks), dtype=np.float32)
+            for index, score in self._bm25_scores(query).items():
+                bm25[index] = score
+            if bm25.max() > 0:
+                bm25 /= bm25.max()
+            alpha = settings.knowledge_hybrid_alpha
+            scores = alpha * np.clip(scores, 0.0, 1.0) + (1 - alpha) * bm25
+        
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(int(index), float(scores[index])) for index in candidates if scores[index] >= self.SEMANTIC_MIN_SCORE]
+    
     def get_context_for_query(self, query: str) -> str:
         """
         Obtiene contexto relevante del documento para una consulta
@@ -3,38 +3,72 @@ Servicio de consultas estructuradas a la base de datos
 """
 from sqlalchemy.orm import Session
 from sqlalchemy import and_, or_, func
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Iterator
 from datetime import date, datetime
 from models import Valuation, Provider
 from schemas import ValuationQuery
 from services.supabase_service import SupabaseService
 from services.ingestion_service import IngestionService
 from config import settings
+from concurrent.futures import ThreadPoolExecutor, wait
+from collections import OrderedDict
 import logging
+import json
+import threading
+import time
 import pandas as pd
 
 logger = logging.getLogger(__name__)
 
+# Pool acotado para consultar los proveedores de Supabase en paralelo (compartido por todas las peticiones)
+_provider_executor = ThreadPoolExecutor(
+    max_workers=settings.supabase_fanout_workers,
+    thread_name_prefix="supabase-provider"
+)
+
+# Caché de series de tiempo por (isin, fecha_inicio, fecha_fin, frecuencia, agregación)
+# Valor: dict con series y loaded_at; OrderedDict para descartar la menos usada
+_series_cache: "OrderedDict[tuple, Dict]" = OrderedDict()
+_series_lock = threading.Lock()
+
+
+def invalidate_series_cache(isin: Optional[str] = None):
+    """
+    Invalida la caché de series de tiempo (llamar después de cargar valoraciones)
+
+    Args:
+        isin: ISIN a invalidar (si es None, invalida todas)
+    """
+    with _series_lock:
+        if isin is None:
+            _series_cache.clear()
+        else:
+            for key in [k for k in _series_cache if k[0] == isin.strip().upper()]:
+                del _series_cache[key]
+
+# Conteos exactos por filtros, usados como estimación mientras no expire la TTL
+# Clave: filtros de ValuationQuery serializados, Valor: dict con total y loaded_at
+_count_cache: "OrderedDict[str, Dict]" = OrderedDict()
+_count_lock = threading.Lock()
+_COUNT_CACHE_MAX_ENTRIES = 1024
+
 
 class QueryService:
     """Servicio para realizar consultas estructuradas a las valoraciones"""
     
+    # ISINs por consulta en las variantes por lote (límite de parámetros de SQLite/psycopg2)
+    BATCH_IN_SIZE = 1000
+    
+    # Frecuencias de remuestreo de get_series (alias de pandas) y agregaciones por periodo
+    SERIES_FREQUENCIES = {"semanal": "W-FRI", "mensual": "ME"}
+    SERIES_AGGREGATIONS = {"ultimo": "last", "promedio": "mean"}
+    SERIES_METRICS = ["precio_limpio", "tasa", "duracion"]
+    
     def __init__(self, db: Session):
         self.db = db
     
-    def query_valuations(self, query: ValuationQuery, supabase_access_token: Optional[str] = None) -> List[Valuation]:
-        """
-        Consulta valoraciones según filtros
-        
-        Args:
-            query: Objeto ValuationQuery con filtros
-            supabase_access_token: Token de acceso a Supabase (opcional, para consulta directa)
-        
-        Returns:
-            Lista de valoraciones que cumplen los criterios
-        """
-        query_builder = self.db.query(Valuation)
-        
+    def _apply_filters(self, query_builder, query: ValuationQuery):
+        """Aplica los filtros de ValuationQuery (compartido por las consultas ORM y por columnas)"""
         # Filtro por ISIN (case-insensitive)
         if query.isin:
             isin_normalized = query.isin.strip().upper() if query.isin else None
@@ -94,7 +128,34 @@ class QueryService:
                 Valuation.cupon <= query.cupon + 0.01
             )
         
-        results = query_builder.order_by(Valuation.fecha.desc(), Valuation.isin).all()
+        return query_builder
+    
+    def query_valuations(self, query: ValuationQuery, supabase_access_token: Optional[str] = None,
+                         after_id: Optional[int] = None, limit: Optional[int] = None) -> List[Valuation]:
+        """
+        Consulta valoraciones según filtros
+        
+        Args:
+            query: Objeto ValuationQuery con filtros
+            supabase_access_token: Token de acceso a Supabase (opcional, para consulta directa)
+            after_id: Paginación por llave: devolver valoraciones con id mayor a este
+            limit: Tamaño de página (se acota a VALUATIONS_MAX_PAGE_SIZE). Al paginar
+                   el orden es por id en lugar de fecha desc, isin
+        
+        Returns:
+            Lista de valoraciones que cumplen los criterios
+        """
+        query_builder = self._apply_filters(self.db.query(Valuation), query)
+        
+        paginated = after_id is not None or limit is not None
+        if paginated:
+            limit = min(limit or settings.valuations_page_size, settings.valuations_max_page_size)
+            if after_id is not None:
+                query_builder = query_builder.filter(Valuation.id > after_id)
+            page_query = query_builder.order_by(Valuation.id).limit(limit)
+            results = page_query.all()
+        else:
+            results = query_builder.order_by(Valuation.fecha.desc(), Valuation.isin).all()
         
         # Para nemotécnicos, siempre consultar Supabase directamente porque la BD local puede no tener todos los datos
         # Para ISINs, solo consultar Supabase si no hay resultados en BD local
@@ -110,6 +171,10 @@ class QueryService:
             # Para ISINs, solo si no hay resultados en BD local
             should_query_supabase = True
         
+        # Las páginas siguientes salen de la BD local (la primera ya guardó lo traído de Supabase)
+        if after_id is not None:
+            should_query_supabase = False
+        
         # Consultar Supabase directamente si es necesario
         if should_query_supabase:
             # Intentar con access token primero, luego con API key como fallback
@@ -160,6 +225,12 @@ class QueryService:
                     logger.error(traceback.format_exc())
             else:
                 logger.warning(f"No hay credenciales de Supabase disponibles para consultar {search_desc}")
+            
+            # Al paginar, la página sale siempre de la BD local en orden de id: lo traído de Supabase
+            # ya se guardó, y sus objetos vienen en otro orden (y sin id si ya existían localmente),
+            # lo que rompería X-Next-After-Id y no coincidiría con X-Total-Count
+            if paginated:
+                results = page_query.all()
         
         # Aplicar filtro de cupón final si es necesario (por si hay resultados de BD local que no se filtraron)
         if query.cupon is not None and results:
@@ -175,9 +246,129 @@ class QueryService:
             if resultados_antes != resultados_despues:
                 logger.info(f"Filtro final de cupón {query.cupon}: {resultados_antes} → {resultados_despues} resultados")
         
+        if paginated:
+            results = results[:limit]
+        
         logger.info(f"Total de resultados encontrados después de todos los filtros: {len(results)}")
         return results
     
+    def count_valuations(self, query: ValuationQuery, exact: bool = False) -> Dict:
+        """
+        Total de valoraciones que cumplen los filtros
+        
+        Sin exact, usa la estimación de filas del planificador (EXPLAIN en PostgreSQL)
+        o, si no está disponible, un conteo exacto guardado en caché por filtros.
+        
+        Returns:
+            Diccionario con total y exact (si el total es exacto)
+        """
+        count_query = self._apply_filters(self.db.query(func.count(Valuation.id)), query)
+        if exact:
+            return {"total": count_query.scalar() or 0, "exact": True}
+        
+        if self.db.get_bind().dialect.name == "postgresql":
+            try:
+                statement = self._apply_filters(self.db.query(Valuation.id), query).statement
+                sql = str(statement.compile(dialect=self.db.get_bind().dialect, compile_kwargs={"literal_binds": True}))
+                # Sin parámetros el driver no interpreta %, así que se deshace el escape de los literales
+                plan = self.db.connection().execution_options(no_parameters=True).exec_driver_sql(
+                    f"EXPLAIN (FORMAT JSON) {sql.replace('%%', '%')}"
+                ).scalar()
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                return {"total": int(plan[0]["Plan"]["Plan Rows"]), "exact": False}
+            except Exception as e:
+                logger.debug(f"No se pudo estimar el conteo con EXPLAIN: {str(e)}")
+        
+        key = json.dumps(query.model_dump(mode="json"), sort_keys=True)
+        with _count_lock:
+            cached = _count_cache.get(key)
+            if cached and time.monotonic() - cached["loaded_at"] < settings.valuations_count_cache_ttl:
+                return {"total": cached["total"], "exact": False}
+        
+        total = count_query.scalar() or 0
+        with _count_lock:
+            _count_cache[key] = {"total": total, "loaded_at": time.monotonic()}
+            while len(_count_cache) > _COUNT_CACHE_MAX_ENTRIES:
+                _count_cache.popitem(last=False)
+        return {"total": total, "exact": False}
+    
+    def query_valuations_frame(self, query: ValuationQuery, supabase_access_token: Optional[str] = None,
+                               after_id: Optional[int] = None, limit: Optional[int] = None) -> pd.DataFrame:
+        """
+        Consulta valoraciones según filtros y devuelve un DataFrame (una columna por campo)
+        
+        Lee las columnas de la tabla directamente, sin construir objetos ORM ni validar
+        fila por fila. Si la búsqueda requiere consultar Supabase (nemotécnico, o ISIN
+        sin resultados locales) usa query_valuations y convierte su resultado.
+        
+        Con after_id o limit pagina por id igual que query_valuations (acotado a
+        VALUATIONS_MAX_PAGE_SIZE).
+        """
+        columns = list(Valuation.__table__.columns)
+        column_names = [column.name for column in columns]
+        
+        paginated = after_id is not None or limit is not None
+        if paginated:
+            limit = min(limit or settings.valuations_page_size, settings.valuations_max_page_size)
+        
+        is_nemotecnico_search = (query.emisor and query.tipo_instrumento and
+                                 query.emisor == query.tipo_instrumento and not query.isin)
+        rows = []
+        if not is_nemotecnico_search:
+            query_builder = self._apply_filters(self.db.query(*columns), query)
+            if paginated:
+                if after_id is not None:
+                    query_builder = query_builder.filter(Valuation.id > after_id)
+                rows = query_builder.order_by(Valuation.id).limit(limit).all()
+            else:
+                rows = query_builder.order_by(Valuation.fecha.desc(), Valuation.isin).all()
+        
+        if is_nemotecnico_search or (not rows and query.isin and after_id is None):
+            valuations = self.query_valuations(query, supabase_access_token, after_id=after_id,
+                                               limit=limit if paginated else None)
+            rows = [tuple(getattr(v, name) for name in column_names) for v in valuations]
+        
+        df = pd.DataFrame(rows, columns=column_names)
+        df["proveedor"] = df["proveedor"].map(lambda p: p.value if isinstance(p, Provider) else p)
+        return df
+    
+    def iter_valuation_rows(self, query: ValuationQuery, after_id: Optional[int] = None,
+                            limit: Optional[int] = None, batch_size: Optional[int] = None) -> Iterator[Dict]:
+        """
+        Recorre las valoraciones que cumplen los filtros con memoria constante
+        
+        Ordena por id para que la exportación se pueda reanudar con after_id (el último
+        id recibido). Lee por lotes con yield_per; en PostgreSQL stream_results usa un
+        cursor del lado del servidor, así que las filas no se cargan todas en memoria.
+        Solo consulta la BD local (no va a Supabase).
+        
+        Args:
+            query: Filtros de ValuationQuery
+            after_id: Continuar después de este id (exclusivo)
+            limit: Máximo de filas a devolver
+            batch_size: Filas por lote leídas del cursor
+        
+        Yields:
+            Diccionario por valoración con las columnas de la tabla
+        """
+        batch_size = batch_size or settings.export_batch_size
+        columns = list(Valuation.__table__.columns)
+        column_names = [column.name for column in columns]
+        
+        query_builder = self._apply_filters(self.db.query(*columns), query)
+        if after_id is not None:
+            query_builder = query_builder.filter(Valuation.id > after_id)
+        query_builder = query_builder.order_by(Valuation.id)
+        if limit is not None:
+            query_builder = query_builder.limit(limit)
+        
+        for row in query_builder.execution_options(stream_results=True, yield_per=batch_size):
+            record = dict(zip(column_names, row))
+            if isinstance(record["proveedor"], Provider):
+                record["proveedor"] = record["proveedor"].value
+            yield record
+    
     def _query_supabase_directly(self, query: ValuationQuery, auth_value: str, use_api_key: bool = False) -> List[Valuation]:
         """
         Consulta Supabase directamente cuando no hay resultados en BD local
@@ -198,528 +389,50 @@ class QueryService:
                 supabase = SupabaseService(access_token=auth_value)
                 ingestion_service = IngestionService(self.db, supabase_access_token=auth_value)
             
-            # Buscar en ambas tablas
+            # Buscar en ambas tablas en paralelo (una tarea por proveedor en un pool acotado)
             # IMPORTANTE: Buscar en ambos proveedores independientemente
             # Si un ISIN solo existe en un proveedor, debe incluirse en los resultados
+            # Un proveedor lento o con error no impide devolver los resultados del otro
+            providers = [
+                provider for provider in [Provider.PIP_LATAM, Provider.PRECIA]
+                if not query.proveedor or query.proveedor == provider
+            ]
+            results_by_provider = self._fan_out_providers(query, providers, supabase, ingestion_service)
+            
+            # Combinar en orden determinístico (PIP_LATAM, luego PRECIA) sin importar cuál terminó primero
             all_valuations = []
-            for provider in [Provider.PIP_LATAM, Provider.PRECIA]:
-                if query.proveedor and query.proveedor != provider:
-                    continue
-                
-                logger.info(f"🔍 Buscando en proveedor {provider.value}...")
+            for provider in providers:
+                valuations = results_by_provider.get(provider, [])
+                all_valuations.extend(valuations)
+                logger.info(f"✅ Agregadas {len(valuations)} valoraciones de {provider.value} al conjunto total (total acumulado: {len(all_valuations)} valoraciones)")
+            
+            # Guardar en BD local para futuras consultas (en el hilo de la petición: la sesión no es thread-safe)
+            # Se omiten las llaves (isin, fecha, proveedor) que ya están en la BD o repetidas en el lote
+            # (process_dataframe asigna la misma fecha a todas las filas de un ISIN): con el índice
+            # único, una sola llave repetida haría fallar el commit completo
+            try:
+                isins_lote = list({v.isin for v in all_valuations if v.isin})
+                existing_keys = set()
+                for start in range(0, len(isins_lote), self.BATCH_IN_SIZE):
+                    existing_keys.update(self.db.query(
+                        Valuation.isin, Valuation.fecha, Valuation.proveedor
+                    ).filter(Valuation.isin.in_(isins_lote[start:start + self.BATCH_IN_SIZE])).all())
                 
-                try:
-                    table_name = supabase.get_table_name(provider.value)
-                    available_columns = supabase._get_available_columns(table_name)
-                    
-                    # Determinar qué columna usar para la búsqueda
-                    search_params = {}
-                    
-                    if query.isin:
-                        # Búsqueda por ISIN (case-insensitive)
-                        isin_normalized = query.isin.strip().upper() if query.isin else None
-                        if not isin_normalized:
-                            continue
-                        
-                        isin_col = None
-                        for col in ["ISIN", "isin", "ISIN_CODIGO", "codigo_isin"]:
-                            if col in available_columns:
-                                isin_col = col
-                                break
-                        
-                        if isin_col:
-                            # Estrategia: Usar eq. con ISIN normalizado (funciona perfectamente según diagnóstico)
-                            # El ISIN está en Supabase, solo necesitamos normalizarlo correctamente
-                            search_params[f"{isin_col}"] = f"eq.{isin_normalized}"
-                            logger.info(f"🔍 Buscando ISIN '{isin_normalized}' en columna '{isin_col}' usando eq. (búsqueda exacta)")
-                        else:
-                            continue
-                    elif query.emisor and query.tipo_instrumento and query.emisor == query.tipo_instrumento:
-                        # Búsqueda por nemotécnico
-                        nemotecnico = query.emisor
-                        logger.info(f"Buscando nemotécnico '{nemotecnico}' en Supabase. Columnas disponibles: {available_columns}")
-                        
-                        # IMPORTANTE: Para nemotécnicos, buscar en la columna NEMOTECNICO si existe
-                        # Si no existe, buscar en EMISION/emisor, pero ser más estricto
-                        nemotecnico_col = None
-                        for col in ["NEMOTECNICO", "nemotecnico", "Nemotecnico", "NEMOTÉCNICO", "nemotécnico"]:
-                            if col in available_columns:
-                                nemotecnico_col = col
-                                break
-                        
-                        # Si no hay columna nemotécnico, buscar en EMISION/emisor
-                        if not nemotecnico_col:
-                            for col in ["EMISION", "emisor", "EMISOR", "EMISOR_NOMBRE"]:
-                                if col in available_columns:
-                                    nemotecnico_col = col
-                                    break
-                        
-                        # Si aún no encontramos, buscar en tipo_instrumento
-                        if not nemotecnico_col:
-                            for col in ["TIPO_ACTIVO", "tipo_instrumento", "TIPO_INSTRUMENTO", "TIPO"]:
-                                if col in available_columns:
-                                    nemotecnico_col = col
-                                    break
-                        
-                        if nemotecnico_col:
-                            # IMPORTANTE: Para nemotécnicos, usar búsqueda exacta case-insensitive
-                            # PostgREST: ilike sin comodines busca exacta case-insensitive
-                            search_params[f"{nemotecnico_col}"] = f"ilike.{nemotecnico}"
-                            logger.info(f"Buscando nemotécnico '{nemotecnico}' en columna '{nemotecnico_col}' con ilike.{nemotecnico} (coincidencia exacta case-insensitive)")
-                        else:
-                            logger.warning(f"No se encontró columna para buscar nemotécnico. Columnas disponibles: {available_columns}")
-                            continue
-                    else:
-                        continue
-                    
-                    if not search_params:
+                nuevas = 0
+                for v in all_valuations:
+                    key = (v.isin, v.fecha, v.proveedor)
+                    if key in existing_keys:
                         continue
-                    
-                    # Consultar Supabase (pasar solo el nombre de la tabla, no la URL completa)
-                    # IMPORTANTE: Para nemotécnicos, necesitamos obtener TODOS los registros
-                    # PostgREST tiene un límite máximo por defecto, pero podemos usar rangos para obtener más
-                    # Para asegurarnos de obtener TODOS los registros, implementamos paginación
-                    # Primero, obtener el primer lote con un límite alto
-                    params = {
-                        "select": "*",
-                        "limit": "5000"  # Límite alto inicial
-                    }
-                    params.update(search_params)
-                    
-                    if query.isin:
-                        logger.info(f"Buscando ISIN '{isin_normalized}' en {table_name} usando filtro eq. en Supabase")
-                    else:
-                        logger.info(f"Buscando nemotécnico '{nemotecnico}' en {table_name} - obteniendo hasta 5000 registros iniciales")
-                    
-                    # Agregar filtro de fecha de valoración si existe
-                    fecha_col = None
-                    for col in ["FECHA_VALORACION", "fecha_valoracion", "fecha", "date"]:
-                        if col in available_columns:
-                            fecha_col = col
-                            break
-                    
-                    if query.fecha and fecha_col:
-                        params[f"{fecha_col}"] = f"eq.{query.fecha.isoformat()}"
-                    
-                    # Agregar filtro de fecha de vencimiento si existe
-                    # ESTRATEGIA HÍBRIDA: Aplicar filtro en Supabase con tolerancia, luego validar en Python
-                    fecha_vencimiento_para_filtrar = None
-                    if query.fecha_vencimiento:
-                        # Buscar columna de fecha de vencimiento
-                        vencimiento_col = None
-                        for col in ["VENCIMIENTO", "vencimiento", "FECHA_VENCIMIENTO", "fecha_vencimiento", "VENCIMIENTO_FECHA"]:
-                            if col in available_columns:
-                                vencimiento_col = col
-                                break
-                        
-                        if vencimiento_col:
-                            # Aplicar filtro en Supabase con tolerancia de ±1 día para manejar variaciones de formato
-                            fecha_iso = query.fecha_vencimiento.isoformat()
-                            # Usar rango en Supabase: desde 1 día antes hasta 1 día después
-                            from datetime import timedelta
-                            fecha_min = (query.fecha_vencimiento - timedelta(days=1)).isoformat()
-                            fecha_max = (query.fecha_vencimiento + timedelta(days=1)).isoformat()
-                            # PostgREST: usar gte y lte para rango (parámetros separados)
-                            # httpx maneja automáticamente múltiples valores para la misma clave
-                            params[f"{vencimiento_col}"] = [f"gte.{fecha_min}", f"lte.{fecha_max}"]
-                            logger.info(f"Filtro de fecha de vencimiento en Supabase: {fecha_min} a {fecha_max} (tolerancia ±1 día)")
-                        else:
-                            logger.warning(f"No se encontró columna de fecha de vencimiento. Columnas disponibles: {available_columns}")
-                        
-                        # Guardar para validación final en Python (coincidencia exacta)
-                        fecha_vencimiento_para_filtrar = query.fecha_vencimiento
-                        logger.info(f"Fecha de vencimiento también se validará en Python con coincidencia exacta: {query.fecha_vencimiento.isoformat()}")
-                    
-                    # Agregar filtro de cupón/tasa facial si existe
-                    # ESTRATEGIA HÍBRIDA: Aplicar filtro en Supabase con rango, luego validar en Python
-                    if query.cupon is not None:
-                        cupon_col = None
-                        for col in ["TASA_FACIAL", "tasa_facial", "cupon", "CUPON", "TASA", "tasa"]:
-                            if col in available_columns:
-                                cupon_col = col
-                                break
-                        
-                        if cupon_col:
-                            # Aplicar filtro en Supabase con rango ampliado (tolerancia 0.02 para capturar variaciones)
-                            cupon_min = query.cupon - 0.02  # Rango ampliado para Supabase
-                            cupon_max = query.cupon + 0.02
-                            # PostgREST: usar gte y lte para rango numérico (parámetros separados)
-                            # httpx maneja automáticamente múltiples valores para la misma clave
-                            params[f"{cupon_col}"] = [f"gte.{cupon_min}", f"lte.{cupon_max}"]
-                            logger.info(f"Filtro de cupón/tasa facial en Supabase: {cupon_min} a {cupon_max} (rango ampliado ±0.02)")
-                            logger.info(f"Cupón también se validará en Python con rango exacto: {query.cupon - 0.01} a {query.cupon + 0.01}")
-                        else:
-                            logger.warning(f"No se encontró columna de cupón/tasa facial. Columnas disponibles: {available_columns}")
-                    
-                    # Pasar solo el nombre de la tabla, _make_request construye la URL
-                    # OPTIMIZACIÓN: Ajustar paginación según cantidad de filtros aplicados
-                    logger.info(f"Consultando {table_name} con parámetros iniciales: {params}")
-                    all_records = []
-                    offset = 0
-                    
-                    # Calcular cantidad de filtros aplicados (además del nemotécnico/ISIN)
-                    filtros_aplicados = 0
-                    if query.fecha:
-                        filtros_aplicados += 1
-                    if query.fecha_vencimiento:
-                        filtros_aplicados += 1
-                    if query.cupon is not None:
-                        filtros_aplicados += 1
-                    
-                    # OPTIMIZACIÓN: Si hay múltiples filtros, reducir paginación (esperamos menos resultados)
-                    if filtros_aplicados >= 2:
-                        # Con 2+ filtros, esperamos resultados muy específicos
-                        limit_per_page = 2000  # Límite más alto por página
-                        max_iterations = 5  # Máximo 10,000 registros (5 × 2000)
-                        logger.info(f"🔍 Múltiples filtros detectados ({filtros_aplicados}). Paginación optimizada: {limit_per_page} por página, máximo {max_iterations} iteraciones")
-                    elif filtros_aplicados == 1:
-                        # Con 1 filtro adicional, reducir moderadamente
-                        limit_per_page = 2000
-                        max_iterations = 10  # Máximo 20,000 registros
-                        logger.info(f"🔍 Un filtro adicional detectado. Paginación moderada: {limit_per_page} por página, máximo {max_iterations} iteraciones")
-                    else:
-                        # Sin filtros adicionales, usar paginación estándar
-                        limit_per_page = 1000  # Usar un límite más conservador para evitar problemas con Supabase
-                        max_iterations = 50  # Prevenir loops infinitos
-                        logger.info(f"📊 Sin filtros adicionales. Paginación estándar: {limit_per_page} por página, máximo {max_iterations} iteraciones")
-                    
-                    iteration = 0
-                    
-                    try:
-                        while iteration < max_iterations:
-                            # Crear copia de params para cada iteración
-                            page_params = params.copy()
-                            # Siempre incluir el límite
-                            page_params["limit"] = str(limit_per_page)
-                            if offset > 0:
-                                page_params["offset"] = str(offset)
-                            
-                            logger.info(f"Obteniendo página {iteration + 1}: offset={offset}, limit={limit_per_page}")
-                            response = supabase._make_request("GET", table_name, params=page_params)
-                            
-                            if not response:
-                                logger.info(f"No hay más registros (respuesta vacía) en página {iteration + 1}")
-                                break
-                            
-                            if isinstance(response, list):
-                                if len(response) == 0:
-                                    logger.info(f"No hay más registros (lista vacía) en página {iteration + 1}")
-                                    break
-                                
-                                all_records.extend(response)
-                                logger.info(f"✅ Obtenidos {len(response)} registros en página {iteration + 1} (total acumulado: {len(all_records)})")
-                                
-                                # OPTIMIZACIÓN: Si hay múltiples filtros y ya tenemos suficientes registros, detener paginación temprano
-                                # Con filtros aplicados, si tenemos más de 5,000 registros, probablemente ya tenemos todos los relevantes
-                                if filtros_aplicados >= 2 and len(all_records) >= 5000:
-                                    logger.info(f"🎯 Deteniendo paginación temprano: {len(all_records)} registros obtenidos con {filtros_aplicados} filtros (suficiente para filtrado en Python)")
-                                    break
-                                
-                                # Si obtuvimos menos registros que el límite, significa que ya obtuvimos todos
-                                if len(response) < limit_per_page:
-                                    logger.info(f"🎯 Se obtuvieron TODOS los registros disponibles ({len(all_records)} totales)")
-                                    break
-                                
-                                offset += limit_per_page
-                                iteration += 1
-                            else:
-                                # Si no es una lista, agregar directamente y terminar
-                                logger.warning(f"Respuesta inesperada de tipo {type(response)}, agregando directamente")
-                                all_records.append(response)
-                                break
-                    except Exception as e:
-                        logger.error(f"Error durante paginación en {table_name}: {str(e)}")
-                        logger.info(f"Usando registros obtenidos hasta el momento: {len(all_records)} registros")
-                    
-                    logger.info(f"📊 RESUMEN: Total de registros obtenidos de {table_name}: {len(all_records)}")
-                    
-                    if all_records:
-                        # Convertir respuesta de Supabase a DataFrame y procesar
-                        df = pd.DataFrame(all_records)
-                        logger.info(f"DataFrame creado con {len(df)} filas y {len(df.columns)} columnas")
-                    else:
-                        if query.isin:
-                            logger.warning(f"⚠️ No se obtuvieron registros de {table_name} para ISIN '{query.isin}'")
-                        else:
-                            logger.warning(f"⚠️ No se obtuvieron registros de {table_name} para nemotécnico '{nemotecnico}'")
-                        df = pd.DataFrame()
-                    
-                    # Continuar procesando solo si hay datos en el DataFrame
-                    if not df.empty:
-                        # Log de ISINs en el DataFrame crudo ANTES de normalizar (para debugging)
-                        if query.emisor and query.tipo_instrumento and query.emisor == query.tipo_instrumento:
-                            isin_cols_candidatas = []
-                            for col in df.columns:
-                                col_upper = str(col).upper()
-                                if "ISIN" in col_upper or "CODIGO" in col_upper or "CÓDIGO" in col_upper:
-                                    isin_cols_candidatas.append(col)
-                            
-                            if isin_cols_candidatas:
-                                # Intentar con la primera columna candidata
-                                isin_col = isin_cols_candidatas[0]
-                                isins_en_df_crudo = df[isin_col].dropna().unique()
-                                logger.info(f"🔍 ISINs en DataFrame CRUDO de {table_name} (antes de normalizar): {len(isins_en_df_crudo)} → {sorted([str(x) for x in isins_en_df_crudo[:20]])}")
-                                
-                                # Verificar si el ISIN faltante está en el DataFrame crudo
-                                isin_faltante = "COB13CD1K4D3"
-                                isins_str = [str(x) for x in isins_en_df_crudo]
-                                if isin_faltante in isins_str:
-                                    logger.info(f"✅ ISIN faltante {isin_faltante} encontrado en DataFrame CRUDO de {table_name}")
-                                else:
-                                    logger.warning(f"⚠️ ISIN faltante {isin_faltante} NO encontrado en DataFrame CRUDO de {table_name} (puede estar más allá del límite o no estar en este proveedor)")
-                        
-                        # Determinar descripción de búsqueda para el log
-                        if query.isin:
-                            search_desc = f"ISIN {query.isin}"
-                        elif query.emisor and query.tipo_instrumento and query.emisor == query.tipo_instrumento:
-                            search_desc = f"nemotécnico {query.emisor}"
-                        else:
-                            search_desc = "criterios especificados"
-                        logger.info(f"Se encontraron {len(df)} registros en {table_name} para {search_desc} (antes de normalizar y filtrar)")
-                        
-                        # Normalizar y procesar
-                        df_normalized = ingestion_service.normalize_column_names(df, provider)
-                        
-                        # Filtrar por cupón/tasa facial si se especificó (con tolerancia por redondeo)
-                        if query.cupon is not None:
-                            # Buscar columna de cupón (puede estar normalizada o no)
-                            cupon_col = None
-                            for col_name in ["cupon", "CUPON", "TASA_FACIAL", "tasa_facial", "Tasa Facial", "Cupón"]:
-                                if col_name in df_normalized.columns:
-                                    cupon_col = col_name
-                                    break
-                            
-                            if cupon_col:
-                                # VALIDACIÓN FINAL: Rango exacto en Python (más estricto que Supabase)
-                                cupon_min = query.cupon - 0.01  # Rango exacto para validación final
-                                cupon_max = query.cupon + 0.01
-                                # Convertir a numérico si es necesario
-                                df_normalized[cupon_col] = pd.to_numeric(df_normalized[cupon_col], errors='coerce')
-                                mask = (df_normalized[cupon_col] >= cupon_min) & (df_normalized[cupon_col] <= cupon_max)
-                                registros_antes = len(df_normalized)
-                                df_normalized = df_normalized[mask]
-                                registros_despues = len(df_normalized)
-                                logger.info(f"✅ Validación final en Python: cupón {query.cupon} (rango exacto: {cupon_min} - {cupon_max}): {registros_antes} → {registros_despues} registros")
-                            else:
-                                logger.warning(f"No se encontró columna de cupón para filtrar. Columnas disponibles: {list(df_normalized.columns)}")
-                        
-                        # Si no hay fecha especificada, usar la fecha más reciente de los datos
-                        if not query.fecha:
-                            # Intentar obtener la fecha de los datos
-                            fecha_cols = ["fecha", "FECHA_VALORACION", "fecha_valoracion"]
-                            fecha_valoracion = None
-                            for col in fecha_cols:
-                                if col in df_normalized.columns:
-                                    try:
-                                        # Obtener la fecha más reciente
-                                        fechas = pd.to_datetime(df_normalized[col], errors='coerce')
-                                        fecha_valoracion = fechas.max().date() if not fechas.empty else None
-                                        if fecha_valoracion:
-                                            break
-                                    except:
-                                        continue
-                            
-                            if not fecha_valoracion:
-                                fecha_valoracion = date.today()
-                        else:
-                            fecha_valoracion = query.fecha
-                        
-                        logger.info(f"Usando fecha de valoración: {fecha_valoracion}")
-                        
-                        valuations = ingestion_service.process_dataframe(
-                            df_normalized, provider, fecha_valoracion, "consulta_directa"
-                        )
-                        
-                        logger.info(f"Se procesaron {len(valuations)} valoraciones de {provider.value} antes de aplicar filtros adicionales")
-                        
-                        # Filtrar por ISIN exacto si se especificó (después de normalizar, para asegurar coincidencia exacta)
-                        if query.isin and valuations:
-                            isin_normalized = query.isin.strip().upper() if query.isin else None
-                            if isin_normalized:
-                                resultados_antes_isin = len(valuations)
-                                valuations = [
-                                    v for v in valuations 
-                                    if v.isin and str(v.isin).strip().upper() == isin_normalized
-                                ]
-                                resultados_despues_isin = len(valuations)
-                                if resultados_antes_isin != resultados_despues_isin:
-                                    logger.info(f"Filtrado por ISIN exacto '{isin_normalized}': {resultados_antes_isin} → {resultados_despues_isin} valoraciones")
-                                else:
-                                    logger.debug(f"ISIN '{isin_normalized}' ya estaba filtrado correctamente: {resultados_despues_isin} valoraciones")
-                        
-                        # Log adicional: mostrar algunos ISINs únicos encontrados para debugging
-                        if valuations:
-                            isins_unicos = set(v.isin for v in valuations if v.isin)
-                            logger.info(f"📋 ISINs únicos encontrados en {provider.value} ANTES de filtrar por fecha: {len(isins_unicos)} → {sorted(isins_unicos)}")
-                            
-                            # Verificar si el ISIN faltante está presente
-                            isin_faltante = "COB13CD1K4D3"
-                            if isin_faltante in isins_unicos:
-                                logger.info(f"✅ ISIN faltante {isin_faltante} encontrado en {provider.value} ANTES del filtro de fecha")
-                                # Log adicional: mostrar la fecha de vencimiento de este ISIN
-                                for v in valuations:
-                                    if v.isin == isin_faltante:
-                                        logger.info(f"   📅 Fecha de vencimiento de {isin_faltante}: {v.fecha_vencimiento} (tipo: {type(v.fecha_vencimiento)})")
-                            else:
-                                logger.warning(f"⚠️ ISIN faltante {isin_faltante} NO encontrado en {provider.value} ANTES del filtro de fecha")
-                        
-                        # Aplicar filtros adicionales después de procesar los datos
-                        # 1. Filtrar por fecha de vencimiento si se especificó
-                        if query.fecha_vencimiento and valuations:
-                            resultados_antes = len(valuations)
-                            # IMPORTANTE: Filtrar por fecha de vencimiento exacta
-                            # Asegurar que la comparación sea exacta y que ambos valores sean del mismo tipo
-                            fecha_vencimiento_buscada = query.fecha_vencimiento
-                            if isinstance(fecha_vencimiento_buscada, str):
-                                from datetime import datetime
-                                fecha_vencimiento_buscada = datetime.fromisoformat(fecha_vencimiento_buscada).date()
-                            
-                            valuations_filtradas = []
-                            for v in valuations:
-                                # Log especial para el ISIN faltante
-                                isin_faltante = "COB13CD1K4D3"
-                                es_isin_faltante = (v.isin == isin_faltante)
-                                
-                                if v.fecha_vencimiento:
-                                    # Asegurar que ambas fechas sean del mismo tipo para comparar
-                                    fecha_v = v.fecha_vencimiento
-                                    fecha_v_original = fecha_v  # Guardar original para logging
-                                    
-                                    if isinstance(fecha_v, str):
-                                        # Intentar múltiples formatos de fecha
-                                        try:
-                                            fecha_v = datetime.fromisoformat(fecha_v).date()
-                                        except:
-                                            try:
-                                                # Formato DD/MM/YYYY o DD-MM-YYYY
-                                                import re
-                                                match = re.match(r'(\d{1,2})[/-](\d{1,2})[/-](\d{4})', fecha_v)
-                                                if match:
-                                                    dia, mes, año = match.groups()
-                                                    fecha_v = date(int(año), int(mes), int(dia))
-                                                else:
-                                                    # Intentar parsear con pandas
-                                                    fecha_v = pd.to_datetime(fecha_v).date()
-                                            except Exception as e:
-                                                if es_isin_faltante:
-                                                    logger.error(f"🔴 ERROR parseando fecha de vencimiento del ISIN faltante {v.isin}: {fecha_v_original} - Error: {str(e)}")
-                                                logger.warning(f"No se pudo parsear fecha de vencimiento: {fecha_v_original} para ISIN {v.isin}")
-                                                continue
-                                    elif hasattr(fecha_v, 'date'):
-                                        fecha_v = fecha_v.date()
-                                    
-                                    # VALIDACIÓN FINAL: Coincidencia exacta en Python (más estricta que el filtro de Supabase)
-                                    # El filtro de Supabase usa tolerancia ±1 día para capturar variaciones de formato
-                                    # Aquí validamos coincidencia exacta para garantizar precisión
-                                    if fecha_v == fecha_vencimiento_buscada:
-                                        valuations_filtradas.append(v)
-                                        if es_isin_faltante:
-                                            logger.info(f"✅ ISIN faltante {v.isin} PASÓ el filtro de fecha: {fecha_v} == {fecha_vencimiento_buscada}")
-                                    else:
-                                        # Log para debugging: registrar ISINs que no pasan el filtro de fecha
-                                        diferencia = abs((fecha_v - fecha_vencimiento_buscada).days) if fecha_v and fecha_vencimiento_buscada else None
-                                        if diferencia and diferencia <= 2:  # Solo loggear si la diferencia es pequeña
-                                            logger.warning(f"❌ ISIN {v.isin} eliminado por filtro de fecha: {fecha_v} vs {fecha_vencimiento_buscada} (diferencia: {diferencia} días) en {provider.value}")
-                                        # Log especial para el ISIN faltante
-                                        if es_isin_faltante:
-                                            logger.error(f"🔴 ISIN FALTANTE {v.isin} ELIMINADO por filtro de fecha: {fecha_v} vs {fecha_vencimiento_buscada} (diferencia: {diferencia} días) en {provider.value}. Fecha original: {fecha_v_original}, tipo original: {type(fecha_v_original)}")
-                                else:
-                                    # Si no tiene fecha de vencimiento, también loggear para el ISIN faltante
-                                    if es_isin_faltante:
-                                        logger.error(f"🔴 ISIN FALTANTE {v.isin} NO tiene fecha_vencimiento en {provider.value}")
-                            
-                            valuations = valuations_filtradas
-                            resultados_despues = len(valuations)
-                            
-                            # Log de ISINs ANTES del filtro para comparar
-                            if resultados_antes > 0:
-                                isins_antes_filtro = set(v.isin for v in valuations_filtradas if v.isin)
-                                # Necesitamos los ISINs antes del filtro, pero ya los tenemos en el log anterior
-                            
-                            if resultados_antes != resultados_despues:
-                                logger.info(f"✅ Filtrado por fecha de vencimiento {query.fecha_vencimiento}: {resultados_antes} → {resultados_despues} valoraciones")
-                                # Log de ISINs después del filtro
-                                if valuations:
-                                    isins_despues_filtro = set(v.isin for v in valuations if v.isin)
-                                    logger.info(f"📋 ISINs únicos DESPUÉS del filtro de fecha en {provider.value}: {len(isins_despues_filtro)} → {sorted(isins_despues_filtro)}")
-                                    
-                                    # Verificar si el ISIN faltante está presente después del filtro
-                                    isin_faltante = "COB13CD1K4D3"
-                                    if isin_faltante in isins_despues_filtro:
-                                        logger.info(f"✅ ISIN faltante {isin_faltante} encontrado en {provider.value} DESPUÉS del filtro de fecha")
-                                    else:
-                                        logger.warning(f"⚠️ ISIN faltante {isin_faltante} NO encontrado en {provider.value} DESPUÉS del filtro de fecha (fue eliminado por el filtro)")
-                            else:
-                                logger.warning(f"⚠️ Filtro de fecha de vencimiento {query.fecha_vencimiento} no redujo resultados ({resultados_antes} → {resultados_despues}). Verificar que las fechas se estén comparando correctamente.")
-                                # Log adicional para debugging
-                                if valuations:
-                                    fechas_encontradas = set()
-                                    isins_antes_filtro = set()
-                                    for v in valuations[:20]:  # Revisar primeras 20
-                                        if v.fecha_vencimiento:
-                                            fechas_encontradas.add(str(v.fecha_vencimiento))
-                                        if v.isin:
-                                            isins_antes_filtro.add(v.isin)
-                                    logger.info(f"Fechas de vencimiento encontradas en los primeros resultados: {sorted(fechas_encontradas)}")
-                                    logger.info(f"ISINs en los primeros resultados: {sorted(isins_antes_filtro)}")
-                        
-                        # 2. Aplicar filtro de cupón también a los objetos Valuation (por si el filtro del DataFrame no fue suficiente)
-                        if query.cupon is not None and valuations:
-                            cupon_min = query.cupon - 0.01
-                            cupon_max = query.cupon + 0.01
-                            resultados_antes = len(valuations)
-                            valuations_filtradas = [
-                                v for v in valuations 
-                                if v.cupon is not None 
-                                and cupon_min <= v.cupon <= cupon_max
-                            ]
-                            logger.info(f"Filtrado por cupón {query.cupon} en objetos Valuation: {len(valuations)} → {len(valuations_filtradas)}")
-                            valuations = valuations_filtradas
-                        
-                        logger.info(f"Se procesaron {len(valuations)} valoraciones de {provider.value} después de todos los filtros")
-                        
-                        # Log adicional: mostrar ISINs únicos encontrados por proveedor
-                        # IMPORTANTE: Esto muestra claramente cuántos ISINs únicos hay en cada tabla
-                        if valuations:
-                            isins_por_proveedor = set(v.isin for v in valuations if v.isin)
-                            logger.info(f"📊 RESUMEN {provider.value}: {len(valuations)} valoraciones, {len(isins_por_proveedor)} ISINs únicos → {sorted(isins_por_proveedor)}")
-                            
-                            # Verificar si el ISIN faltante está en este proveedor
-                            isin_faltante = "COB13CD1K4D3"
-                            if isin_faltante in isins_por_proveedor:
-                                logger.info(f"✅ ISIN faltante {isin_faltante} encontrado en {provider.value}")
-                                # Log detallado del ISIN faltante
-                                for v in valuations:
-                                    if v.isin == isin_faltante:
-                                        logger.info(f"   📋 Detalles del ISIN faltante: ISIN={v.isin}, fecha_vencimiento={v.fecha_vencimiento}, proveedor={v.proveedor}")
-                            else:
-                                logger.warning(f"⚠️ ISIN faltante {isin_faltante} NO encontrado en {provider.value}")
-                        
-                        # IMPORTANTE: Agregar TODAS las valoraciones encontradas, sin importar si solo están en un proveedor
-                        # LÓGICA SIMPLE: Buscar en PIP, filtrar por fecha, agregar resultados. Buscar en Precia, filtrar por fecha, agregar resultados.
-                        # Luego combinamos todos los ISINs únicos. Si un ISIN solo está en PIP, se incluye igual.
-                        all_valuations.extend(valuations)
-                        logger.info(f"✅ Agregadas {len(valuations)} valoraciones de {provider.value} al conjunto total (total acumulado: {len(all_valuations)} valoraciones)")
-                        
-                        # Guardar en BD local para futuras consultas
-                        for v in valuations:
-                            existing = self.db.query(Valuation).filter(
-                                and_(
-                                    Valuation.isin == v.isin,
-                                    Valuation.fecha == v.fecha,
-                                    Valuation.proveedor == v.proveedor
-                                )
-                            ).first()
-                            if not existing:
-                                self.db.add(v)
-                        
-                        self.db.commit()
-                except Exception as e:
-                    logger.error(f"❌ Error consultando {provider.value} en Supabase: {str(e)}")
-                    logger.warning(f"Continuando con el otro proveedor...")
-                    # IMPORTANTE: Continuar con el otro proveedor incluso si uno falla
-                    # Esto asegura que ISINs que solo están en un proveedor se incluyan
-                    continue
+                    existing_keys.add(key)
+                    self.db.add(v)
+                    nuevas += 1
+                
+                self.db.commit()
+                logger.info(f"💾 {nuevas} valoraciones de Supabase guardadas en la BD local")
+                invalidate_series_cache()
+            except Exception as e:
+                self.db.rollback()
+                logger.error(f"Error guardando valoraciones de Supabase en BD local: {str(e)}")
             
             # Log final: mostrar todos los ISINs únicos encontrados después de combinar ambos proveedores
             if all_valuations:
@@ -822,6 +535,457 @@ class QueryService:
             logger.error(f"Error en consulta directa a Supabase: {str(e)}")
             return []
     
+    def _query_provider_supabase(self, query: ValuationQuery, provider: Provider,
+                                 supabase: SupabaseService, ingestion_service: IngestionService,
+                                 deadline: Optional[float] = None) -> List[Valuation]:
+        """
+        Consulta y procesa la tabla de un proveedor en Supabase (se ejecuta en un hilo del pool)
+        
+        IMPORTANTE: No usa la sesión de BD (no es thread-safe); el guardado local lo hace el hilo de la petición
+        
+        Args:
+            query: Objeto ValuationQuery con filtros
+            provider: Proveedor a consultar
+            supabase: Servicio de Supabase compartido por ambos proveedores
+            ingestion_service: Servicio de ingesta para normalizar y procesar los datos
+            deadline: Instante límite (time.monotonic()); la paginación se detiene al alcanzarlo
+        
+        Returns:
+            Lista de valoraciones del proveedor después de todos los filtros
+        """
+        logger.info(f"🔍 Buscando en proveedor {provider.value}...")
+        
+        table_name = supabase.get_table_name(provider.value)
+        available_columns = supabase._get_available_columns(table_name)
+        # Columnas reales por rol (resueltas una vez por tabla y guardadas en caché)
+        resolved_columns = supabase.resolve_columns(table_name)
+        
+        # Determinar qué columna usar para la búsqueda
+        search_params = {}
+        
+        if query.isin:
+            # Búsqueda por ISIN (case-insensitive)
+            isin_normalized = query.isin.strip().upper() if query.isin else None
+            if not isin_normalized:
+                return []
+            
+            isin_col = resolved_columns["isin"]
+            
+            if isin_col:
+                # Estrategia: Usar eq. con ISIN normalizado (funciona perfectamente según diagnóstico)
+                # El ISIN está en Supabase, solo necesitamos normalizarlo correctamente
+                search_params[f"{isin_col}"] = f"eq.{isin_normalized}"
+                logger.info(f"🔍 Buscando ISIN '{isin_normalized}' en columna '{isin_col}' usando eq. (búsqueda exacta)")
+            else:
+                return []
+        elif query.emisor and query.tipo_instrumento and query.emisor == query.tipo_instrumento:
+            # Búsqueda por nemotécnico
+            nemotecnico = query.emisor
+            logger.info(f"Buscando nemotécnico '{nemotecnico}' en Supabase. Columnas disponibles: {available_columns}")
+            
+            # IMPORTANTE: Para nemotécnicos, buscar en la columna NEMOTECNICO si existe
+            # Si no existe, buscar en EMISION/emisor, pero ser más estricto
+            # Si no hay columna nemotécnico, buscar en EMISION/emisor y luego en tipo_instrumento
+            nemotecnico_col = (
+                resolved_columns["nemotecnico"]
+                or resolved_columns["emisor"]
+                or resolved_columns["tipo_instrumento"]
+            )
+            
+            if nemotecnico_col:
+                # IMPORTANTE: Para nemotécnicos, usar búsqueda exacta case-insensitive
+                # PostgREST: ilike sin comodines busca exacta case-insensitive
+                search_params[f"{nemotecnico_col}"] = f"ilike.{nemotecnico}"
+                logger.info(f"Buscando nemotécnico '{nemotecnico}' en columna '{nemotecnico_col}' con ilike.{nemotecnico} (coincidencia exacta case-insensitive)")
+            else:
+                logger.warning(f"No se encontró columna para buscar nemotécnico. Columnas disponibles: {available_columns}")
+                return []
+        else:
+            return []
+        
+        if not search_params:
+            return []
+        
+        # Consultar Supabase (pasar solo el nombre de la tabla, no la URL completa)
+        # IMPORTANTE: Para nemotécnicos, necesitamos obtener TODOS los registros
+        # PostgREST tiene un límite máximo por respuesta; iter_pages pagina hasta agotar los resultados
+        # Proyección: solo las columnas que usa COLUMN_MAPPINGS (el resto las descarta normalize_column_names)
+        projection = ingestion_service.get_projection(provider, available_columns)
+        params = {
+            "select": supabase.build_select(projection)
+        }
+        params.update(search_params)
+        
+        if query.isin:
+            logger.info(f"Buscando ISIN '{isin_normalized}' en {table_name} usando filtro eq. en Supabase")
+        else:
+            logger.info(f"Buscando nemotécnico '{nemotecnico}' en {table_name} - obteniendo todos los registros")
+        
+        # Agregar filtro de fecha de valoración si existe
+        fecha_col = resolved_columns["fecha"]
+        
+        if query.fecha and fecha_col:
+            params[f"{fecha_col}"] = f"eq.{query.fecha.isoformat()}"
+        
+        # Agregar filtro de fecha de vencimiento si existe
+        # ESTRATEGIA HÍBRIDA: Aplicar filtro en Supabase con tolerancia, luego validar en Python
+        fecha_vencimiento_para_filtrar = None
+        if query.fecha_vencimiento:
+            # Buscar columna de fecha de vencimiento
+            vencimiento_col = resolved_columns["vencimiento"]
+            
+            if vencimiento_col:
+                # Aplicar filtro en Supabase con tolerancia de ±1 día para manejar variaciones de formato
+                fecha_iso = query.fecha_vencimiento.isoformat()
+                # Usar rango en Supabase: desde 1 día antes hasta 1 día después
+                from datetime import timedelta
+                fecha_min = (query.fecha_vencimiento - timedelta(days=1)).isoformat()
+                fecha_max = (query.fecha_vencimiento + timedelta(days=1)).isoformat()
+                # PostgREST: usar gte y lte para rango (parámetros separados)
+                # httpx maneja automáticamente múltiples valores para la misma clave
+                params[f"{vencimiento_col}"] = [f"gte.{fecha_min}", f"lte.{fecha_max}"]
+                logger.info(f"Filtro de fecha de vencimiento en Supabase: {fecha_min} a {fecha_max} (tolerancia ±1 día)")
+            else:
+                logger.warning(f"No se encontró columna de fecha de vencimiento. Columnas disponibles: {available_columns}")
+            
+            # Guardar para validación final en Python (coincidencia exacta)
+            fecha_vencimiento_para_filtrar = query.fecha_vencimiento
+            logger.info(f"Fecha de vencimiento también se validará en Python con coincidencia exacta: {query.fecha_vencimiento.isoformat()}")
+        
+        # Agregar filtro de cupón/tasa facial si existe
+        # ESTRATEGIA HÍBRIDA: Aplicar filtro en Supabase con rango, luego validar en Python
+        if query.cupon is not None:
+            cupon_col = resolved_columns["cupon"]
+            
+            if cupon_col:
+                # Aplicar filtro en Supabase con rango ampliado (tolerancia 0.02 para capturar variaciones)
+                cupon_min = query.cupon - 0.02  # Rango ampliado para Supabase
+                cupon_max = query.cupon + 0.02
+                # PostgREST: usar gte y lte para rango numérico (parámetros separados)
+                # httpx maneja automáticamente múltiples valores para la misma clave
+                params[f"{cupon_col}"] = [f"gte.{cupon_min}", f"lte.{cupon_max}"]
+                logger.info(f"Filtro de cupón/tasa facial en Supabase: {cupon_min} a {cupon_max} (rango ampliado ±0.02)")
+                logger.info(f"Cupón también se validará en Python con rango exacto: {query.cupon - 0.01} a {query.cupon + 0.01}")
+            else:
+                logger.warning(f"No se encontró columna de cupón/tasa facial. Columnas disponibles: {available_columns}")
+        
+        # Obtener TODOS los registros sin tope de iteraciones que trunque nemotécnicos grandes
+        # Paginación keyset por defecto (SUPABASE_PAGINATION_MODE); cada página se convierte
+        # a DataFrame al llegar en lugar de acumular todos los registros como diccionarios
+        logger.info(f"Consultando {table_name} con parámetros: {params}")
+        frames = [pd.DataFrame(page) for page in supabase.iter_pages(table_name, params, deadline=deadline)]
+        total_registros = sum(len(frame) for frame in frames)
+        
+        logger.info(f"📊 RESUMEN: Total de registros obtenidos de {table_name}: {total_registros}")
+        
+        if frames:
+            # Unir las páginas de Supabase en un DataFrame y procesar
+            df = pd.concat(frames, ignore_index=True)
+            logger.info(f"DataFrame creado con {len(df)} filas y {len(df.columns)} columnas")
+        else:
+            if query.isin:
+                logger.warning(f"⚠️ No se obtuvieron registros de {table_name} para ISIN '{query.isin}'")
+            else:
+                logger.warning(f"⚠️ No se obtuvieron registros de {table_name} para nemotécnico '{nemotecnico}'")
+            df = pd.DataFrame()
+        
+        # Continuar procesando solo si hay datos en el DataFrame
+        if not df.empty:
+            # Log de ISINs en el DataFrame crudo ANTES de normalizar (para debugging)
+            if query.emisor and query.tipo_instrumento and query.emisor == query.tipo_instrumento:
+                isin_cols_candidatas = []
+                for col in df.columns:
+                    col_upper = str(col).upper()
+                    if "ISIN" in col_upper or "CODIGO" in col_upper or "CÓDIGO" in col_upper:
+                        isin_cols_candidatas.append(col)
+                
+                if isin_cols_candidatas:
+                    # Intentar con la primera columna candidata
+                    isin_col = isin_cols_candidatas[0]
+                    isins_en_df_crudo = df[isin_col].dropna().unique()
+                    logger.info(f"🔍 ISINs en DataFrame CRUDO de {table_name} (antes de normalizar): {len(isins_en_df_crudo)} → {sorted([str(x) for x in isins_en_df_crudo[:20]])}")
+                    
+                    # Verificar si el ISIN faltante está en el DataFrame crudo
+                    isin_faltante = "COB13CD1K4D3"
+                    isins_str = [str(x) for x in isins_en_df_crudo]
+                    if isin_faltante in isins_str:
+                        logger.info(f"✅ ISIN faltante {isin_faltante} encontrado en DataFrame CRUDO de {table_name}")
+                    else:
+                        logger.warning(f"⚠️ ISIN faltante {isin_faltante} NO encontrado en DataFrame CRUDO de {table_name} (puede estar más allá del límite o no estar en este proveedor)")
+            
+            # Determinar descripción de búsqueda para el log
+            if query.isin:
+                search_desc = f"ISIN {query.isin}"
+            elif query.emisor and query.tipo_instrumento and query.emisor == query.tipo_instrumento:
+                search_desc = f"nemotécnico {query.emisor}"
+            else:
+                search_desc = "criterios especificados"
+            logger.info(f"Se encontraron {len(df)} registros en {table_name} para {search_desc} (antes de normalizar y filtrar)")
+            
+            # Normalizar y procesar
+            df_normalized = ingestion_service.normalize_column_names(df, provider)
+            
+            # Filtrar por cupón/tasa facial si se especificó (con tolerancia por redondeo)
+            if query.cupon is not None:
+                # Buscar columna de cupón (puede estar normalizada o no)
+                cupon_col = None
+                for col_name in ["cupon", "CUPON", "TASA_FACIAL", "tasa_facial", "Tasa Facial", "Cupón"]:
+                    if col_name in df_normalized.columns:
+                        cupon_col = col_name
+                        break
+                
+                if cupon_col:
+                    # VALIDACIÓN FINAL: Rango exacto en Python (más estricto que Supabase)
+                    cupon_min = query.cupon - 0.01  # Rango exacto para validación final
+                    cupon_max = query.cupon + 0.01
+                    # Convertir a numérico si es necesario
+                    df_normalized[cupon_col] = pd.to_numeric(df_normalized[cupon_col], errors='coerce')
+                    mask = (df_normalized[cupon_col] >= cupon_min) & (df_normalized[cupon_col] <= cupon_max)
+                    registros_antes = len(df_normalized)
+                    df_normalized = df_normalized[mask]
+                    registros_despues = len(df_normalized)
+                    logger.info(f"✅ Validación final en Python: cupón {query.cupon} (rango exacto: {cupon_min} - {cupon_max}): {registros_antes} → {registros_despues} registros")
+                else:
+                    logger.warning(f"No se encontró columna de cupón para filtrar. Columnas disponibles: {list(df_normalized.columns)}")
+            
+            # Si no hay fecha especificada, usar la fecha más reciente de los datos
+            if not query.fecha:
+                # Intentar obtener la fecha de los datos
+                fecha_cols = ["fecha", "FECHA_VALORACION", "fecha_valoracion"]
+                fecha_valoracion = None
+                for col in fecha_cols:
+                    if col in df_normalized.columns:
+                        try:
+                            # Obtener la fecha más reciente
+                            fechas = pd.to_datetime(df_normalized[col], errors='coerce')
+                            fecha_valoracion = fechas.max().date() if not fechas.empty else None
+                            if fecha_valoracion:
+                                break
+                        except:
+                            continue
+                
+                if not fecha_valoracion:
+                    fecha_valoracion = date.today()
+            else:
+                fecha_valoracion = query.fecha
+            
+            logger.info(f"Usando fecha de valoración: {fecha_valoracion}")
+            
+            valuations = ingestion_service.process_dataframe(
+                df_normalized, provider, fecha_valoracion, "consulta_directa"
+            )
+            
+            logger.info(f"Se procesaron {len(valuations)} valoraciones de {provider.value} antes de aplicar filtros adicionales")
+            
+            # Filtrar por ISIN exacto si se especificó (después de normalizar, para asegurar coincidencia exacta)
+            if query.isin and valuations:
+                isin_normalized = query.isin.strip().upper() if query.isin else None
+                if isin_normalized:
+                    resultados_antes_isin = len(valuations)
+                    valuations = [
+                        v for v in valuations 
+                        if v.isin and str(v.isin).strip().upper() == isin_normalized
+                    ]
+                    resultados_despues_isin = len(valuations)
+                    if resultados_antes_isin != resultados_despues_isin:
+                        logger.info(f"Filtrado por ISIN exacto '{isin_normalized}': {resultados_antes_isin} → {resultados_despues_isin} valoraciones")
+                    else:
+                        logger.debug(f"ISIN '{isin_normalized}' ya estaba filtrado correctamente: {resultados_despues_isin} valoraciones")
+            
+            # Log adicional: mostrar algunos ISINs únicos encontrados para debugging
+            if valuations:
+                isins_unicos = set(v.isin for v in valuations if v.isin)
+                logger.info(f"📋 ISINs únicos encontrados en {provider.value} ANTES de filtrar por fecha: {len(isins_unicos)} → {sorted(isins_unicos)}")
+                
+                # Verificar si el ISIN faltante está presente
+                isin_faltante = "COB13CD1K4D3"
+                if isin_faltante in isins_unicos:
+                    logger.info(f"✅ ISIN faltante {isin_faltante} encontrado en {provider.value} ANTES del filtro de fecha")
+                    # Log adicional: mostrar la fecha de vencimiento de este ISIN
+                    for v in valuations:
+                        if v.isin == isin_faltante:
+                            logger.info(f"   📅 Fecha de vencimiento de {isin_faltante}: {v.fecha_vencimiento} (tipo: {type(v.fecha_vencimiento)})")
+                else:
+                    logger.warning(f"⚠️ ISIN faltante {isin_faltante} NO encontrado en {provider.value} ANTES del filtro de fecha")
+            
+            # Aplicar filtros adicionales después de procesar los datos
+            # 1. Filtrar por fecha de vencimiento si se especificó
+            if query.fecha_vencimiento and valuations:
+                resultados_antes = len(valuations)
+                # IMPORTANTE: Filtrar por fecha de vencimiento exacta
+                # Asegurar que la comparación sea exacta y que ambos valores sean del mismo tipo
+                fecha_vencimiento_buscada = query.fecha_vencimiento
+                if isinstance(fecha_vencimiento_buscada, str):
+                    from datetime import datetime
+                    fecha_vencimiento_buscada = datetime.fromisoformat(fecha_vencimiento_buscada).date()
+                
+                valuations_filtradas = []
+                for v in valuations:
+                    # Log especial para el ISIN faltante
+                    isin_faltante = "COB13CD1K4D3"
+                    es_isin_faltante = (v.isin == isin_faltante)
+                    
+                    if v.fecha_vencimiento:
+                        # Asegurar que ambas fechas sean del mismo tipo para comparar
+                        fecha_v = v.fecha_vencimiento
+                        fecha_v_original = fecha_v  # Guardar original para logging
+                        
+                        if isinstance(fecha_v, str):
+                            # Intentar múltiples formatos de fecha
+                            try:
+                                fecha_v = datetime.fromisoformat(fecha_v).date()
+                            except:
+                                try:
+                                    # Formato DD/MM/YYYY o DD-MM-YYYY
+                                    import re
+                                    match = re.match(r'(\d{1,2})[/-](\d{1,2})[/-](\d{4})', fecha_v)
+                                    if match:
+                                        dia, mes, año = match.groups()
+                                        fecha_v = date(int(año), int(mes), int(dia))
+                                    else:
+                                        # Intentar parsear con pandas
+                                        fecha_v = pd.to_datetime(fecha_v).date()
+                                except Exception as e:
+                                    if es_isin_faltante:
+                                        logger.error(f"🔴 ERROR parseando fecha de vencimiento del ISIN faltante {v.isin}: {fecha_v_original} - Error: {str(e)}")
+                                    logger.warning(f"No se pudo parsear fecha de vencimiento: {fecha_v_original} para ISIN {v.isin}")
+                                    continue
+                        elif hasattr(fecha_v, 'date'):
+                            fecha_v = fecha_v.date()
+                        
+                        # VALIDACIÓN FINAL: Coincidencia exacta en Python (más estricta que el filtro de Supabase)
+                        # El filtro de Supabase usa tolerancia ±1 día para capturar variaciones de formato
+                        # Aquí validamos coincidencia exacta para garantizar precisión
+                        if fecha_v == fecha_vencimiento_buscada:
+                            valuations_filtradas.append(v)
+                            if es_isin_faltante:
+                                logger.info(f"✅ ISIN faltante {v.isin} PASÓ el filtro de fecha: {fecha_v} == {fecha_vencimiento_buscada}")
+                        else:
+                            # Log para debugging: registrar ISINs que no pasan el filtro de fecha
+                            diferencia = abs((fecha_v - fecha_vencimiento_buscada).days) if fecha_v and fecha_vencimiento_buscada else None
+                            if diferencia and diferencia <= 2:  # Solo loggear si la diferencia es pequeña
+                                logger.warning(f"❌ ISIN {v.isin} eliminado por filtro de fecha: {fecha_v} vs {fecha_vencimiento_buscada} (diferencia: {diferencia} días) en {provider.value}")
+                            # Log especial para el ISIN faltante
+                            if es_isin_faltante:
+                                logger.error(f"🔴 ISIN FALTANTE {v.isin} ELIMINADO por filtro de fecha: {fecha_v} vs {fecha_vencimiento_buscada} (diferencia: {diferencia} días) en {provider.value}. Fecha original: {fecha_v_original}, tipo original: {type(fecha_v_original)}")
+                    else:
+                        # Si no tiene fecha de vencimiento, también loggear para el ISIN faltante
+                        if es_isin_faltante:
+                            logger.error(f"🔴 ISIN FALTANTE {v.isin} NO tiene fecha_vencimiento en {provider.value}")
+                
+                valuations = valuations_filtradas
+                resultados_despues = len(valuations)
+                
+                # Log de ISINs ANTES del filtro para comparar
+                if resultados_antes > 0:
+                    isins_antes_filtro = set(v.isin for v in valuations_filtradas if v.isin)
+                    # Necesitamos los ISINs antes del filtro, pero ya los tenemos en el log anterior
+                
+                if resultados_antes != resultados_despues:
+                    logger.info(f"✅ Filtrado por fecha de vencimiento {query.fecha_vencimiento}: {resultados_antes} → {resultados_despues} valoraciones")
+                    # Log de ISINs después del filtro
+                    if valuations:
+                        isins_despues_filtro = set(v.isin for v in valuations if v.isin)
+                        logger.info(f"📋 ISINs únicos DESPUÉS del filtro de fecha en {provider.value}: {len(isins_despues_filtro)} → {sorted(isins_despues_filtro)}")
+                        
+                        # Verificar si el ISIN faltante está presente después del filtro
+                        isin_faltante = "COB13CD1K4D3"
+                        if isin_faltante in isins_despues_filtro:
+                            logger.info(f"✅ ISIN faltante {isin_faltante} encontrado en {provider.value} DESPUÉS del filtro de fecha")
+                        else:
+                            logger.warning(f"⚠️ ISIN faltante {isin_faltante} NO encontrado en {provider.value} DESPUÉS del filtro de fecha (fue eliminado por el filtro)")
+                else:
+                    logger.warning(f"⚠️ Filtro de fecha de vencimiento {query.fecha_vencimiento} no redujo resultados ({resultados_antes} → {resultados_despues}). Verificar que las fechas se estén comparando correctamente.")
+                    # Log adicional para debugging
+                    if valuations:
+                        fechas_encontradas = set()
+                        isins_antes_filtro = set()
+                        for v in valuations[:20]:  # Revisar primeras 20
+                            if v.fecha_vencimiento:
+                                fechas_encontradas.add(str(v.fecha_vencimiento))
+                            if v.isin:
+                                isins_antes_filtro.add(v.isin)
+                        logger.info(f"Fechas de vencimiento encontradas en los primeros resultados: {sorted(fechas_encontradas)}")
+                        logger.info(f"ISINs en los primeros resultados: {sorted(isins_antes_filtro)}")
+            
+            # 2. Aplicar filtro de cupón también a los objetos Valuation (por si el filtro del DataFrame no fue suficiente)
+            if query.cupon is not None and valuations:
+                cupon_min = query.cupon - 0.01
+                cupon_max = query.cupon + 0.01
+                resultados_antes = len(valuations)
+                valuations_filtradas = [
+                    v for v in valuations 
+                    if v.cupon is not None 
+                    and cupon_min <= v.cupon <= cupon_max
+                ]
+                logger.info(f"Filtrado por cupón {query.cupon} en objetos Valuation: {len(valuations)} → {len(valuations_filtradas)}")
+                valuations = valuations_filtradas
+            
+            logger.info(f"Se procesaron {len(valuations)} valoraciones de {provider.value} después de todos los filtros")
+            
+            # Log adicional: mostrar ISINs únicos encontrados por proveedor
+            # IMPORTANTE: Esto muestra claramente cuántos ISINs únicos hay en cada tabla
+            if valuations:
+                isins_por_proveedor = set(v.isin for v in valuations if v.isin)
+                logger.info(f"📊 RESUMEN {provider.value}: {len(valuations)} valoraciones, {len(isins_por_proveedor)} ISINs únicos → {sorted(isins_por_proveedor)}")
+                
+                # Verificar si el ISIN faltante está en este proveedor
+                isin_faltante = "COB13CD1K4D3"
+                if isin_faltante in isins_por_proveedor:
+                    logger.info(f"✅ ISIN faltante {isin_faltante} encontrado en {provider.value}")
+                    # Log detallado del ISIN faltante
+                    for v in valuations:
+                        if v.isin == isin_faltante:
+                            logger.info(f"   📋 Detalles del ISIN faltante: ISIN={v.isin}, fecha_vencimiento={v.fecha_vencimiento}, proveedor={v.proveedor}")
+                else:
+                    logger.warning(f"⚠️ ISIN faltante {isin_faltante} NO encontrado en {provider.value}")
+            
+            # IMPORTANTE: Devolver TODAS las valoraciones encontradas, sin importar si solo están en un proveedor
+            # Luego se combinan todos los ISINs únicos. Si un ISIN solo está en PIP, se incluye igual.
+            return valuations
+        
+        return []
+    
+    def _fan_out_providers(self, query: ValuationQuery, providers: List[Provider],
+                           supabase: SupabaseService, ingestion_service: IngestionService) -> Dict[Provider, List[Valuation]]:
+        """
+        Consulta los proveedores en paralelo y espera a lo sumo SUPABASE_PROVIDER_TIMEOUT segundos
+        
+        Returns:
+            Diccionario {proveedor: valoraciones}; los proveedores con error o que no respondieron a tiempo no aparecen
+        """
+        results = {}
+        if not providers:
+            return results
+        
+        # El hilo no se puede interrumpir: el deadline hace que iter_pages lo termine entre páginas
+        # (cada petición HTTP ya está acotada por SUPABASE_TIMEOUT) y libere el worker del pool
+        deadline = time.monotonic() + settings.supabase_provider_timeout
+        futures = {
+            _provider_executor.submit(
+                self._query_provider_supabase, query, provider, supabase, ingestion_service, deadline
+            ): provider
+            for provider in providers
+        }
+        done, pending = wait(futures, timeout=settings.supabase_provider_timeout)
+        
+        for future in done:
+            provider = futures[future]
+            try:
+                results[provider] = future.result()
+            except Exception as e:
+                logger.error(f"❌ Error consultando {provider.value} en Supabase: {str(e)}")
+                logger.warning(f"Continuando con el otro proveedor...")
+        
+        for future in pending:
+            # Se abandona: el hilo sigue hasta su próxima revisión del deadline y su resultado se descarta
+            logger.error(
+                f"⏱️ {futures[future].value} no respondió en {settings.supabase_provider_timeout}s; "
+                f"se abandona su consulta pendiente y se devuelven resultados parciales"
+            )
+        
+        return results
+    
     def get_latest_valuation(self, isin: str, provider: Optional[Provider] = None) -> Optional[Valuation]:
         """
         Obtiene la valoración más reciente de un ISIN
@@ -840,45 +1004,67 @@ class QueryService:
         
         return query_builder.order_by(Valuation.fecha.desc()).first()
     
-    def compare_providers(self, isin: str, fecha: Optional[date] = None) -> Dict:
+    def _provider_rows(self, isins: List[str], fecha: Optional[date] = None) -> Dict[str, Dict]:
         """
-        Compara valoraciones entre proveedores para un ISIN
+        Valoraciones de ambos proveedores por ISIN en una sola consulta
+        
+        Sin fecha, toma la fecha más reciente en que ambos proveedores valoraron cada ISIN
+        (GROUP BY isin, fecha HAVING count(DISTINCT proveedor) = 2) y trae las filas de
+        PIP_LATAM y PRECIA de ese día; si no hay fecha común, la más reciente de cualquiera.
         
         Args:
-            isin: Código ISIN
-            fecha: Fecha de valoración (opcional, usa la más reciente si no se especifica)
+            isins: Códigos ISIN
+            fecha: Fecha de valoración (opcional)
         
         Returns:
-            Diccionario con comparación de proveedores
+            Diccionario {isin: {"fecha": fecha, Provider.PIP_LATAM: Valuation, Provider.PRECIA: Valuation}};
+            los ISINs sin valoraciones no aparecen
         """
-        if not fecha:
-            # Obtener fecha más reciente disponible
-            latest = self.db.query(Valuation.fecha).filter(
-                Valuation.isin == isin
-            ).order_by(Valuation.fecha.desc()).first()
-            
-            if not latest:
-                return {"error": "No se encontraron valoraciones para este ISIN"}
-            
-            fecha = latest[0]
-        
-        # Obtener valoraciones de ambos proveedores
-        pip_latam = self.db.query(Valuation).filter(
-            and_(
-                Valuation.isin == isin,
-                Valuation.fecha == fecha,
-                Valuation.proveedor == Provider.PIP_LATAM
-            )
-        ).first()
+        rows_by_isin: Dict[str, Dict] = {}
+        isins = list(dict.fromkeys(isins))
         
-        precia = self.db.query(Valuation).filter(
-            and_(
-                Valuation.isin == isin,
-                Valuation.fecha == fecha,
-                Valuation.proveedor == Provider.PRECIA
-            )
-        ).first()
+        # Lotes para no exceder el límite de parámetros del driver (un lote = una consulta)
+        for start in range(0, len(isins), self.BATCH_IN_SIZE):
+            chunk = isins[start:start + self.BATCH_IN_SIZE]
+            if fecha:
+                query_builder = self.db.query(Valuation).filter(
+                    Valuation.isin.in_(chunk),
+                    Valuation.fecha == fecha
+                )
+            else:
+                latest = self.db.query(
+                    Valuation.isin.label("isin"),
+                    func.max(Valuation.fecha).label("fecha")
+                ).filter(Valuation.isin.in_(chunk)).group_by(Valuation.isin).subquery()
+                # Fechas en que todos los proveedores tienen valoración del ISIN
+                common_dates = self.db.query(
+                    Valuation.isin.label("isin"),
+                    Valuation.fecha.label("fecha")
+                ).filter(Valuation.isin.in_(chunk)).group_by(Valuation.isin, Valuation.fecha).having(
+                    func.count(func.distinct(Valuation.proveedor)) == len(Provider)
+                ).subquery()
+                latest_common = self.db.query(
+                    common_dates.c.isin.label("isin"),
+                    func.max(common_dates.c.fecha).label("fecha")
+                ).group_by(common_dates.c.isin).subquery()
+                target = self.db.query(
+                    latest.c.isin.label("isin"),
+                    func.coalesce(latest_common.c.fecha, latest.c.fecha).label("fecha")
+                ).outerjoin(latest_common, latest_common.c.isin == latest.c.isin).subquery()
+                query_builder = self.db.query(Valuation).join(
+                    target,
+                    and_(Valuation.isin == target.c.isin, Valuation.fecha == target.c.fecha)
+                )
+            
+            for valuation in query_builder.all():
+                entry = rows_by_isin.setdefault(valuation.isin, {"fecha": valuation.fecha})
+                entry.setdefault(valuation.proveedor, valuation)
         
+        return rows_by_isin
+    
+    def _build_comparison(self, isin: str, fecha: Optional[date],
+                          pip_latam: Optional[Valuation], precia: Optional[Valuation]) -> Dict:
+        """Arma el diccionario de comparación a partir de las valoraciones de cada proveedor"""
         comparison = {
             "isin": isin,
             "fecha": fecha,
@@ -924,43 +1110,11 @@ class QueryService:
         
         return comparison
     
-    def get_missing_data(self, isin: str, fecha: Optional[date] = None) -> List[str]:
-        """
-        Identifica datos faltantes o inconsistentes
-        
-        Args:
-            isin: Código ISIN
-            fecha: Fecha de valoración (opcional)
-        
-        Returns:
-            Lista de alertas sobre datos faltantes
-        """
+    def _build_missing_alerts(self, isin: str, fecha: date,
+                              pip_latam: Optional[Valuation], precia: Optional[Valuation]) -> List[str]:
+        """Alertas de datos faltantes a partir de las valoraciones de cada proveedor"""
         alerts = []
         
-        if not fecha:
-            latest = self.get_latest_valuation(isin)
-            if not latest:
-                alerts.append(f"No se encontraron valoraciones para ISIN {isin}")
-                return alerts
-            fecha = latest.fecha
-        
-        # Verificar ambos proveedores
-        pip_latam = self.db.query(Valuation).filter(
-            and_(
-                Valuation.isin == isin,
-                Valuation.fecha == fecha,
-                Valuation.proveedor == Provider.PIP_LATAM
-            )
-        ).first()
-        
-        precia = self.db.query(Valuation).filter(
-            and_(
-                Valuation.isin == isin,
-                Valuation.fecha == fecha,
-                Valuation.proveedor == Provider.PRECIA
-            )
-        ).first()
-        
         if not pip_latam:
             alerts.append(f"No se encontró valoración en PIP Latam para ISIN {isin} en fecha {fecha}")
         
@@ -976,9 +1130,258 @@ class QueryService:
                     alerts.append(f"Tasa faltante en {provider_name} para ISIN {isin}")
         
         return alerts
-
-
-
-
-
-
+    
+    def compare_providers(self, isin: str, fecha: Optional[date] = None) -> Dict:
+        """
+        Compara valoraciones entre proveedores para un ISIN
+        
+        Args:
+            isin: Código ISIN
+            fecha: Fecha de valoración (opcional, usa la más reciente común a ambos proveedores si no se especifica)
+        
+        Returns:
+            Diccionario con comparación de proveedores
+        """
+        entry = self._provider_rows([isin], fecha).get(isin)
+        
+        if not entry:
+            if not fecha:
+                return {"error": "No se encontraron valoraciones para este ISIN"}
+            return self._build_comparison(isin, fecha, None, None)
+        
+        return self._build_comparison(
+            isin, entry["fecha"], entry.get(Provider.PIP_LATAM), entry.get(Provider.PRECIA)
+        )
+    
+    def compare_providers_batch(self, isins: List[str], fecha: Optional[date] = None) -> Dict[str, Dict]:
+        """
+        Compara proveedores para una lista de ISINs con una consulta por lote
+        
+        Args:
+            isins: Códigos ISIN (ej: un portafolio)
+            fecha: Fecha de valoración (opcional, usa la más reciente común a ambos proveedores de cada ISIN)
+        
+        Returns:
+            Diccionario {isin: comparación}; los ISINs sin valoraciones traen "error"
+        """
+        rows_by_isin = self._provider_rows(isins, fecha)
+        comparisons = {}
+        for isin in dict.fromkeys(isins):
+            entry = rows_by_isin.get(isin)
+            if entry:
+                comparisons[isin] = self._build_comparison(
+                    isin, entry["fecha"], entry.get(Provider.PIP_LATAM), entry.get(Provider.PRECIA)
+                )
+            elif fecha:
+                comparisons[isin] = self._build_comparison(isin, fecha, None, None)
+            else:
+                comparisons[isin] = {"isin": isin, "error": "No se encontraron valoraciones para este ISIN"}
+        return comparisons
+    
+    def get_missing_data(self, isin: str, fecha: Optional[date] = None) -> List[str]:
+        """
+        Identifica datos faltantes o inconsistentes
+        
+        Args:
+            isin: Código ISIN
+            fecha: Fecha de valoración (opcional)
+        
+        Returns:
+            Lista de alertas sobre datos faltantes
+        """
+        return self.get_missing_data_batch([isin], fecha)[isin]
+    
+    def get_missing_data_batch(self, isins: List[str], fecha: Optional[date] = None) -> Dict[str, List[str]]:
+        """
+        Identifica datos faltantes para una lista de ISINs con una consulta por lote
+        
+        Args:
+            isins: Códigos ISIN
+            fecha: Fecha de valoración (opcional, usa la más reciente común a ambos proveedores de cada ISIN)
+        
+        Returns:
+            Diccionario {isin: lista de alertas}
+        """
+        rows_by_isin = self._provider_rows(isins, fecha)
+        alerts_by_isin = {}
+        for isin in dict.fromkeys(isins):
+            entry = rows_by_isin.get(isin)
+            if entry:
+                alerts_by_isin[isin] = self._build_missing_alerts(
+                    isin, entry["fecha"], entry.get(Provider.PIP_LATAM), entry.get(Provider.PRECIA)
+                )
+            elif fecha:
+                alerts_by_isin[isin] = self._build_missing_alerts(isin, fecha, None, None)
+            else:
+                alerts_by_isin[isin] = [f"No se encontraron valoraciones para ISIN {isin}"]
+        return alerts_by_isin
+    
+    # Métricas comparadas en la conciliación por lote
+    COMPARE_METRICS = ["precio_limpio", "tasa", "duracion"]
+    
+    def compare_providers_frame(self, isins: List[str], fecha_inicio: Optional[date] = None,
+                                fecha_fin: Optional[date] = None) -> pd.DataFrame:
+        """
+        Tabla de comparación PIP_LATAM vs PRECIA para muchos ISINs, calculada con pandas
+        
+        Sin rango de fechas usa la fecha más reciente de cada ISIN; con rango,
+        compara cada (isin, fecha) dentro del rango. Lee solo las columnas necesarias
+        (sin objetos ORM) y calcula todas las diferencias por columnas.
+        
+        Returns:
+            DataFrame con isin, fecha, <métrica>_pip, <métrica>_precia y diff_<métrica> (PRECIA - PIP)
+        """
+        isins = list(dict.fromkeys(i.strip().upper() for i in isins if i and i.strip()))
+        columns = [Valuation.isin, Valuation.fecha, Valuation.proveedor] + \
+                  [getattr(Valuation, metric) for metric in self.COMPARE_METRICS]
+        
+        rows = []
+        for start in range(0, len(isins), self.BATCH_IN_SIZE):
+            chunk = isins[start:start + self.BATCH_IN_SIZE]
+            query_builder = self.db.query(*columns).filter(Valuation.isin.in_(chunk))
+            if fecha_inicio or fecha_fin:
+                if fecha_inicio:
+                    query_builder = query_builder.filter(Valuation.fecha >= fecha_inicio)
+                if fecha_fin:
+                    query_builder = query_builder.filter(Valuation.fecha <= fecha_fin)
+            else:
+                latest = self.db.query(
+                    Valuation.isin.label("isin"),
+                    func.max(Valuation.fecha).label("fecha")
+                ).filter(Valuation.isin.in_(chunk)).group_by(Valuation.isin).subquery()
+                query_builder = query_builder.join(
+                    latest,
+                    and_(Valuation.isin == latest.c.isin, Valuation.fecha == latest.c.fecha)
+                )
+            rows.extend(query_builder.all())
+        
+        metric_columns = [f"{metric}_{suffix}" for metric in self.COMPARE_METRICS for suffix in ("pip", "precia")]
+        if not rows:
+            return pd.DataFrame(columns=["isin", "fecha"] + metric_columns +
+                                [f"diff_{metric}" for metric in self.COMPARE_METRICS] + ["en_pip", "en_precia"])
+        
+        df = pd.DataFrame(rows, columns=["isin", "fecha", "proveedor"] + self.COMPARE_METRICS)
+        df["proveedor"] = df["proveedor"].map(lambda p: "pip" if p == Provider.PIP_LATAM else "precia")
+        # Solo los (isin, fecha) que existen: pivot_table con dropna=False crearía el producto isin × fecha
+        wide = df.groupby(["isin", "fecha", "proveedor"])[self.COMPARE_METRICS].first().unstack("proveedor")
+        wide.columns = [f"{metric}_{suffix}" for metric, suffix in wide.columns]
+        wide = wide.reindex(columns=metric_columns)
+        
+        for metric in self.COMPARE_METRICS:
+            wide[f"diff_{metric}"] = wide[f"{metric}_precia"] - wide[f"{metric}_pip"]
+        
+        # Qué proveedores tienen valoración en cada (isin, fecha)
+        presence = df.groupby(["isin", "fecha"])["proveedor"].agg(set)
+        wide["en_pip"] = presence.map(lambda p: "pip" in p).reindex(wide.index).fillna(False).astype(bool)
+        wide["en_precia"] = presence.map(lambda p: "precia" in p).reindex(wide.index).fillna(False).astype(bool)
+        
+        return wide.reset_index().sort_values(["isin", "fecha"], ignore_index=True)
+    
+    def summarize_comparison(self, comparison: pd.DataFrame, requested_isins: List[str],
+                             umbrales: Optional[Dict[str, float]] = None) -> Dict:
+        """
+        Estadísticas agregadas de una tabla de compare_providers_frame
+        
+        Returns:
+            Diccionario con conteos de cobertura y, por métrica, media y máximo de la
+            diferencia absoluta y cuántas comparaciones superan el umbral
+        """
+        umbrales = umbrales or {}
+        requested = set(i.strip().upper() for i in requested_isins if i and i.strip())
+        en_pip = comparison["en_pip"].fillna(False).astype(bool)
+        en_precia = comparison["en_precia"].fillna(False).astype(bool)
+        
+        summary = {
+            "isins_solicitados": len(requested),
+            "isins_encontrados": int(comparison["isin"].nunique()),
+            "isins_sin_datos": len(requested - set(comparison["isin"])),
+            "comparaciones": int(len(comparison)),
+            "con_ambos_proveedores": int((en_pip & en_precia).sum()),
+            "solo_pip_latam": int((en_pip & ~en_precia).sum()),
+            "solo_precia": int((en_precia & ~en_pip).sum()),
+            "metricas": {}
+        }
+        
+        for metric in self.COMPARE_METRICS:
+            abs_diff = comparison[f"diff_{metric}"].astype("float64").abs()
+            umbral = umbrales.get(metric)
+            summary["metricas"][metric] = {
+                "comparadas": int(abs_diff.notna().sum()),
+                "media_diferencia_abs": float(abs_diff.mean()) if abs_diff.notna().any() else None,
+                "max_diferencia_abs": float(abs_diff.max()) if abs_diff.notna().any() else None,
+                "umbral": umbral,
+                "sobre_umbral": int((abs_diff > umbral).sum()) if umbral is not None else None
+            }
+        
+        return summary
+    
+    def get_series(self, isin: str, fecha_inicio: Optional[date] = None, fecha_fin: Optional[date] = None,
+                   frecuencia: Optional[str] = None, agregacion: str = "ultimo") -> Dict:
+        """
+        Historia de un ISIN en arreglos por columna, separada por proveedor
+        
+        Args:
+            isin: Código ISIN
+            fecha_inicio / fecha_fin: Rango opcional (inclusive)
+            frecuencia: None (diaria, sin remuestreo), "semanal" o "mensual"
+            agregacion: Valor por periodo al remuestrear: "ultimo" o "promedio"
+            
+        Returns:
+            Diccionario con proveedores -> {fechas, precio_limpio, tasa, duracion}
+        """
+        if frecuencia is not None and frecuencia not in self.SERIES_FREQUENCIES:
+            raise ValueError(f"Frecuencia no soportada: {frecuencia} (use {', '.join(self.SERIES_FREQUENCIES)})")
+        if agregacion not in self.SERIES_AGGREGATIONS:
+            raise ValueError(f"Agregación no soportada: {agregacion} (use {', '.join(self.SERIES_AGGREGATIONS)})")
+        
+        isin = isin.strip().upper()
+        key = (isin, fecha_inicio, fecha_fin, frecuencia, agregacion if frecuencia else None)
+        
+        with _series_lock:
+            cached = _series_cache.get(key)
+            if cached and time.monotonic() - cached["loaded_at"] < settings.series_cache_ttl:
+                _series_cache.move_to_end(key)
+                return cached["series"]
+        
+        # Solo las columnas de la serie, en el orden del índice (isin, fecha) y sin objetos ORM
+        query_builder = self.db.query(
+            Valuation.proveedor, Valuation.fecha,
+            *[getattr(Valuation, metric) for metric in self.SERIES_METRICS]
+        ).filter(Valuation.isin == isin)
+        if fecha_inicio:
+            query_builder = query_builder.filter(Valuation.fecha >= fecha_inicio)
+        if fecha_fin:
+            query_builder = query_builder.filter(Valuation.fecha <= fecha_fin)
+        rows = query_builder.order_by(Valuation.proveedor, Valuation.fecha).all()
+        
+        df = pd.DataFrame(rows, columns=["proveedor", "fecha"] + self.SERIES_METRICS)
+        proveedores = {}
+        for provider, group in df.groupby("proveedor", sort=False):
+            group = group.set_index(pd.to_datetime(group["fecha"]))[self.SERIES_METRICS].astype("float64")
+            if frecuencia:
+                resampled = group.resample(self.SERIES_FREQUENCIES[frecuencia])
+                group = getattr(resampled, self.SERIES_AGGREGATIONS[agregacion])().dropna(how="all")
+            # NaN no es JSON válido: los huecos se devuelven como null
+            group = group.astype(object).where(group.notna(), None)
+            provider_name = provider.value if isinstance(provider, Provider) else str(provider)
+            proveedores[provider_name] = {
+                "fechas": [d.date().isoformat() for d in group.index],
+                **{metric: group[metric].tolist() for metric in self.SERIES_METRICS}
+            }
+        
+        series = {
+            "isin": isin,
+            "fecha_inicio": fecha_inicio.isoformat() if fecha_inicio else None,
+            "fecha_fin": fecha_fin.isoformat() if fecha_fin else None,
+            "frecuencia": frecuencia or "diaria",
+            "agregacion": agregacion if frecuencia else None,
+            "proveedores": proveedores
+        }
+        
+        with _series_lock:
+            _series_cache[key] = {"series": series, "loaded_at": time.monotonic()}
+            _series_cache.move_to_end(key)
+            while len(_series_cache) > settings.series_cache_max_entries:
+                _series_cache.popitem(last=False)
+        
+        return series
@@ -0,0 +1,153 @@
+"""
+Formatos de respuesta por columnas para extracciones grandes de valoraciones
+(JSON columnar, Apache Arrow IPC y Parquet) construidos directamente desde un DataFrame
+"""
+from typing import Optional
+from datetime import date, datetime
+import io
+import json
+import logging
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    ARROW_AVAILABLE = True
+except ImportError:
+    ARROW_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Formato -> media type de la respuesta
+MEDIA_TYPES = {
+    "json": "application/json",
+    "columnar": "application/json",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+# Media types aceptados en el header Accept -> formato
+ACCEPT_FORMATS = {
+    "application/vnd.apache.arrow.stream": "arrow",
+    "application/vnd.apache.arrow.file": "arrow",
+    "application/vnd.apache.parquet": "parquet",
+    "application/x-parquet": "parquet",
+}
+
+# Extensión de archivo por formato (Content-Disposition)
+FILE_EXTENSIONS = {"arrow": "arrows", "parquet": "parquet"}
+
+
+def negotiate_format(formato: Optional[str] = None, accept: Optional[str] = None) -> str:
+    """
+    Resuelve el formato de respuesta: el parámetro explícito tiene prioridad sobre el header Accept
+
+    Raises:
+        ValueError: si el formato no existe o requiere pyarrow y no está instalado
+    """
+    if formato:
+        formato = formato.strip().lower()
+        if formato not in MEDIA_TYPES:
+            raise ValueError(f"Formato no soportado: {formato} (use {', '.join(MEDIA_TYPES)})")
+    else:
+        formato = "json"
+        for media_type in (accept or "").split(","):
+            media_type = media_type.split(";")[0].strip().lower()
+            if media_type in ACCEPT_FORMATS:
+                formato = ACCEPT_FORMATS[media_type]
+                break
+
+    if formato in ("arrow", "parquet") and not ARROW_AVAILABLE:
+        raise ValueError(f"El formato {formato} requiere pyarrow. Instala con: pip install pyarrow")
+    return formato
+
+
+def _json_safe(df: pd.DataFrame) -> pd.DataFrame:
+    """Fechas a ISO 8601 y NaN/NaT a None para serializar con json"""
+    df = df.copy()
+    for column in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = df[column].dt.strftime("%Y-%m-%dT%H:%M:%S")
+        elif df[column].dtype == object:
+            df[column] = df[column].map(lambda v: v.isoformat() if isinstance(v, (date, datetime)) else v)
+    return df.astype(object).where(df.notna(), None)
+
+
+def to_columnar_json(df: pd.DataFrame) -> bytes:
+    """JSON por columnas: {"columns": [...], "rows": n, "data": {columna: [valores]}}"""
+    safe = _json_safe(df)
+    payload = {
+        "columns": list(safe.columns),
+        "rows": len(safe),
+        "data": {column: safe[column].tolist() for column in safe.columns},
+    }
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+
+def arrow_schema(table) -> "pa.Schema":
+    """
+    Esquema Arrow desde una tabla de SQLAlchemy
+
+    Con el esquema explícito las columnas sin valores en el resultado mantienen
+    su tipo (en lugar de null), y dos extracciones del mismo filtro son compatibles.
+    """
+    fields = []
+    for column in table.columns:
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            python_type = str
+        if python_type is bool:
+            arrow_type = pa.bool_()
+        elif python_type is int:
+            arrow_type = pa.int64()
+        elif python_type is float:
+            arrow_type = pa.float64()
+        elif python_type is datetime:
+            arrow_type = pa.timestamp("us")
+        elif python_type is date:
+            arrow_type = pa.date32()
+        else:
+            arrow_type = pa.string()  # String y Enum (el proveedor se serializa por su valor)
+        fields.append(pa.field(column.name, arrow_type))
+    return pa.schema(fields)
+
+
+def to_arrow_table(df: pd.DataFrame, schema: Optional["pa.Schema"] = None) -> "pa.Table":
+    """Tabla Arrow desde el DataFrame (sin esquema, los tipos se infieren de los valores)"""
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+
+def to_arrow_ipc(df: pd.DataFrame, schema: Optional["pa.Schema"] = None) -> bytes:
+    """Serializa en formato Arrow IPC (stream), legible con pyarrow.ipc.open_stream o pandas"""
+    table = to_arrow_table(df, schema)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def to_parquet(df: pd.DataFrame, schema: Optional["pa.Schema"] = None) -> bytes:
+    """Serializa en Parquet (comprimido con snappy)"""
+    buffer = io.BytesIO()
+    pq.write_table(to_arrow_table(df, schema), buffer, compression="snappy")
+    return buffer.getvalue()
+
+
+def render(df: pd.DataFrame, formato: str, table=None) -> bytes:
+    """
+    Serializa el DataFrame en el formato por columnas indicado
+
+    Args:
+        df: Resultado de la consulta
+        formato: columnar, arrow o parquet
+        table: Tabla de SQLAlchemy de la que salen las columnas (para tipar Arrow/Parquet)
+    """
+    if formato == "columnar":
+        return to_columnar_json(df)
+    schema = arrow_schema(table) if table is not None else None
+    if formato == "arrow":
+        return to_arrow_ipc(df, schema)
+    if formato == "parquet":
+        return to_parquet(df, schema)
+    raise ValueError(f"Formato sin serializador por columnas: {formato}")
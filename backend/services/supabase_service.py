@@ -3,19 +3,199 @@ Servicio para integración con Supabase usando API REST
 Lee archivos de valoración almacenados en las tablas BD_PIP y BD_Precia
 """
 import httpx
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple, Iterator
 from config import settings
 import logging
 import pandas as pd
-from datetime import datetime
 import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 logger = logging.getLogger(__name__)
 
+# HTTP/2 requiere el paquete h2 (pip install httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Pool de clientes HTTP compartido por todo el proceso, indexado por URL base
+# Reutiliza conexiones TCP/TLS entre peticiones e instancias de SupabaseService
+_http_clients: Dict[str, httpx.Client] = {}
+_http_stats: Dict[str, Dict[str, int]] = {}
+_http_lock = threading.Lock()
+
+
+def _make_trace(base_url: str):
+    """Crea un callback de trazas de httpcore que cuenta conexiones nuevas por URL base"""
+    def trace(event_name: str, info: Dict):
+        if event_name == "connection.connect_tcp.complete":
+            with _http_lock:
+                _http_stats[base_url]["connections_opened"] += 1
+    return trace
+
+
+def get_http_client(base_url: str) -> httpx.Client:
+    """
+    Obtiene el cliente HTTP compartido para una URL base, creándolo si no existe
+
+    Args:
+        base_url: URL del proyecto Supabase
+
+    Returns:
+        Cliente httpx con keep-alive y límites de conexión configurados
+    """
+    base_url = base_url.rstrip('/')
+    with _http_lock:
+        client = _http_clients.get(base_url)
+        if client is None or client.is_closed:
+            use_http2 = settings.supabase_http2 and HTTP2_AVAILABLE
+            if settings.supabase_http2 and not HTTP2_AVAILABLE:
+                logger.warning("SUPABASE_HTTP2 activo pero el paquete h2 no está instalado. Usando HTTP/1.1")
+            limits = httpx.Limits(
+                max_connections=settings.supabase_max_connections,
+                max_keepalive_connections=settings.supabase_max_keepalive_connections,
+                keepalive_expiry=settings.supabase_keepalive_expiry
+            )
+            client = httpx.Client(
+                timeout=settings.supabase_timeout,
+                limits=limits,
+                http2=use_http2
+            )
+            _http_clients[base_url] = client
+            _http_stats[base_url] = {"requests": 0, "errors": 0, "connections_opened": 0}
+            logger.info(f"Cliente HTTP compartido creado para {base_url} (http2={use_http2})")
+        return client
+
+
+def _send(base_url: str, method: str, url: str, **kwargs) -> httpx.Response:
+    """Envía una petición por el cliente compartido registrando estadísticas del pool"""
+    base_url = base_url.rstrip('/')
+    client = get_http_client(base_url)
+    try:
+        response = client.request(method, url, extensions={"trace": _make_trace(base_url)}, **kwargs)
+    except Exception:
+        with _http_lock:
+            _http_stats[base_url]["errors"] += 1
+        raise
+    with _http_lock:
+        _http_stats[base_url]["requests"] += 1
+    return response
+
+
+def get_http_pool_stats() -> Dict[str, Dict]:
+    """
+    Estadísticas de reutilización de conexiones por URL base
+
+    Returns:
+        Diccionario {base_url: {requests, errors, connections_opened, open_connections, reuse_ratio}}
+    """
+    stats = {}
+    with _http_lock:
+        for base_url, client in _http_clients.items():
+            counters = dict(_http_stats.get(base_url, {}))
+            # El pool de httpcore no expone estadísticas públicas; se lee de forma defensiva
+            pool = getattr(getattr(client, "_transport", None), "_pool", None)
+            connections = getattr(pool, "connections", None)
+            counters["open_connections"] = len(connections) if connections is not None else None
+            requests_count = counters.get("requests", 0)
+            opened = counters.get("connections_opened", 0)
+            counters["reuse_ratio"] = round(1 - opened / requests_count, 4) if requests_count else None
+            counters["closed"] = client.is_closed
+            stats[base_url] = counters
+    return stats
+
+
+def close_http_clients():
+    """Cierra todos los clientes HTTP compartidos (llamar al apagar la aplicación)"""
+    with _http_lock:
+        for base_url, client in _http_clients.items():
+            try:
+                client.close()
+                logger.info(f"Cliente HTTP compartido cerrado para {base_url}")
+            except Exception as e:
+                logger.warning(f"Error cerrando cliente HTTP de {base_url}: {str(e)}")
+        _http_clients.clear()
+        _http_stats.clear()
+
+
+# Pool para descargar páginas en paralelo (separado del pool de proveedores para no bloquearse entre sí)
+_page_executor = ThreadPoolExecutor(
+    max_workers=settings.supabase_page_workers * 2,
+    thread_name_prefix="supabase-page"
+)
+
+
+# Caché de esquema por tabla compartida por el proceso
+# Clave: "{base_url}/{tabla}", Valor: dict con columns, resolved y loaded_at
+_schema_cache: Dict[str, Dict] = {}
+_openapi_unavailable: Dict[str, float] = {}  # base_url -> momento en que la raíz OpenAPI falló
+_schema_lock = threading.Lock()
+
+
+def invalidate_schema_cache(table_name: Optional[str] = None):
+    """
+    Invalida la caché de columnas
+
+    Args:
+        table_name: Tabla a invalidar (si es None, invalida todas)
+    """
+    with _schema_lock:
+        if table_name is None:
+            _schema_cache.clear()
+        else:
+            for key in [k for k in _schema_cache if k.endswith(f"/{table_name}")]:
+                del _schema_cache[key]
+    logger.info(f"Caché de esquema invalidada: {table_name or 'todas las tablas'}")
+
+
+# Caché del listado de archivos por tabla (agrupado en la base de datos)
+# Clave: "{base_url}/{tabla}", Valor: dict con files, signature y loaded_at
+_file_list_cache: Dict[str, Dict] = {}
+_file_list_strategy: Dict[str, str] = {}  # estrategia de listado que funcionó por tabla
+# Última firma consultada por tabla (dict con signature y checked_at), para no sondear en cada listado
+_file_list_signatures: Dict[str, Dict] = {}
+_file_list_lock = threading.Lock()
+
+
+def invalidate_file_list_cache(table_name: Optional[str] = None):
+    """
+    Invalida la caché del listado de archivos
+
+    Args:
+        table_name: Tabla a invalidar; si es None se limpia toda la caché
+    """
+    with _file_list_lock:
+        if table_name is None:
+            _file_list_cache.clear()
+            _file_list_signatures.clear()
+        else:
+            for cache in (_file_list_cache, _file_list_signatures):
+                for key in [k for k in cache if k.endswith(f"/{table_name}")]:
+                    del cache[key]
+
 
 class SupabaseService:
     """Servicio para interactuar con Supabase usando API REST"""
     
+    # Variaciones de nombres de columna por rol, en orden de prioridad
+    # Se resuelven una sola vez por tabla y se guardan junto al esquema en caché
+    COLUMN_CANDIDATES = {
+        "archivo": ["TIPO_ARCHIVO", "tipo_archivo", "archivo_origen", "archivo", "file_name", "nombre_archivo"],
+        "proveedor": ["FUENTE", "fuente", "proveedor", "provider", "PROVEEDOR"],
+        "fecha": ["FECHA_VALORACION", "fecha_valoracion", "fecha", "date", "valuation_date", "FECHA"],
+        "timestamp": ["created_at", "CREATED_AT", "timestamp_ingesta", "timestamp", "upload_date", "fecha_ingesta"],
+        "isin": ["ISIN", "isin", "ISIN_CODIGO", "codigo_isin"],
+        "nemotecnico": ["NEMOTECNICO", "nemotecnico", "Nemotecnico", "NEMOTÉCNICO", "nemotécnico"],
+        "emisor": ["EMISION", "emisor", "EMISOR", "EMISOR_NOMBRE"],
+        "tipo_instrumento": ["TIPO_ACTIVO", "tipo_instrumento", "TIPO_INSTRUMENTO", "TIPO"],
+        "vencimiento": ["VENCIMIENTO", "vencimiento", "FECHA_VENCIMIENTO", "fecha_vencimiento", "VENCIMIENTO_FECHA"],
+        "cupon": ["TASA_FACIAL", "tasa_facial", "cupon", "CUPON", "TASA", "tasa"],
+    }
+    
     def __init__(self, api_key: Optional[str] = None, access_token: Optional[str] = None):
         """
         Inicializa la conexión con Supabase usando API REST
@@ -104,18 +284,17 @@ class SupabaseService:
         }
         
         try:
-            with httpx.Client(timeout=30.0) as client:
-                response = client.post(auth_url, headers=headers, json=data)
-                response.raise_for_status()
-                result = response.json()
-                
-                return {
-                    "success": True,
-                    "access_token": result.get("access_token"),
-                    "refresh_token": result.get("refresh_token"),
-                    "expires_in": result.get("expires_in"),
-                    "user": result.get("user")
-                }
+            response = _send(base_url, "POST", auth_url, headers=headers, json=data)
+            response.raise_for_status()
+            result = response.json()
+            
+            return {
+                "success": True,
+                "access_token": result.get("access_token"),
+                "refresh_token": result.get("refresh_token"),
+                "expires_in": result.get("expires_in"),
+                "user": result.get("user")
+            }
         except httpx.HTTPStatusError as e:
             logger.error(f"Error de autenticación: {e.response.status_code} - {e.response.text}")
             if e.response.status_code == 400:
@@ -154,43 +333,549 @@ class SupabaseService:
         url = f"{self.api_url}/{table}"
         
         try:
-            with httpx.Client(timeout=30.0) as client:
-                if method == "GET":
-                    response = client.get(url, headers=self.headers, params=params)
-                elif method == "POST":
-                    response = client.post(url, headers=self.headers, json=data, params=params)
-                else:
-                    raise ValueError(f"Método HTTP no soportado: {method}")
-                
-                response.raise_for_status()
-                return response.json() if response.content else {}
+            if method == "GET":
+                response = _send(self.base_url, "GET", url, headers=self.headers, params=params)
+            elif method == "POST":
+                response = _send(self.base_url, "POST", url, headers=self.headers, json=data, params=params)
+            else:
+                raise ValueError(f"Método HTTP no soportado: {method}")
+            
+            response.raise_for_status()
+            return response.json() if response.content else {}
         except httpx.HTTPStatusError as e:
-            logger.error(f"Error HTTP {e.response.status_code}: {e.response.text}")
-            raise Exception(f"Error en petición a Supabase: {e.response.status_code}")
+            self._raise_http_error(e, table)
         except Exception as e:
             logger.error(f"Error en petición a Supabase: {str(e)}")
             raise
     
+    def _raise_http_error(self, e: httpx.HTTPStatusError, table: str):
+        """Registra un error HTTP de PostgREST y lo relanza con un mensaje uniforme"""
+        logger.error(f"Error HTTP {e.response.status_code}: {e.response.text}")
+        # PostgREST responde 42703 cuando una columna no existe: el esquema en caché quedó obsoleto
+        if "does not exist" in e.response.text or "42703" in e.response.text:
+            invalidate_schema_cache(table)
+            raise Exception(f"Error en petición a Supabase: {e.response.status_code} - column does not exist")
+        raise Exception(f"Error en petición a Supabase: {e.response.status_code}")
+    
+    def _get_page(self, table: str, params: Dict, offset: int, limit: int,
+                  count: bool = False) -> Tuple[List[Dict], Optional[int]]:
+        """
+        Obtiene una página de una tabla usando el header Range de PostgREST
+        
+        Args:
+            table: Nombre de la tabla
+            params: Parámetros de consulta (filtros, select, order)
+            offset: Primera fila de la página
+            limit: Cantidad de filas solicitadas
+            count: Si es True, pide el total con Prefer: count=exact
+        
+        Returns:
+            Tupla (filas, total); total es None si no se pidió o el servidor no lo informó
+        """
+        url = f"{self.api_url}/{table}"
+        headers = dict(self.headers)
+        headers["Range-Unit"] = "items"
+        headers["Range"] = f"{offset}-{offset + limit - 1}"
+        if count:
+            headers["Prefer"] = "count=exact"
+        
+        try:
+            response = _send(self.base_url, "GET", url, headers=headers, params=params)
+            response.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            # 416: el offset quedó fuera del rango (la tabla se achicó entre peticiones)
+            if e.response.status_code == 416:
+                return [], None
+            self._raise_http_error(e, table)
+        
+        rows = response.json() if response.content else []
+        if not isinstance(rows, list):
+            rows = [rows]
+        
+        # Content-Range: "0-999/12345" (o "*/0" si no hay filas, "0-999/*" si no se pidió conteo)
+        total = None
+        content_range = response.headers.get("Content-Range", "")
+        if "/" in content_range:
+            total_str = content_range.rsplit("/", 1)[1]
+            if total_str.isdigit():
+                total = int(total_str)
+        return rows, total
+    
+    def fetch_all(self, table: str, params: Optional[Dict] = None,
+                  page_size: Optional[int] = None) -> List[Dict]:
+        """
+        Obtiene TODAS las filas que cumplen los filtros, sin tope silencioso
+        
+        La primera página pide el total exacto (Prefer: count=exact + Content-Range) y
+        el resto de rangos se descargan en paralelo con una ventana acotada
+        (SUPABASE_PAGE_WORKERS). Si el servidor limita las filas por respuesta (max-rows),
+        el tamaño de página se ajusta al que devolvió la primera página.
+        
+        Args:
+            table: Nombre de la tabla
+            params: Parámetros PostgREST (select, filtros, order); limit/offset se ignoran
+            page_size: Filas por página (por defecto SUPABASE_PAGE_SIZE)
+        
+        Returns:
+            Lista de filas en el orden de la consulta
+        """
+        params = {k: v for k, v in (params or {}).items() if k not in ("limit", "offset")}
+        params.setdefault("select", "*")
+        page_size = page_size or settings.supabase_page_size
+        
+        # Sin orden explícito las páginas podrían solaparse: ordenar por id si existe
+        if "order" not in params and "id" in self._get_available_columns(table):
+            params["order"] = "id.asc"
+        
+        first_page, total = self._get_page(table, params, 0, page_size, count=True)
+        
+        if total is None:
+            # El servidor no informó el total: continuar secuencialmente hasta una página corta
+            logger.warning(f"Supabase no devolvió el total de {table}; paginando secuencialmente")
+            all_rows = list(first_page)
+            page = first_page
+            page_size = len(first_page) or page_size
+            while page and len(page) >= page_size:
+                page, _ = self._get_page(table, params, len(all_rows), page_size)
+                all_rows.extend(page)
+            return all_rows
+        
+        if len(first_page) >= total:
+            return first_page
+        
+        # max-rows del servidor puede devolver menos filas que las pedidas
+        page_size = min(page_size, len(first_page)) or page_size
+        offsets = list(range(len(first_page), total, page_size))
+        logger.info(f"📊 {table}: {total} registros en total, descargando {len(offsets)} páginas adicionales de {page_size}")
+        
+        pages = {0: first_page}
+        in_flight = {}  # future -> offset
+        next_index = 0
+        window = max(1, settings.supabase_page_workers)
+        while next_index < len(offsets) or in_flight:
+            # Mantener a lo sumo `window` páginas en vuelo
+            while next_index < len(offsets) and len(in_flight) < window:
+                offset = offsets[next_index]
+                in_flight[_page_executor.submit(self._get_page, table, params, offset, page_size)] = offset
+                next_index += 1
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                pages[in_flight.pop(future)] = future.result()[0]
+        
+        all_rows = []
+        for offset in sorted(pages):
+            all_rows.extend(pages[offset])
+        
+        if len(all_rows) != total:
+            logger.warning(f"⚠️ {table}: se esperaban {total} registros y se obtuvieron {len(all_rows)} (la tabla cambió durante la descarga)")
+        return all_rows
+    
+    def _load_schema_from_openapi(self) -> Dict[str, List[str]]:
+        """
+        Obtiene las columnas de todas las tablas desde la raíz OpenAPI de PostgREST
+        
+        Returns:
+            Diccionario {tabla: [columnas]} (vacío si la raíz no está disponible)
+        """
+        try:
+            response = _send(self.base_url, "GET", f"{self.api_url}/", headers=self.headers)
+            response.raise_for_status()
+            definitions = response.json().get("definitions", {})
+            return {
+                table: list(definition.get("properties", {}).keys())
+                for table, definition in definitions.items()
+            }
+        except Exception as e:
+            logger.debug(f"No se pudo leer el esquema OpenAPI de Supabase: {str(e)}")
+            return {}
+    
+    def _cache_schema(self, table_name: str, columns: List[str]):
+        """Guarda en caché las columnas de una tabla y resuelve sus candidatos una sola vez"""
+        resolved = {}
+        for role, candidates in self.COLUMN_CANDIDATES.items():
+            resolved[role] = next((col for col in candidates if col in columns), None)
+        with _schema_lock:
+            _schema_cache[f"{self.base_url}/{table_name}"] = {
+                "columns": columns,
+                "resolved": resolved,
+                "loaded_at": time.monotonic()
+            }
+    
+    def _get_schema(self, table_name: str) -> Optional[Dict]:
+        """
+        Obtiene el esquema en caché de una tabla, cargándolo si no existe o expiró
+        
+        Primero intenta con la raíz OpenAPI (una sola petición para todas las tablas)
+        y, si no está disponible, con select=*&limit=1
+        """
+        key = f"{self.base_url}/{table_name}"
+        with _schema_lock:
+            entry = _schema_cache.get(key)
+        if entry and time.monotonic() - entry["loaded_at"] < settings.supabase_schema_cache_ttl:
+            return entry
+        
+        # Si la raíz OpenAPI falló recientemente, no reintentar hasta que expire el TTL
+        with _schema_lock:
+            failed_at = _openapi_unavailable.get(self.base_url)
+        openapi_schema = {}
+        if failed_at is None or time.monotonic() - failed_at >= settings.supabase_schema_cache_ttl:
+            openapi_schema = self._load_schema_from_openapi()
+            if not openapi_schema:
+                with _schema_lock:
+                    _openapi_unavailable[self.base_url] = time.monotonic()
+        for table, columns in openapi_schema.items():
+            if columns:
+                self._cache_schema(table, columns)
+        
+        if not openapi_schema.get(table_name):
+            try:
+                params = {"select": "*", "limit": "1"}
+                data = self._make_request("GET", table_name, params=params)
+                if isinstance(data, list) and len(data) > 0:
+                    self._cache_schema(table_name, list(data[0].keys()))
+            except Exception as e:
+                logger.warning(f"No se pudieron detectar columnas en {table_name}: {str(e)}")
+        
+        with _schema_lock:
+            return _schema_cache.get(key)
+    
     def _get_available_columns(self, table_name: str) -> List[str]:
         """
         Detecta las columnas disponibles en una tabla
-        Intenta hacer una consulta con select=* y devuelve las claves del primer registro
+        Usa la caché de esquema (TTL configurable con SUPABASE_SCHEMA_CACHE_TTL)
+        """
+        entry = self._get_schema(table_name)
+        return list(entry["columns"]) if entry else []
+    
+    def resolve_columns(self, table_name: str) -> Dict[str, Optional[str]]:
         """
+        Resuelve el nombre real de cada columna conocida (ver COLUMN_CANDIDATES) en una tabla
+        
+        Returns:
+            Diccionario {rol: columna o None}, ej: {"isin": "ISIN", "fecha": "FECHA_VALORACION", ...}
+        """
+        entry = self._get_schema(table_name)
+        if not entry:
+            return {role: None for role in self.COLUMN_CANDIDATES}
+        return dict(entry["resolved"])
+    
+    @staticmethod
+    def build_select(columns: Optional[List[str]]) -> str:
+        """
+        Construye el parámetro select de PostgREST para una lista de columnas
+        Las columnas con espacios o tildes van entre comillas dobles; sin columnas devuelve "*"
+        """
+        if not columns:
+            return "*"
+        return ",".join(
+            col if re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", col) else f'"{col}"'
+            for col in columns
+        )
+    
+    def _keyset_columns(self, table: str) -> Optional[List[str]]:
+        """Columnas de la llave de paginación keyset: id, o (FECHA_VALORACION, ISIN) si no hay id"""
+        if "id" in self._get_available_columns(table):
+            return ["id"]
+        resolved = self.resolve_columns(table)
+        if resolved["fecha"] and resolved["isin"]:
+            return [resolved["fecha"], resolved["isin"]]
+        return None
+    
+    @staticmethod
+    def _quote_filter_value(value) -> str:
+        """Cita un valor para usarlo dentro de un filtro or=(...)/and=(...) de PostgREST"""
+        if isinstance(value, (int, float)):
+            return str(value)
+        return '"' + str(value).replace('"', '\\"') + '"'
+    
+    @staticmethod
+    def _check_deadline(table: str, deadline: Optional[float]):
+        """Lanza TimeoutError si ya pasó el instante límite (time.monotonic()) de un recorrido"""
+        if deadline is not None and time.monotonic() >= deadline:
+            raise TimeoutError(f"Tiempo agotado recorriendo {table}; se abandona el recorrido")
+    
+    def iter_pages(self, table: str, params: Optional[Dict] = None,
+                   page_size: Optional[int] = None, deadline: Optional[float] = None) -> Iterator[List[Dict]]:
+        """
+        Recorre una tabla página por página con paginación keyset (por cursor)
+        
+        Ordena por la llave (id, o FECHA_VALORACION + ISIN) y pide cada página con un filtro
+        gt. sobre la última llave vista, así Postgres no recorre las filas anteriores como
+        con offset. Con SUPABASE_PAGINATION_MODE=offset, o si la tabla no tiene llave
+        utilizable, entrega en una sola página el resultado de fetch_all (offset con conteo).
+        
+        La condición de la llave se agrega en un parámetro and=(...) (combinado con el and
+        del llamador si existe), así que los filtros del llamador, incluidos or= y los
+        filtros sobre las columnas de la llave, se conservan. Las filas con llave nula no pueden
+        ser cursor (gt. no las compara): se excluyen del recorrido keyset y, con la llave
+        (FECHA_VALORACION, ISIN), se entregan al final en una página aparte.
+        
+        Args:
+            table: Nombre de la tabla
+            params: Parámetros PostgREST (select, filtros); limit/offset se ignoran
+            page_size: Filas por página (por defecto SUPABASE_PAGE_SIZE)
+            deadline: Instante límite (time.monotonic()); se revisa antes de pedir cada página
+        
+        Yields:
+            Listas de filas, en orden de la llave
+        
+        Raises:
+            ValueError: Si params trae un order distinto al de la llave (usar fetch_all)
+            TimeoutError: Si se alcanza el deadline antes de terminar el recorrido
+        """
+        params = {k: v for k, v in (params or {}).items() if k not in ("limit", "offset")}
+        params.setdefault("select", "*")
+        limit = page_size or settings.supabase_page_size
+        
+        key_columns = None
+        if settings.supabase_pagination_mode != "offset":
+            key_columns = self._keyset_columns(table)
+            if not key_columns:
+                logger.warning(f"{table} no tiene columnas para paginación keyset; usando offset")
+        if not key_columns:
+            rows = self.fetch_all(table, params, page_size=limit)
+            if rows:
+                yield rows
+            return
+        
+        key_order = [f"{col}.asc" for col in key_columns]
+        if "order" in params:
+            requested = [item.strip() if item.strip().endswith((".asc", ".desc")) else f"{item.strip()}.asc"
+                         for item in str(params["order"]).split(",") if item.strip()]
+            if requested != key_order:
+                raise ValueError(
+                    f"iter_pages ordena por la llave keyset ({','.join(key_order)}); "
+                    f"order={params['order']} no es compatible, usar fetch_all"
+                )
+        
+        # La llave debe venir en la respuesta para poder continuar desde la última fila
+        if params["select"] != "*":
+            selected = params["select"].split(",")
+            params["select"] = ",".join(selected + [col for col in key_columns if col not in selected])
+        params["order"] = ",".join(key_order)
+        caller_and = str(params.pop("and")).strip()[1:-1] if "and" in params else None
+        base_conditions = ([caller_and] if caller_and else []) + [f"{col}.not.is.null" for col in key_columns]
+        
+        last_key = None
+        while True:
+            self._check_deadline(table, deadline)
+            page_params = dict(params)
+            page_params["limit"] = str(limit)
+            conditions = list(base_conditions)
+            if last_key is not None:
+                if len(key_columns) == 1:
+                    conditions.append(f"{key_columns[0]}.gt.{self._quote_filter_value(last_key[0])}")
+                else:
+                    # (fecha, isin) > (ultima_fecha, ultimo_isin)
+                    fecha_col, isin_col = key_columns
+                    fecha_val, isin_val = (self._quote_filter_value(v) for v in last_key)
+                    conditions.append(
+                        f"or({fecha_col}.gt.{fecha_val},"
+                        f"and({fecha_col}.eq.{fecha_val},{isin_col}.gt.{isin_val}))"
+                    )
+            page_params["and"] = f"({','.join(conditions)})"
+            
+            page = self._make_request("GET", table, params=page_params)
+            if not isinstance(page, list) or not page:
+                break
+            yield page
+            
+            last_key = tuple(page[-1].get(col) for col in key_columns)
+            # Una página corta puede deberse al max-rows del servidor: ajustar y pedir una más
+            if len(page) < limit:
+                limit = len(page)
+        
+        # Filas con FECHA_VALORACION o ISIN nulos (id es la llave primaria: nunca es nulo)
+        if len(key_columns) > 1:
+            self._check_deadline(table, deadline)
+            null_params = dict(params)
+            null_conditions = ([caller_and] if caller_and else []) + [
+                f"or({','.join(f'{col}.is.null' for col in key_columns)})"
+            ]
+            null_params["and"] = f"({','.join(null_conditions)})"
+            rows = self.fetch_all(table, null_params, page_size=page_size or settings.supabase_page_size)
+            if rows:
+                yield rows
+    
+    def _file_list_signature(self, table_name: str, timestamp_col: Optional[str]) -> Tuple:
+        """
+        Firma barata de la tabla para detectar ingestas nuevas: id máximo si existe la
+        columna (llave primaria, indexada), si no el último timestamp de ingesta, y si
+        tampoco existe el conteo exacto de filas
+        
+        La firma se reutiliza durante SUPABASE_FILE_LIST_SIGNATURE_TTL segundos.
+        """
+        key = f"{self.base_url}/{table_name}"
+        with _file_list_lock:
+            entry = _file_list_signatures.get(key)
+        if entry and time.monotonic() - entry["checked_at"] < settings.supabase_file_list_signature_ttl:
+            return entry["signature"]
+        
+        signature = self._probe_file_list_signature(table_name, timestamp_col)
+        with _file_list_lock:
+            _file_list_signatures[key] = {"signature": signature, "checked_at": time.monotonic()}
+        return signature
+    
+    def _probe_file_list_signature(self, table_name: str, timestamp_col: Optional[str]) -> Tuple:
+        """Consulta la firma de la tabla en Supabase (ver _file_list_signature)"""
+        if "id" in self._get_available_columns(table_name):
+            rows, _ = self._get_page(table_name, {"select": "id", "order": "id.desc"}, 0, 1)
+            return ("id", rows[0].get("id") if rows else None)
+        if timestamp_col:
+            rows, _ = self._get_page(table_name, {"select": timestamp_col, "order": f"{timestamp_col}.desc"}, 0, 1)
+            return ("timestamp", rows[0].get(timestamp_col) if rows else None)
+        _, total = self._get_page(table_name, {"select": "*"}, 0, 1, count=True)
+        return ("count", total)
+    
+    def _list_files_from_view(self, table_name: str) -> List[Dict]:
+        """Lee la vista de archivos (scripts/create_supabase_file_views.sql), ya agrupada en la base de datos"""
+        view_name = f"{table_name}{settings.supabase_files_view_suffix}"
+        # Paginado como cualquier consulta: una sola petición se cortaría en el max-rows del servidor
+        return self.fetch_all(view_name, {
+            "select": "name,provider,fecha_valoracion,upload_date,record_count",
+            "order": "name.asc,provider.asc,fecha_valoracion.asc",
+        })
+    
+    def _list_files_from_aggregate(self, table_name: str, resolved: Dict[str, Optional[str]]) -> List[Dict]:
+        """
+        Agrupa con un select agregado de PostgREST (count() y max(), requiere db-aggregates-enabled)
+        """
+        archivo_col = resolved["archivo"]
+        if not archivo_col:
+            raise ValueError(f"Columna de archivo no encontrada en {table_name}")
+        select = [f"name:{archivo_col}"]
+        if resolved["proveedor"]:
+            select.append(f"provider:{resolved['proveedor']}")
+        if resolved["fecha"]:
+            select.append(f"fecha_valoracion:{resolved['fecha']}")
+        if resolved["timestamp"]:
+            select.append(f"upload_date:{resolved['timestamp']}.max()")
+        select.append("record_count:count()")
+        # Orden por las columnas agrupadas para que las páginas de fetch_all no se solapen
+        order = [col for col in (archivo_col, resolved["proveedor"], resolved["fecha"]) if col]
+        return self.fetch_all(table_name, {
+            "select": ",".join(select),
+            "order": ",".join(f"{self.build_select([col])}.asc" for col in order),
+        })
+    
+    def _list_files_client_side(self, table_name: str, resolved: Dict[str, Optional[str]]) -> List[Dict]:
+        """Último recurso: recorre la tabla con paginación keyset y agrupa en Python"""
+        archivo_col = resolved["archivo"]
+        proveedor_col = resolved["proveedor"]
+        fecha_col = resolved["fecha"]
+        timestamp_col = resolved["timestamp"]
+        
+        selected_columns = []
+        for role, col in [("archivo_origen", archivo_col), ("proveedor", proveedor_col),
+                          ("fecha", fecha_col), ("timestamp_ingesta", timestamp_col)]:
+            if col:
+                selected_columns.append(col)
+            else:
+                logger.warning(f"Columna {role} no encontrada en {table_name}")
+        
+        # Si no encontramos las columnas necesarias, usar select=*
+        if len(selected_columns) < 2:
+            logger.warning(f"Usando select=* para {table_name} porque no se encontraron las columnas esperadas")
+            params = {"select": "*"}
+        else:
+            params = {"select": ",".join(selected_columns)}
+        
+        # Agrupar por archivo_origen (o la columna equivalente) página por página
+        file_groups = {}
+        for page in self.iter_pages(table_name, params):
+            for row in page:
+                file_name = row.get(archivo_col) if archivo_col else row.get("archivo_origen", "N/A")
+                if file_name and file_name != "N/A":
+                    if file_name not in file_groups:
+                        file_groups[file_name] = {
+                            "name": file_name,
+                            "provider": row.get(proveedor_col) if proveedor_col else row.get("proveedor"),
+                            "fecha_valoracion": row.get(fecha_col) if fecha_col else None,
+                            "upload_date": row.get(timestamp_col) if timestamp_col else row.get("timestamp_ingesta"),
+                            "record_count": 0
+                        }
+                    group = file_groups[file_name]
+                    group["record_count"] += 1
+                    upload_date = row.get(timestamp_col) if timestamp_col else None
+                    if upload_date and (not group["upload_date"] or upload_date > group["upload_date"]):
+                        group["upload_date"] = upload_date
+        return list(file_groups.values())
+    
+    def _get_file_list(self, table_name: str) -> List[Dict]:
+        """
+        Lista de archivos de una tabla agrupada en la base de datos, con caché por tabla
+        
+        Estrategias en orden: vista de archivos, select agregado, agrupación en Python.
+        La que funcionó se recuerda por tabla. La caché se invalida cuando cambia la firma
+        de la tabla (nueva ingesta) o al cumplirse SUPABASE_FILE_LIST_CACHE_TTL.
+        """
+        key = f"{self.base_url}/{table_name}"
+        resolved = self.resolve_columns(table_name)
+        
         try:
-            params = {"select": "*", "limit": "1"}
-            data = self._make_request("GET", table_name, params=params)
-            if isinstance(data, list) and len(data) > 0:
-                return list(data[0].keys())
-            return []
+            signature = self._file_list_signature(table_name, resolved["timestamp"])
         except Exception as e:
-            logger.warning(f"No se pudieron detectar columnas en {table_name}: {str(e)}")
-            return []
+            logger.debug(f"No se pudo calcular la firma de {table_name}: {str(e)}")
+            signature = None
+        
+        with _file_list_lock:
+            entry = _file_list_cache.get(key)
+        if (entry and signature is not None and entry["signature"] == signature
+                and time.monotonic() - entry["loaded_at"] < settings.supabase_file_list_cache_ttl):
+            return entry["files"]
+        if entry:
+            logger.info(f"Caché de archivos de {table_name} invalidada (nueva ingesta o TTL vencido)")
+        
+        strategies = [
+            ("view", lambda: self._list_files_from_view(table_name)),
+            ("aggregate", lambda: self._list_files_from_aggregate(table_name, resolved)),
+            ("client", lambda: self._list_files_client_side(table_name, resolved)),
+        ]
+        with _file_list_lock:
+            known = _file_list_strategy.get(key)
+        if known:
+            strategies = [item for item in strategies if item[0] == known] + \
+                         [item for item in strategies if item[0] != known]
+        
+        files = None
+        for name, strategy in strategies:
+            try:
+                files = strategy()
+            except Exception as e:
+                if name == "client":
+                    raise
+                logger.info(f"Listado de archivos por '{name}' no disponible en {table_name}: {str(e)}")
+                continue
+            with _file_list_lock:
+                _file_list_strategy[key] = name
+            logger.info(f"📁 {len(files)} archivos en {table_name} (estrategia: {name})")
+            break
+        
+        files = [
+            {
+                "name": f.get("name"),
+                "provider": f.get("provider"),
+                "fecha_valoracion": str(f["fecha_valoracion"]) if f.get("fecha_valoracion") else None,
+                "upload_date": f.get("upload_date"),
+                "record_count": int(f.get("record_count") or 0)
+            }
+            for f in files
+            if f.get("name") and f.get("name") != "N/A"
+        ]
+        files.sort(key=lambda x: x.get("upload_date") or "", reverse=True)
+        
+        with _file_list_lock:
+            _file_list_cache[key] = {"files": files, "signature": signature, "loaded_at": time.monotonic()}
+        return files
     
     def list_files(self, provider: Optional[str] = None, 
                    fecha_valoracion: Optional[str] = None) -> List[Dict]:
         """
         Lista archivos disponibles en Supabase
         
+        El agrupamiento por archivo se hace en la base de datos (ver _get_file_list),
+        por lo que record_count cubre todas las filas de cada archivo
+        
         Args:
             provider: Filtrar por proveedor (PIP_LATAM, PRECIA)
             fecha_valoracion: Filtrar por fecha (formato: YYYY-MM-DD)
@@ -200,7 +885,6 @@ class SupabaseService:
         """
         try:
             files = []
-            tables_to_query = []
             
             if provider:
                 tables_to_query = [self.get_table_name(provider)]
@@ -208,63 +892,8 @@ class SupabaseService:
                 tables_to_query = [self.table_pip, self.table_precia]
             
             for table_name in tables_to_query:
-                # Detectar columnas disponibles
-                available_columns = self._get_available_columns(table_name)
-                
-                # Mapear nombres de columnas esperados a posibles variaciones
-                # Incluye variaciones en mayúsculas/minúsculas y nombres alternativos
-                column_mapping = {
-                    "archivo_origen": ["TIPO_ARCHIVO", "tipo_archivo", "archivo_origen", "archivo", "file_name", "nombre_archivo"],
-                    "proveedor": ["FUENTE", "fuente", "proveedor", "provider", "PROVEEDOR"],
-                    "fecha": ["FECHA_VALORACION", "fecha_valoracion", "fecha", "date", "valuation_date", "FECHA"],
-                    "timestamp_ingesta": ["created_at", "CREATED_AT", "timestamp_ingesta", "timestamp", "upload_date", "fecha_ingesta"]
-                }
-                
-                # Encontrar las columnas reales disponibles
-                selected_columns = []
-                for expected_col, variations in column_mapping.items():
-                    found = False
-                    for variation in variations:
-                        if variation in available_columns:
-                            selected_columns.append(variation)
-                            found = True
-                            break
-                    if not found:
-                        logger.warning(f"Columna {expected_col} no encontrada en {table_name}. Columnas disponibles: {available_columns}")
-                
-                # Si no encontramos las columnas necesarias, usar select=*
-                if len(selected_columns) < 2:
-                    logger.warning(f"Usando select=* para {table_name} porque no se encontraron las columnas esperadas")
-                    params = {"select": "*", "limit": "1000"}
-                else:
-                    # Construir parámetros de consulta (sintaxis PostgREST)
-                    params = {
-                        "select": ",".join(selected_columns),
-                        "limit": "1000"
-                    }
-                    
-                    # Intentar ordenar por timestamp si está disponible
-                    timestamp_col = None
-                    for col in ["created_at", "CREATED_AT", "timestamp_ingesta", "timestamp", "upload_date"]:
-                        if col in available_columns:
-                            timestamp_col = col
-                            break
-                    if timestamp_col:
-                        params["order"] = f"{timestamp_col}.desc"
-                
-                if fecha_valoracion:
-                    # Intentar filtrar por fecha
-                    fecha_col = None
-                    for col in ["FECHA_VALORACION", "fecha_valoracion", "fecha", "date", "valuation_date", "FECHA"]:
-                        if col in available_columns:
-                            fecha_col = col
-                            break
-                    if fecha_col:
-                        params[fecha_col] = f"eq.{fecha_valoracion}"
-                
-                # Obtener datos
                 try:
-                    data = self._make_request("GET", table_name, params=params)
+                    table_files = self._get_file_list(table_name)
                 except Exception as e:
                     error_msg = str(e)
                     if "does not exist" in error_msg or "column" in error_msg.lower():
@@ -273,63 +902,27 @@ class SupabaseService:
                         raise Exception(f"Columnas faltantes en {table_name}. Ver logs para más detalles.")
                     raise
                 
-                if isinstance(data, list):
-                    # Agrupar por archivo_origen (o la columna equivalente)
-                    file_groups = {}
-                    archivo_col = None
-                    proveedor_col = None
-                    fecha_col = None
-                    timestamp_col = None
-                    
-                    # Encontrar las columnas reales en los datos
-                    if len(data) > 0:
-                        row_keys = list(data[0].keys())
-                        for key in row_keys:
-                            key_lower = key.lower()
-                            key_upper = key.upper()
-                            # Mapeo de archivo_origen
-                            if key_upper == "TIPO_ARCHIVO" or "archivo" in key_lower or "file" in key_lower:
-                                archivo_col = key
-                            # Mapeo de proveedor
-                            if key_upper == "FUENTE" or "proveedor" in key_lower or "provider" in key_lower:
-                                proveedor_col = key
-                            # Mapeo de fecha
-                            if key_upper == "FECHA_VALORACION" or key_lower in ["fecha", "fecha_valoracion", "date", "valuation_date"]:
-                                fecha_col = key
-                            # Mapeo de timestamp
-                            if key_upper == "CREATED_AT" or "timestamp" in key_lower or "created_at" in key_lower or "upload" in key_lower:
-                                timestamp_col = key
-                    
-                    for row in data:
-                        file_name = row.get(archivo_col) if archivo_col else row.get("archivo_origen", "N/A")
-                        if file_name and file_name != "N/A":
-                            if file_name not in file_groups:
-                                file_groups[file_name] = {
-                                    "name": file_name,
-                                    "provider": row.get(proveedor_col) if proveedor_col else row.get("proveedor"),
-                                    "fecha_valoracion": str(row.get(fecha_col)) if fecha_col and row.get(fecha_col) else None,
-                                    "upload_date": row.get(timestamp_col) if timestamp_col else row.get("timestamp_ingesta"),
-                                    "record_count": 0
-                                }
-                            file_groups[file_name]["record_count"] += 1
-                    
-                    files.extend(list(file_groups.values()))
+                if fecha_valoracion:
+                    table_files = [f for f in table_files if (f["fecha_valoracion"] or "")[:10] == fecha_valoracion]
+                files.extend(table_files)
             
             # Ordenar por fecha de subida (más recientes primero)
-            files.sort(key=lambda x: x.get("upload_date") or datetime.min, reverse=True)
+            files.sort(key=lambda x: x.get("upload_date") or "", reverse=True)
             
             return files
         except Exception as e:
             logger.error(f"Error listando archivos: {str(e)}")
             raise
     
-    def get_data_by_file(self, file_name: str, provider: str) -> pd.DataFrame:
+    def get_data_by_file(self, file_name: str, provider: str,
+                         columns: Optional[List[str]] = None) -> pd.DataFrame:
         """
         Obtiene datos de un archivo específico desde Supabase
         
         Args:
             file_name: Nombre del archivo
             provider: Proveedor (PIP_LATAM, PRECIA)
+            columns: Columnas a traer (select); None trae todas (select=*)
         
         Returns:
             DataFrame con los datos
@@ -337,15 +930,11 @@ class SupabaseService:
         try:
             table_name = self.get_table_name(provider)
             
-            # Detectar columnas disponibles
+            # Detectar columnas disponibles (caché de esquema)
             available_columns = self._get_available_columns(table_name)
             
             # Encontrar la columna de archivo_origen
-            archivo_col = None
-            for col in ["TIPO_ARCHIVO", "tipo_archivo", "archivo_origen", "archivo", "file_name", "nombre_archivo"]:
-                if col in available_columns:
-                    archivo_col = col
-                    break
+            archivo_col = self.resolve_columns(table_name)["archivo"]
             
             if not archivo_col:
                 # Si no encontramos la columna, intentar con el nombre esperado
@@ -354,17 +943,17 @@ class SupabaseService:
             
             # Construir parámetros de consulta (sintaxis PostgREST)
             params = {
-                "select": "*",
+                "select": self.build_select(columns),
                 archivo_col: f"eq.{file_name}",
             }
             
-            # Intentar ordenar por id si está disponible
+            # Intentar ordenar por id si está disponible (la paginación keyset ya ordena por su llave)
             if "id" in available_columns:
                 params["order"] = "id.asc"
             
-            # Obtener datos
+            # Obtener TODAS las filas del archivo, convirtiendo cada página a DataFrame al llegar
             try:
-                data = self._make_request("GET", table_name, params=params)
+                frames = [pd.DataFrame(page) for page in self.iter_pages(table_name, params)]
             except Exception as e:
                 error_msg = str(e)
                 if "does not exist" in error_msg or "column" in error_msg.lower():
@@ -373,9 +962,8 @@ class SupabaseService:
                     raise Exception(f"Columna {archivo_col} no existe en {table_name}. Ver logs para más detalles.")
                 raise
             
-            if isinstance(data, list) and len(data) > 0:
-                df = pd.DataFrame(data)
-                return df
+            if frames:
+                return pd.concat(frames, ignore_index=True)
             else:
                 return pd.DataFrame()  # DataFrame vacío si no hay datos
                 
@@ -395,101 +983,7 @@ class SupabaseService:
             Lista de archivos ordenados por fecha de subida (más recientes primero)
         """
         try:
-            table_name = self.get_table_name(provider)
-            
-            # Detectar columnas disponibles
-            available_columns = self._get_available_columns(table_name)
-            
-            # Mapear nombres de columnas esperados a posibles variaciones
-            # Incluye variaciones en mayúsculas/minúsculas y nombres alternativos
-            column_mapping = {
-                "archivo_origen": ["TIPO_ARCHIVO", "tipo_archivo", "archivo_origen", "archivo", "file_name", "nombre_archivo"],
-                "proveedor": ["FUENTE", "fuente", "proveedor", "provider", "PROVEEDOR"],
-                "fecha": ["FECHA_VALORACION", "fecha_valoracion", "fecha", "date", "valuation_date", "FECHA"],
-                "timestamp_ingesta": ["created_at", "CREATED_AT", "timestamp_ingesta", "timestamp", "upload_date", "fecha_ingesta"]
-            }
-            
-            # Encontrar las columnas reales disponibles
-            selected_columns = []
-            for expected_col, variations in column_mapping.items():
-                for variation in variations:
-                    if variation in available_columns:
-                        selected_columns.append(variation)
-                        break
-            
-            # Si no encontramos las columnas necesarias, usar select=*
-            if len(selected_columns) < 2:
-                logger.warning(f"Usando select=* para {table_name} porque no se encontraron las columnas esperadas")
-                params = {"select": "*", "limit": str(limit)}
-            else:
-                params = {
-                    "select": ",".join(selected_columns),
-                    "limit": str(limit)
-                }
-                
-                # Intentar ordenar por timestamp si está disponible
-                timestamp_col = None
-                for col in ["created_at", "CREATED_AT", "timestamp_ingesta", "timestamp", "upload_date"]:
-                    if col in available_columns:
-                        timestamp_col = col
-                        break
-                if timestamp_col:
-                    params["order"] = f"{timestamp_col}.desc"
-            
-            # Obtener datos
-            try:
-                data = self._make_request("GET", table_name, params=params)
-            except Exception as e:
-                error_msg = str(e)
-                if "does not exist" in error_msg or "column" in error_msg.lower():
-                    logger.error(f"Error: Las columnas necesarias no existen en {table_name}. "
-                               f"Ejecuta el script SQL en scripts/create_supabase_columns.sql para crear las columnas.")
-                    raise Exception(f"Columnas faltantes en {table_name}. Ver logs para más detalles.")
-                raise
-            
-            if isinstance(data, list):
-                # Agrupar por archivo_origen (o la columna equivalente)
-                file_groups = {}
-                archivo_col = None
-                proveedor_col = None
-                fecha_col = None
-                timestamp_col = None
-                
-                # Encontrar las columnas reales en los datos
-                if len(data) > 0:
-                    row_keys = list(data[0].keys())
-                    for key in row_keys:
-                        key_lower = key.lower()
-                        key_upper = key.upper()
-                        # Mapeo de archivo_origen
-                        if key_upper == "TIPO_ARCHIVO" or "archivo" in key_lower or "file" in key_lower:
-                            archivo_col = key
-                        # Mapeo de proveedor
-                        if key_upper == "FUENTE" or "proveedor" in key_lower or "provider" in key_lower:
-                            proveedor_col = key
-                        # Mapeo de fecha
-                        if key_upper == "FECHA_VALORACION" or key_lower in ["fecha", "fecha_valoracion", "date", "valuation_date"]:
-                            fecha_col = key
-                        # Mapeo de timestamp
-                        if key_upper == "CREATED_AT" or "timestamp" in key_lower or "created_at" in key_lower or "upload" in key_lower:
-                            timestamp_col = key
-                
-                for row in data:
-                    file_name = row.get(archivo_col) if archivo_col else row.get("archivo_origen", "N/A")
-                    if file_name and file_name != "N/A":
-                        if file_name not in file_groups:
-                            file_groups[file_name] = {
-                                "name": file_name,
-                                "provider": row.get(proveedor_col) if proveedor_col else row.get("proveedor"),
-                                "fecha_valoracion": str(row.get(fecha_col)) if fecha_col and row.get(fecha_col) else None,
-                                "upload_date": row.get(timestamp_col) if timestamp_col else row.get("timestamp_ingesta"),
-                                "record_count": 0
-                            }
-                        file_groups[file_name]["record_count"] += 1
-                
-                return list(file_groups.values())
-            
-            return []
+            return self.list_files(provider=provider)[:limit]
         except Exception as e:
             logger.error(f"Error obteniendo archivos recientes: {str(e)}")
             raise
@@ -515,9 +1009,8 @@ class SupabaseService:
         try:
             # Probar conexión básica haciendo una petición simple
             test_url = f"{self.api_url}/"
-            with httpx.Client(timeout=10.0) as client:
-                response = client.get(test_url, headers=self.headers)
-                response.raise_for_status()
+            response = _send(self.base_url, "GET", test_url, headers=self.headers, timeout=10.0)
+            response.raise_for_status()
             
             # Verificar tablas
             pip_exists = self.table_exists(self.table_pip)
@@ -547,5 +1040,9 @@ class SupabaseService:
             }
     
     def close(self):
-        """Cierra la conexión con Supabase (no necesario para API REST, pero mantiene compatibilidad)"""
+        """
+        Libera la instancia (mantiene compatibilidad)
+        
+        El cliente HTTP es compartido por el proceso y se cierra con close_http_clients() al apagar la aplicación
+        """
         logger.info("Conexión con Supabase API cerrada")
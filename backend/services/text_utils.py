@@ -0,0 +1,23 @@
+"""
+Normalización de texto en español compartida por la búsqueda de conocimiento y el parser de intención
+
+Sin dependencias: el parser de intención (ruta rápida del chat) la importa sin cargar
+PyPDF2, numpy ni sentence-transformers.
+"""
+
+# Palabras vacías en español (sin tildes, se comparan después de normalizar)
+SPANISH_STOP_WORDS = frozenset("""
+a al algo algun alguna algunas alguno algunos ante antes como con contra cual cuales cuando de del desde
+donde durante e el ella ellas ellos en entre era eran es esa esas ese eso esos esta estan estas este esto
+estos fue fueron ha han hasta hay la las le les lo los mas me mi mientras muy no nos o os otra otras otro
+otros para pero poco por porque que quien quienes se sea segun ser si sin sobre son su sus tambien tan
+tanto te tiene tienen todo todos tu tus un una unas uno unos y ya yo
+""".split())
+
+# Tabla de traducción de vocales con tilde/diéresis y ñ
+_ACCENT_TABLE = str.maketrans("áéíóúüñàèìòùâêîôûäëïö", "aeiouunaeiouaeiouaeio")
+
+
+def fold_accents(text: str) -> str:
+    """Minúsculas y sin tildes ni diéresis (duración -> duracion, cupón -> cupon)"""
+    return text.lower().translate(_ACCENT_TABLE)
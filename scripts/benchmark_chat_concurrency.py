@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga de /chat: throughput con peticiones concurrentes
+
+Envía N consultas a /chat con C peticiones simultáneas y, en paralelo, sondea
+/health para medir si el event loop sigue respondiendo mientras /chat espera a
+OpenAI/Supabase. Reporta peticiones por segundo y latencias p50/p95/máx.
+
+Modos:
+- Contra un servidor en ejecución (mide el stack real, incluido OpenAI):
+      python scripts/benchmark_chat_concurrency.py --url http://localhost:8000 -n 40 -c 10
+  Para comparar antes/después, ejecutar contra cada versión del backend.
+
+- Simulado, sin servidor ni OpenAI: monta la app en proceso y reemplaza
+  ChatService por uno que bloquea --latencia ms (como una llamada síncrona al LLM).
+  Compara el endpoint actual (def, en el threadpool) con la forma anterior
+  (async def que llama al código bloqueante dentro del event loop):
+      python scripts/benchmark_chat_concurrency.py --simulado -n 40 -c 10 --latencia 200
+"""
+import sys
+import os
+import time
+import asyncio
+import argparse
+import statistics
+from pathlib import Path
+
+# Configurar codificación UTF-8 para Windows
+if sys.platform == 'win32':
+    import io
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+# Cambiar al directorio backend para cargar .env
+backend_dir = Path(__file__).parent.parent / "backend"
+os.chdir(backend_dir)
+
+sys.path.insert(0, str(backend_dir))
+
+import httpx
+
+CONSULTAS = [
+    "¿Cuál es el precio limpio del TES CO000123 hoy en Precia?",
+    "Compara PIP Latam vs Precia para COB07CD0PY71",
+    "¿Qué es la duración modificada?",
+    "Trae valoración de ayer para COT29CD00021",
+]
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[indice]
+
+
+async def carga(client: httpx.AsyncClient, ruta_chat: str, total: int, concurrencia: int):
+    """Ejecuta la carga de /chat y sondea /health mientras tanto"""
+    semaforo = asyncio.Semaphore(concurrencia)
+    latencias, errores = [], 0
+    latencias_health = []
+    terminado = asyncio.Event()
+
+    async def una_consulta(i: int):
+        nonlocal errores
+        async with semaforo:
+            inicio = time.perf_counter()
+            try:
+                respuesta = await client.post(ruta_chat, json={
+                    "message": CONSULTAS[i % len(CONSULTAS)],
+                    "user": f"benchmark-{i % concurrencia}",
+                })
+                if respuesta.status_code != 200:
+                    errores += 1
+            except Exception:
+                errores += 1
+            latencias.append(time.perf_counter() - inicio)
+
+    async def sondeo_health():
+        while not terminado.is_set():
+            inicio = time.perf_counter()
+            try:
+                await client.get("/health")
+            except Exception:
+                pass
+            latencias_health.append(time.perf_counter() - inicio)
+            await asyncio.sleep(0.05)
+
+    sonda = asyncio.create_task(sondeo_health())
+    inicio = time.perf_counter()
+    await asyncio.gather(*(una_consulta(i) for i in range(total)))
+    duracion = time.perf_counter() - inicio
+    terminado.set()
+    await sonda
+
+    return {
+        "duracion": duracion,
+        "rps": total / duracion,
+        "p50": percentil(latencias, 50),
+        "p95": percentil(latencias, 95),
+        "max": max(latencias) if latencias else 0.0,
+        "errores": errores,
+        "health_p95": percentil(latencias_health, 95),
+        "health_max": max(latencias_health) if latencias_health else 0.0,
+    }
+
+
+def imprimir(nombre: str, r: dict):
+    print(f"--- {nombre} ---")
+    print(f"  Duración total: {r['duracion']:.2f}s  |  Throughput: {r['rps']:.1f} req/s  |  Errores: {r['errores']}")
+    print(f"  Latencia /chat: p50 {r['p50'] * 1000:.0f} ms, p95 {r['p95'] * 1000:.0f} ms, máx {r['max'] * 1000:.0f} ms")
+    print(f"  Latencia /health durante la carga: p95 {r['health_p95'] * 1000:.0f} ms, máx {r['health_max'] * 1000:.0f} ms")
+    print()
+
+
+def preparar_app_simulada(latencia_ms: int):
+    """Monta la app con un ChatService que bloquea latencia_ms y la ruta con la forma anterior"""
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    import main
+    from database import get_db
+    from schemas import ChatMessage, ChatResponse
+
+    class ChatServiceBloqueante:
+        def __init__(self, db, supabase_access_token=None, conversation_context=None, **kwargs):
+            self.context = conversation_context or {}
+
+        def generate_response(self, query, user=None):
+            time.sleep(latencia_ms / 1000)  # Simula la llamada síncrona a OpenAI
+            return {"answer": "ok", "data": None, "recommendations": [], "metadata": {}}
+
+        def get_conversation_context(self):
+            return self.context
+
+    main.ChatService = ChatServiceBloqueante
+    main.app.dependency_overrides[get_db] = lambda: None
+
+    @main.app.post("/bench/chat-async-bloqueante", response_model=ChatResponse)
+    async def chat_async_bloqueante(message: ChatMessage):
+        # Forma anterior del endpoint: async def con trabajo bloqueante en el event loop
+        return main.chat(message, db=None)
+
+    return main.app
+
+
+async def main_async(args):
+    if args.simulado:
+        app = preparar_app_simulada(args.latencia)
+        transport = httpx.ASGITransport(app=app)
+        rutas = {
+            "Antes: async def bloqueante": "/bench/chat-async-bloqueante",
+            "Después: def en threadpool": "/api/v1/chat",
+        }
+        print(f"=== /chat simulado: {args.n} consultas, concurrencia {args.c}, latencia {args.latencia} ms ===\n")
+        for nombre, ruta in rutas.items():
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+                imprimir(nombre, await carga(client, ruta, args.n, args.c))
+    else:
+        print(f"=== /chat en {args.url}: {args.n} consultas, concurrencia {args.c} ===\n")
+        async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout) as client:
+            imprimir(args.url, await carga(client, "/api/v1/chat", args.n, args.c))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prueba de carga concurrente de /chat")
+    parser.add_argument("--url", default="http://localhost:8000", help="URL del backend en ejecución")
+    parser.add_argument("--simulado", action="store_true", help="App en proceso con latencia de LLM simulada")
+    parser.add_argument("--latencia", type=int, default=200, help="Milisegundos de bloqueo por consulta (modo simulado)")
+    parser.add_argument("-n", type=int, default=40, help="Total de consultas")
+    parser.add_argument("-c", type=int, default=10, help="Consultas simultáneas")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Timeout por petición en segundos")
+    asyncio.run(main_async(parser.parse_args()))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Script para comparar la búsqueda BM25 (índice invertido) con el recorrido por palabras clave anterior
+
+Usa los chunks de "Guia de Estudio - Renta Fija.pdf" (o de su índice precalculado);
+si el PDF no está, genera chunks sintéticos. Mide el tiempo por consulta de ambos
+métodos, el costo de construir el índice y cuántos resultados coinciden en el top-k.
+
+Uso:
+    python scripts/benchmark_knowledge_search.py [--chunks N] [--repeticiones R]
+"""
+import sys
+import os
+import time
+import random
+import argparse
+from pathlib import Path
+
+# Configurar codificación UTF-8 para Windows
+if sys.platform == 'win32':
+    import io
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+# Cambiar al directorio backend para cargar .env
+backend_dir = Path(__file__).parent.parent / "backend"
+os.chdir(backend_dir)
+
+sys.path.insert(0, str(backend_dir))
+
+from services.knowledge_service import KnowledgeService
+
+CONSULTAS = [
+    "¿Qué es la TIR?",
+    "¿Qué es la duración modificada de un bono?",
+    "¿Qué es el precio limpio?",
+    "¿Qué es un CDT?",
+    "Explícame la convexidad y su relación con la duración",
+    "¿Cómo se calcula el cupón corrido de los TES?",
+    "Diferencia entre precio sucio y precio limpio en la valoración",
+    "rendimiento al vencimiento de un bono en UVR",
+]
+
+TEMAS = [
+    "La tasa interna de retorno (TIR) iguala el valor presente de los flujos con el precio.",
+    "La duración modificada aproxima la sensibilidad del precio ante cambios de tasa.",
+    "La convexidad corrige la aproximación lineal de la duración.",
+    "El precio limpio excluye los intereses causados; el precio sucio los incluye.",
+    "El CDT es un certificado de depósito a término emitido por entidades financieras.",
+    "Los TES son títulos de deuda pública del Gobierno Nacional en pesos o UVR.",
+    "El cupón es el pago periódico de intereses del bono.",
+    "PIP Latam y Precia publican los precios de valoración diariamente.",
+]
+
+
+def buscar_por_recorrido(chunks, query: str, max_chunks: int = 3):
+    """Implementación anterior de search_relevant_context (recorre y cuenta en cada chunk)"""
+    query_lower = query.lower()
+    scored_chunks = []
+    for chunk in chunks:
+        chunk_text_lower = chunk['text'].lower()
+        score = 0
+        keywords = query_lower.split()
+        for keyword in keywords:
+            if len(keyword) > 3:
+                score += chunk_text_lower.count(keyword)
+        renta_fija_terms = ['tir', 'tasa', 'precio', 'duración', 'convexidad', 'valoración',
+                            'cdt', 'tes', 'bonos', 'renta fija', 'yield', 'cupón']
+        for term in renta_fija_terms:
+            if term in query_lower and term in chunk_text_lower:
+                score += 2
+        if score > 0:
+            scored_chunks.append({'chunk': chunk, 'score': score})
+    scored_chunks.sort(key=lambda x: x['score'], reverse=True)
+    return [item['chunk'] for item in scored_chunks[:max_chunks]]
+
+
+def chunks_sinteticos(cantidad: int):
+    random.seed(3)
+    relleno = ("el mercado de renta fija colombiano ofrece instrumentos con distintos perfiles "
+               "de riesgo liquidez y plazo para inversionistas institucionales").split()
+    chunks = []
+    for i in range(cantidad):
+        texto = random.choice(TEMAS) + " " + " ".join(random.choice(relleno) for _ in range(150))
+        chunks.append({'text': texto, 'page': i // 3 + 1, 'source': 'sintético'})
+    return chunks
+
+
+def medir(funcion, repeticiones: int) -> float:
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        for consulta in CONSULTAS:
+            funcion(consulta)
+    return (time.perf_counter() - inicio) / (repeticiones * len(CONSULTAS))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de búsqueda en la base de conocimiento")
+    parser.add_argument("--chunks", type=int, default=0, help="Usar N chunks sintéticos en lugar del PDF")
+    parser.add_argument("--repeticiones", type=int, default=50)
+    args = parser.parse_args()
+
+    service = KnowledgeService(load=False)
+    if args.chunks or not service.knowledge_base_path.exists():
+        service.chunks = chunks_sinteticos(args.chunks or 2000)
+        origen = "sintético"
+    else:
+        service._load_knowledge_base()
+        origen = service.knowledge_base_path.name
+
+    inicio = time.perf_counter()
+    service._build_search_index()
+    construccion = time.perf_counter() - inicio
+
+    print(f"=== Búsqueda en conocimiento: {len(service.chunks)} chunks ({origen}) ===\n")
+    print(f"Construcción del índice invertido: {construccion * 1000:.1f} ms ({len(service._postings)} términos)\n")
+
+    recorrido = medir(lambda q: buscar_por_recorrido(service.chunks, q), args.repeticiones)
+    bm25 = medir(lambda q: service.search_relevant_context(q), args.repeticiones)
+    print(f"Recorrido anterior: {recorrido * 1e6:,.0f} µs por consulta")
+    print(f"BM25 (índice):      {bm25 * 1e6:,.0f} µs por consulta")
+    print(f"Aceleración:        {recorrido / bm25:.1f}x\n")
+
+    for consulta in CONSULTAS:
+        anterior = [c['page'] for c in buscar_por_recorrido(service.chunks, consulta)]
+        nuevo = [c['page'] for c in service.search_relevant_context(consulta)]
+        print(f"{consulta[:50]:<50}  recorrido: {anterior}  bm25: {nuevo}")
+
+
+if __name__ == "__main__":
+    main()
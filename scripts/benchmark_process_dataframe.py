@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Script para comparar la conversión vectorizada de process_dataframe con el recorrido fila por fila
+
+Genera un DataFrame sintético con el formato de Supabase (incluye valores sucios:
+nulos, textos no numéricos, fechas en varios formatos), ejecuta ambos caminos,
+verifica que produzcan las mismas valoraciones y muestra los tiempos.
+
+Uso:
+    python scripts/benchmark_process_dataframe.py [filas]
+"""
+import sys
+import os
+import math
+import time
+import random
+from datetime import date, datetime
+from pathlib import Path
+
+# Configurar codificación UTF-8 para Windows
+if sys.platform == 'win32':
+    import io
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+# Cambiar al directorio backend para cargar .env
+backend_dir = Path(__file__).parent.parent / "backend"
+os.chdir(backend_dir)
+
+sys.path.insert(0, str(backend_dir))
+
+import pandas as pd
+from models import Provider
+from services.ingestion_service import IngestionService
+
+CAMPOS = [
+    "isin", "emisor", "tipo_instrumento", "plazo", "precio_limpio", "precio_sucio", "tasa",
+    "duracion", "convexidad", "fecha", "proveedor", "archivo_origen", "fecha_vencimiento",
+    "fecha_emision", "valor_nominal", "cupon", "frecuencia_cupon",
+]
+
+
+def generar_dataframe(filas: int) -> pd.DataFrame:
+    """Genera filas con el formato de las tablas de Supabase"""
+    random.seed(42)
+    registros = []
+    for i in range(filas):
+        registros.append({
+            "ISIN": random.choice([f" COB{i:09d} ", f"COT{i:09d}", None, ""]),
+            "EMISION": random.choice(["TES", " CDT BANCOLOMBIA ", None, 123]),
+            "TIPO_ACTIVO": random.choice(["TFIT", "CDT", None]),
+            "PRECIO_LIMPIO": random.choice([round(random.uniform(90, 110), 4), "101.5", "N/A", None]),
+            "PRECIO_SUCIO": random.uniform(90, 110),
+            "TIR": random.choice([random.uniform(5, 15), " 9.87 ", None]),
+            "DURACION": random.uniform(0, 10),
+            "VENCIMIENTO": random.choice(["2030-06-15", "15/06/2031", "2032/01/20 00:00", None, "sin fecha"]),
+            "TASA_FACIAL": random.choice([7.25, "7.25", None]),
+            "PERIODICIDAD": random.choice(["SV", "TV", None]),
+            "FECHA_VALORACION": "2024-01-15",
+            "COLUMNA_NO_USADA": "x" * 20,
+        })
+    return pd.DataFrame(registros)
+
+
+def normalizar(valor):
+    """Hace comparables los valores de ambos caminos (NaN ≡ None, Timestamp ≡ date)"""
+    if valor is None or (isinstance(valor, float) and math.isnan(valor)):
+        return None
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, float):
+        return round(valor, 10)
+    return valor
+
+
+def comparar(filas: int):
+    service = IngestionService.__new__(IngestionService)  # no requiere conexión a Supabase
+    df = generar_dataframe(filas)
+    print(f"=== process_dataframe: {filas} filas ===\n")
+
+    inicio = time.perf_counter()
+    por_fila = service.process_dataframe(df, Provider.PRECIA, date(2024, 1, 15), "benchmark", vectorized=False)
+    tiempo_fila = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    vectorizado = service.process_dataframe(df, Provider.PRECIA, date(2024, 1, 15), "benchmark", vectorized=True)
+    tiempo_vectorizado = time.perf_counter() - inicio
+
+    print(f"Fila por fila: {len(por_fila)} valoraciones en {tiempo_fila:.3f}s ({filas / tiempo_fila:,.0f} filas/s)")
+    print(f"Vectorizado:   {len(vectorizado)} valoraciones en {tiempo_vectorizado:.3f}s ({filas / tiempo_vectorizado:,.0f} filas/s)")
+    print(f"Aceleración:   {tiempo_fila / tiempo_vectorizado:.1f}x\n")
+
+    diferencias = 0
+    if len(por_fila) != len(vectorizado):
+        print(f"[ERROR] Cantidad distinta de valoraciones: {len(por_fila)} vs {len(vectorizado)}")
+        diferencias += 1
+    for a, b in zip(por_fila, vectorizado):
+        for campo in CAMPOS:
+            va, vb = normalizar(getattr(a, campo)), normalizar(getattr(b, campo))
+            if va != vb:
+                diferencias += 1
+                if diferencias <= 10:
+                    print(f"[DIFERENCIA] ISIN {a.isin} campo {campo}: {va!r} vs {vb!r}")
+
+    if diferencias == 0:
+        print("[OK] Ambos caminos producen las mismas valoraciones")
+    else:
+        print(f"[ERROR] {diferencias} diferencias encontradas")
+    return diferencias == 0
+
+
+if __name__ == "__main__":
+    filas = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    sys.exit(0 if comparar(filas) else 1)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Script para comparar los planes de consulta de valoraciones antes y después
+de los índices compuestos (migración alembic 0002)
+
+Crea una base SQLite temporal con valoraciones sintéticas, ejecuta las consultas
+frecuentes de QueryService con los índices originales (una columna) y con los
+índices nuevos, y muestra EXPLAIN QUERY PLAN y el tiempo promedio de cada una.
+
+En PostgreSQL se puede hacer la misma comparación con EXPLAIN ANALYZE sobre las
+consultas que imprime este script.
+
+Uso:
+    python scripts/benchmark_valuation_indexes.py [filas]
+"""
+import sys
+import os
+import time
+import random
+import tempfile
+from datetime import date, timedelta
+from pathlib import Path
+
+# Configurar codificación UTF-8 para Windows
+if sys.platform == 'win32':
+    import io
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+# Cambiar al directorio backend para cargar .env
+backend_dir = Path(__file__).parent.parent / "backend"
+os.chdir(backend_dir)
+
+sys.path.insert(0, str(backend_dir))
+
+from sqlalchemy import create_engine, insert, text
+from models import Base, Valuation, Provider
+
+# Índices de la migración 0002 y los índices de una columna que reemplaza
+INDICES_NUEVOS = {
+    "uq_valuations_isin_fecha_proveedor":
+        "CREATE UNIQUE INDEX uq_valuations_isin_fecha_proveedor ON valuations (isin, fecha DESC, proveedor)",
+    "ix_valuations_fecha_proveedor":
+        "CREATE INDEX ix_valuations_fecha_proveedor ON valuations (fecha, proveedor)",
+    "ix_valuations_isin_upper":
+        "CREATE INDEX ix_valuations_isin_upper ON valuations (upper(isin))",
+}
+INDICES_ORIGINALES = {
+    "ix_valuations_isin": "CREATE INDEX ix_valuations_isin ON valuations (isin)",
+    "ix_valuations_fecha": "CREATE INDEX ix_valuations_fecha ON valuations (fecha)",
+}
+
+
+def consultas(isin: str, fecha: date):
+    """Consultas frecuentes de QueryService (mismo SQL que generan los métodos)"""
+    return {
+        "get_latest_valuation": (
+            "SELECT * FROM valuations WHERE isin = :isin ORDER BY fecha DESC LIMIT 1",
+            {"isin": isin},
+        ),
+        "compare_providers (fecha más reciente)": (
+            "SELECT fecha FROM valuations WHERE isin = :isin ORDER BY fecha DESC LIMIT 1",
+            {"isin": isin},
+        ),
+        "compare_providers (por proveedor)": (
+            "SELECT * FROM valuations WHERE isin = :isin AND fecha = :fecha AND proveedor = 'PRECIA' LIMIT 1",
+            {"isin": isin, "fecha": fecha.isoformat()},
+        ),
+        "query_valuations (upper(isin))": (
+            "SELECT * FROM valuations WHERE upper(isin) = :isin ORDER BY fecha DESC, isin",
+            {"isin": isin.upper()},
+        ),
+        "valoraciones del día por proveedor": (
+            "SELECT count(*) FROM valuations WHERE fecha = :fecha AND proveedor = 'PIP_LATAM'",
+            {"fecha": fecha.isoformat()},
+        ),
+    }
+
+
+def poblar(engine, filas: int):
+    """Inserta valoraciones sintéticas: ISINs × días × proveedores"""
+    random.seed(7)
+    dias = 250
+    isins = [f"COB{i:09d}" for i in range(max(1, filas // (dias * 2)))]
+    inicio = date(2024, 1, 1)
+    registros = []
+    for isin in isins:
+        for d in range(dias):
+            for proveedor in (Provider.PIP_LATAM, Provider.PRECIA):
+                registros.append({
+                    "isin": isin, "fecha": inicio + timedelta(days=d), "proveedor": proveedor,
+                    "precio_limpio": random.uniform(90, 110), "tasa": random.uniform(5, 15),
+                })
+    with engine.begin() as conn:
+        for start in range(0, len(registros), 10000):
+            conn.execute(insert(Valuation.__table__), registros[start:start + 10000])
+    return isins, inicio + timedelta(days=dias - 1), len(registros)
+
+
+def aplicar_indices(engine, crear: dict, eliminar: dict):
+    with engine.begin() as conn:
+        for nombre in eliminar:
+            conn.execute(text(f"DROP INDEX IF EXISTS {nombre}"))
+        for ddl in crear.values():
+            conn.execute(text(ddl.replace("CREATE INDEX", "CREATE INDEX IF NOT EXISTS")
+                              .replace("CREATE UNIQUE INDEX", "CREATE UNIQUE INDEX IF NOT EXISTS")))
+        conn.execute(text("ANALYZE"))
+
+
+def medir(engine, isin: str, fecha: date, repeticiones: int = 200):
+    resultados = {}
+    with engine.connect() as conn:
+        for nombre, (sql, params) in consultas(isin, fecha).items():
+            plan = [row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"), params)]
+            inicio = time.perf_counter()
+            for _ in range(repeticiones):
+                conn.execute(text(sql), params).fetchall()
+            promedio_ms = (time.perf_counter() - inicio) / repeticiones * 1000
+            resultados[nombre] = (plan, promedio_ms)
+    return resultados
+
+
+def main():
+    filas = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    ruta = Path(tempfile.gettempdir()) / "sirius_benchmark_indices.db"
+    if ruta.exists():
+        ruta.unlink()
+    engine = create_engine(f"sqlite:///{ruta}")
+    Base.metadata.create_all(engine)
+
+    print(f"=== Índices de valoraciones: {filas} filas aprox. ===\n")
+    isins, fecha, total = poblar(engine, filas)
+    isin = isins[len(isins) // 2]
+    print(f"Filas insertadas: {total}, ISIN de prueba: {isin}, fecha: {fecha}\n")
+
+    aplicar_indices(engine, crear=INDICES_ORIGINALES, eliminar=INDICES_NUEVOS)
+    antes = medir(engine, isin, fecha)
+    aplicar_indices(engine, crear=INDICES_NUEVOS, eliminar=INDICES_ORIGINALES)
+    despues = medir(engine, isin, fecha)
+
+    for nombre in antes:
+        plan_antes, ms_antes = antes[nombre]
+        plan_despues, ms_despues = despues[nombre]
+        print(f"--- {nombre} ---")
+        print(f"  Antes   ({ms_antes:.3f} ms): {' | '.join(plan_antes)}")
+        print(f"  Después ({ms_despues:.3f} ms): {' | '.join(plan_despues)}")
+        print()
+
+    engine.dispose()
+    ruta.unlink()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Script para precalcular el índice del servicio de conocimiento
+
+Extrae el texto de "Guia de Estudio - Renta Fija.pdf", lo divide en chunks y los
+guarda en KNOWLEDGE_INDEX_DIR con el hash SHA-256 del PDF como llave. Al iniciar,
+KnowledgeService carga ese índice y solo vuelve a extraer el PDF si cambió.
+
+Con --embeddings también precalcula los vectores de los chunks con el modelo local
+KNOWLEDGE_EMBEDDING_MODEL (sentence-transformers, CPU) para los modos de búsqueda
+semantic/hybrid; se guardan como matriz float32 .npy junto al índice.
+
+Uso:
+    python scripts/build_knowledge_index.py [--force] [--embeddings]
+"""
+import sys
+import os
+import time
+from pathlib import Path
+
+# Configurar codificación UTF-8 para Windows
+if sys.platform == 'win32':
+    import io
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+# Cambiar al directorio backend para cargar .env
+backend_dir = Path(__file__).parent.parent / "backend"
+os.chdir(backend_dir)
+
+sys.path.insert(0, str(backend_dir))
+
+from services.knowledge_service import KnowledgeService
+
+
+def build_knowledge_index(force: bool = False, embeddings: bool = False):
+    """Construye el índice y compara la carga desde el PDF con la carga desde el índice"""
+    print("=== Índice del Servicio de Conocimiento ===\n")
+
+    try:
+        # Sin cargar en el constructor: el índice se construye explícitamente
+        service = KnowledgeService(load=False)
+
+        if not service.knowledge_base_path.exists():
+            print(f"[ERROR] No se encontró el PDF: {service.knowledge_base_path}")
+            return False
+
+        inicio = time.perf_counter()
+        result = service.build_index(force=force)
+        duracion = time.perf_counter() - inicio
+
+        estado = "reconstruido" if result["rebuilt"] else "vigente (mismo hash, no se re-extrajo)"
+        print(f"[OK] Índice {estado}")
+        print(f"  PDF:     {service.knowledge_base_path.name}")
+        print(f"  SHA-256: {result['pdf_sha256']}")
+        print(f"  Índice:  {result['index']}")
+        print(f"  Chunks:  {result['chunks']}")
+        print(f"  Tiempo:  {duracion:.3f}s\n")
+
+        inicio = time.perf_counter()
+        service.chunks = []
+        service._load_index(result["pdf_sha256"])
+        print(f"Carga desde el índice: {(time.perf_counter() - inicio) * 1000:.1f} ms, {len(service.chunks)} chunks")
+
+        if embeddings:
+            inicio = time.perf_counter()
+            vectores = service.build_embeddings(force=force)
+            estado = "calculados" if vectores["rebuilt"] else "vigentes (mismo PDF y modelo)"
+            print(f"\n[OK] Vectores {estado}: {vectores['vectors']} x {vectores['dim']} float32")
+            print(f"  Archivo: {vectores['index']}")
+            print(f"  Tiempo:  {time.perf_counter() - inicio:.3f}s")
+        return True
+
+    except Exception as e:
+        print(f"[ERROR] Error construyendo el índice de conocimiento: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+if __name__ == "__main__":
+    sys.exit(0 if build_knowledge_index(force="--force" in sys.argv, embeddings="--embeddings" in sys.argv) else 1)
@@ -0,0 +1,64 @@
+-- Script SQL para crear las vistas de archivos de valoración en Supabase
+-- Ejecutar este script en el SQL Editor de Supabase
+--
+-- SupabaseService.list_files lee estas vistas para obtener el listado de archivos
+-- ya agrupado en la base de datos (una fila por archivo con su conteo de registros),
+-- en lugar de descargar las filas de valoración y agruparlas en Python.
+-- El nombre de la vista es el de la tabla + SUPABASE_FILES_VIEW_SUFFIX (por defecto "_archivos").
+--
+-- Ajusta los nombres de columna si tus tablas usan otros (archivo_origen, proveedor, fecha, timestamp_ingesta)
+
+-- ============================================================
+-- VISTA: BD_PIP_archivos
+-- ============================================================
+
+CREATE OR REPLACE VIEW "BD_PIP_archivos" AS
+SELECT
+    "TIPO_ARCHIVO" AS name,
+    MAX("FUENTE") AS provider,
+    MAX("FECHA_VALORACION") AS fecha_valoracion,
+    MAX(created_at) AS upload_date,
+    COUNT(*) AS record_count
+FROM "BD_PIP"
+WHERE "TIPO_ARCHIVO" IS NOT NULL
+GROUP BY "TIPO_ARCHIVO";
+
+-- ============================================================
+-- VISTA: BD_Precia_archivos
+-- ============================================================
+
+CREATE OR REPLACE VIEW "BD_Precia_archivos" AS
+SELECT
+    "TIPO_ARCHIVO" AS name,
+    MAX("FUENTE") AS provider,
+    MAX("FECHA_VALORACION") AS fecha_valoracion,
+    MAX(created_at) AS upload_date,
+    COUNT(*) AS record_count
+FROM "BD_Precia"
+WHERE "TIPO_ARCHIVO" IS NOT NULL
+GROUP BY "TIPO_ARCHIVO";
+
+-- Índices para que el GROUP BY y la firma de la caché (último created_at) sean rápidos
+CREATE INDEX IF NOT EXISTS idx_bd_pip_tipo_archivo ON "BD_PIP"("TIPO_ARCHIVO");
+CREATE INDEX IF NOT EXISTS idx_bd_pip_created_at ON "BD_PIP"(created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_bd_precia_tipo_archivo ON "BD_Precia"("TIPO_ARCHIVO");
+CREATE INDEX IF NOT EXISTS idx_bd_precia_created_at ON "BD_Precia"(created_at DESC);
+
+-- Permitir lectura con la anon key / usuarios autenticados
+GRANT SELECT ON "BD_PIP_archivos" TO anon, authenticated;
+GRANT SELECT ON "BD_Precia_archivos" TO anon, authenticated;
+
+-- ============================================================
+-- ALTERNATIVA SIN VISTAS
+-- ============================================================
+-- Si no se crean las vistas, list_files intenta un select agregado de PostgREST
+-- (count() y max()), que requiere habilitar los agregados:
+-- ALTER ROLE authenticator SET pgrst.db_aggregates_enabled = 'true';
+-- NOTIFY pgrst, 'reload config';
+-- Si tampoco está disponible, agrupa en Python recorriendo la tabla completa.
+
+-- ============================================================
+-- VERIFICACIÓN
+-- ============================================================
+-- SELECT * FROM "BD_PIP_archivos" ORDER BY upload_date DESC LIMIT 10;
+-- SELECT * FROM "BD_Precia_archivos" ORDER BY upload_date DESC LIMIT 10;
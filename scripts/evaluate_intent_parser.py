@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Script para evaluar el parser de intención por reglas (ruta rápida de extract_intent)
+
+Ejecuta services.intent_parser.parse_intent sobre el corpus etiquetado
+scripts/intent_corpus.json y reporta:
+- Porcentaje de consultas que se resuelven sin LLM (confianza >= umbral)
+- Precisión de las consultas resueltas por reglas (todos los parámetros correctos)
+- Precisión de las reglas en las consultas que se envían al LLM (calibración de la confianza)
+- Precisión por parámetro
+
+No llama a OpenAI: la extracción del LLM no se mide aquí.
+
+Uso:
+    python scripts/evaluate_intent_parser.py [--umbral 0.7] [--detalle]
+"""
+import sys
+import os
+import json
+import argparse
+from datetime import date
+from pathlib import Path
+
+# Configurar codificación UTF-8 para Windows
+if sys.platform == 'win32':
+    import io
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+CORPUS_PATH = Path(__file__).parent / "intent_corpus.json"
+
+# Cambiar al directorio backend para cargar .env
+backend_dir = Path(__file__).parent.parent / "backend"
+os.chdir(backend_dir)
+
+sys.path.insert(0, str(backend_dir))
+
+from services.intent_parser import parse_intent
+
+# Parámetros evaluados y su valor cuando la etiqueta no los menciona
+CAMPOS = {
+    "isins": [],
+    "nemotecnico": None,
+    "provider": None,
+    "date": None,
+    "fecha_vencimiento": None,
+    "cupon": None,
+    "fields": [],
+    "comparison": False,
+}
+
+
+def comparar(resultado: dict, esperado: dict) -> dict:
+    """Parámetro -> True si las reglas extrajeron el valor etiquetado"""
+    aciertos = {}
+    for campo, defecto in CAMPOS.items():
+        valor = resultado.get(campo)
+        objetivo = esperado.get(campo, defecto)
+        if campo in ("isins", "fields"):
+            aciertos[campo] = sorted(valor or []) == sorted(objetivo)
+        elif campo == "cupon" and valor is not None and objetivo is not None:
+            aciertos[campo] = abs(valor - objetivo) < 1e-9
+        else:
+            aciertos[campo] = (valor or defecto) == objetivo
+    return aciertos
+
+
+def porcentaje(parte: int, total: int) -> str:
+    return f"{parte}/{total} ({parte / total:.0%})" if total else "0/0"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluación del parser de intención por reglas")
+    parser.add_argument("--umbral", type=float, default=None,
+                        help="Confianza mínima para no llamar al LLM (por defecto settings.intent_fast_path_min_confidence)")
+    parser.add_argument("--detalle", action="store_true", help="Mostrar cada consulta")
+    args = parser.parse_args()
+
+    if args.umbral is None:
+        from config import settings
+        args.umbral = settings.intent_fast_path_min_confidence
+
+    corpus = json.loads(CORPUS_PATH.read_text(encoding="utf-8"))
+    hoy = date.fromisoformat(corpus["fecha_referencia"])
+    consultas = corpus["consultas"]
+
+    reglas = {"total": 0, "correctas": 0}
+    llm = {"total": 0, "correctas": 0}
+    por_campo = {campo: 0 for campo in CAMPOS}
+
+    print(f"=== Parser de intención por reglas: {len(consultas)} consultas, umbral {args.umbral} ===\n")
+    for consulta in consultas:
+        resultado, confianza = parse_intent(consulta["mensaje"], today=hoy)
+        aciertos = comparar(resultado, consulta["esperado"])
+        correcta = all(aciertos.values())
+        for campo, acierto in aciertos.items():
+            por_campo[campo] += acierto
+
+        grupo = reglas if confianza >= args.umbral else llm
+        grupo["total"] += 1
+        grupo["correctas"] += correcta
+
+        if args.detalle or (confianza >= args.umbral and not correcta):
+            ruta = "reglas" if confianza >= args.umbral else "LLM"
+            fallos = [campo for campo, acierto in aciertos.items() if not acierto]
+            estado = "ok" if correcta else f"FALLA {fallos}"
+            print(f"[{ruta:<6} {confianza:.2f}] {consulta['mensaje'][:70]:<70} {estado}")
+
+    if args.detalle:
+        print()
+    print(f"Resueltas sin LLM:              {porcentaje(reglas['total'], len(consultas))}")
+    print(f"Precisión de la ruta rápida:    {porcentaje(reglas['correctas'], reglas['total'])}")
+    print(f"Precisión de reglas bajo umbral: {porcentaje(llm['correctas'], llm['total'])} (se envían al LLM)\n")
+    print("Precisión por parámetro (todas las consultas):")
+    for campo, aciertos in por_campo.items():
+        print(f"  {campo:<18} {porcentaje(aciertos, len(consultas))}")
+
+
+if __name__ == "__main__":
+    main()